@@ -0,0 +1,17 @@
+from typing import Tuple
+import exceptions
+
+
+def parse_address(address: str) -> Tuple[str, object]:
+    """
+    parses 'unix:/path/to/socket' or 'host:port'
+
+    :param address: str
+    :return: tuple('unix', path: str) or tuple('tcp', (host: str, port: int))
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise exceptions.ArgumentError(f"Address must be 'host:port' or 'unix:/path', got {address}")
+    return "tcp", (host, int(port))
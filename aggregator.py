@@ -0,0 +1,265 @@
+from typing import Dict, List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from socket import gethostname
+from time import monotonic
+import asyncio
+import signal
+import socket
+import struct
+import json
+import sys
+from manager import Manager
+from db import Client
+from retention import Retention
+from addresses import parse_address
+
+# every frame is a 4 byte big endian length followed by that many bytes of utf-8 json:
+# {"host": str, "rows": [[time_ms, core, processor, processor_usage, heaviest_process,
+#                         heaviest_process_usage, temperature], ...]}
+# the aggregator answers every frame with ACK once the batch is checked and queued for writing, not once it is
+# written. a frame that is not a valid batch is not answered and its connection is closed
+FRAME_HEADER = struct.Struct("!I")
+ACK = b"\x06"
+MAX_FRAME = 64 * 1024 * 1024
+# the port has no authentication so it only listens on the loopback interface unless told otherwise
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+# the type of each field of a row, bool is left out as json true and false are not numbers here
+ROW_TYPES = [(int,), (int,), (int,), (int, float), (str,), (int, float), (int,)]
+
+
+def parse_batch(body: bytes) -> Tuple[str, List[list]]:
+    """
+    decodes and checks the body of one frame
+
+    :param body: bytes, utf-8 json
+    :return: tuple(host: str, rows: list)
+    """
+    batch = json.loads(body)
+    if not isinstance(batch, dict) or not isinstance(batch.get("host"), str) or \
+            not isinstance(batch.get("rows"), list):
+        raise ValueError("batch must be an object with a 'host' string and a 'rows' list")
+    for row in batch["rows"]:
+        if not isinstance(row, list) or len(row) != len(ROW_TYPES):
+            raise ValueError(f"rows must have {len(ROW_TYPES)} fields, got {row!r}")
+        for value, types in zip(row, ROW_TYPES):
+            if isinstance(value, bool) or not isinstance(value, types):
+                raise ValueError(f"row has a field of the wrong type, got {row!r}")
+    return batch["host"], batch["rows"]
+
+
+def encode_frame(host: str, rows: List[list]) -> bytes:
+    body = json.dumps({"host": host, "rows": rows}, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+class Aggregator:
+    """
+    receives batches of samples from many agents and writes them to one database
+
+    batches are put on a bounded queue. when the database falls behind the queue fills up,
+    connection handlers stop reading and the agents are held back by their sockets.
+    all database work happens on a single writer thread so the event loop never blocks on it.
+    batches are acknowledged once they are queued, on SIGTERM or ctrl-c the aggregator stops listening
+    and writes what is queued before it exits. a batch that fails to be written is logged and dropped,
+    the writer carries on with the next ones.
+    """
+
+    def __init__(self, engine_adress: str, queue_size: int = 1024, flush_interval: float = 1.0,
+                 report_every: Optional[float] = 60, retention: Optional[Retention] = None):
+        self.engine_adress = engine_adress
+        self.retention = retention
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.report_every = report_every
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.clients: Dict[str, Client] = {}
+        self.rows_written = 0
+
+    def open(self):
+        self.manager = Manager(self.engine_adress, flush_size=2 ** 31, flush_interval=float("inf"),
+                               retention=self.retention).__enter__()
+
+    def close(self):
+        self.manager.__exit__(None, None, None)
+
+    def write(self, batches: List[Tuple[str, List[list]]]) -> int:
+        """
+        writes batches of samples in one transaction, runs on the writer thread
+
+        :param batches: list of tuple(host: str, rows: list)
+        :return: int, rows written
+        """
+        count = 0
+        for host, rows in batches:
+            if host not in self.clients:
+                self.clients[host] = self.manager.get_client(host)
+            client = self.clients[host]
+            for time, core, cpu, cpu_usage, process, process_usage, temperature in rows:
+                self.manager.buffer_cpu(client, core, cpu, cpu_usage, process, process_usage, temperature, time)
+            count += len(rows)
+        self.manager.flush()
+        return count
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                length, = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME:
+                    break
+                try:
+                    batch = parse_batch(await reader.readexactly(length))
+                except ValueError as error:
+                    # includes json and utf-8 errors, the agent is not acknowledged and sends the batch again
+                    print(f"aggregator dropped an invalid batch: {error}", file=sys.stderr, flush=True)
+                    break
+                await self.queue.put(batch)
+                writer.write(ACK)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # cancelled connections of agents that are still connected when the aggregator exits
+            pass
+        finally:
+            writer.close()
+
+    def write_batches(self, batches: List[Tuple[str, List[list]]]) -> int:
+        """
+        writes batches like write but keeps the writer running when the write fails
+
+        if the transaction fails each batch is written again on its own, the ones that still fail are logged
+        and dropped
+
+        :param batches: list of tuple(host: str, rows: list)
+        :return: int, rows written
+        """
+        try:
+            return self.write(batches)
+        except Exception as error:
+            self.manager.discard()
+            self.clients = {}
+            if len(batches) > 1:
+                return sum(self.write_batches([batch]) for batch in batches)
+            print(f"aggregator dropped {len(batches[0][1]):,} rows of {batches[0][0]} that could not be written: "
+                  f"{error!r}", file=sys.stderr, flush=True)
+            return 0
+
+    async def write_loop(self):
+        """
+        writes the queued batches until a None is queued
+
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        reported = monotonic()
+        stopping = False
+        while not stopping:
+            batch = await self.queue.get()
+            if batch is None:
+                break
+            batches = [batch]
+            deadline = monotonic() + self.flush_interval
+            while monotonic() < deadline:
+                try:
+                    batch = await asyncio.wait_for(self.queue.get(), deadline - monotonic())
+                except asyncio.TimeoutError:
+                    break
+                if batch is None:
+                    stopping = True
+                    break
+                batches.append(batch)
+                if len(batches) >= self.queue_size:
+                    break
+            self.rows_written += await loop.run_in_executor(self.executor, self.write_batches, batches)
+            if self.report_every and monotonic() - reported >= self.report_every:
+                elapsed, reported = monotonic() - reported, monotonic()
+                print(f"aggregator wrote {self.rows_written / elapsed:,.0f} rows/s from {len(self.clients)} hosts, "
+                      f"{self.queue.qsize()} batches queued", flush=True)
+                self.rows_written = 0
+
+    async def serve(self, address: str):
+        """
+        listens on 'address' until cancelled
+
+        :param address: str, 'host:port' or 'unix:/path/to/socket'
+        :return: None
+        """
+        self.queue = asyncio.Queue(self.queue_size)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.open)
+        kind, target = parse_address(address)
+        if kind == "unix":
+            server = await asyncio.start_unix_server(self.handle_connection, target)
+        else:
+            server = await asyncio.start_server(self.handle_connection, *target)
+        writer = asyncio.ensure_future(self.write_loop())
+        serving = asyncio.ensure_future(server.serve_forever())
+        loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+        try:
+            async with server:
+                await serving
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # the queued batches were acknowledged, write them before closing
+            await self.queue.put(None)
+            await writer
+            await loop.run_in_executor(self.executor, self.close)
+
+    def run(self, address: str):
+        try:
+            asyncio.run(self.serve(address))
+        except KeyboardInterrupt:
+            pass
+
+
+class Agent:
+    """
+    sends batches of samples to an aggregator over a blocking socket
+
+    rows are buffered until send is called. if the aggregator can not be reached the rows are kept,
+    up to max_rows after which the oldest are dropped, and sending is tried again on the next send.
+    """
+
+    def __init__(self, address: str, host: str = None, max_rows: int = 100000, timeout: float = 10.0):
+        self.address = parse_address(address)
+        self.host = host if host else gethostname()
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.rows: List[list] = []
+        self.socket: Optional[socket.socket] = None
+
+    def connect(self):
+        kind, target = self.address
+        self.socket = socket.socket(socket.AF_UNIX if kind == "unix" else socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.socket.connect(target)
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def add(self, row: list):
+        self.rows.append(row)
+        if len(self.rows) > self.max_rows:
+            del self.rows[:len(self.rows) - self.max_rows]
+
+    def send(self) -> bool:
+        """
+        sends the buffered rows as one batch and waits for the aggregator to accept it
+
+        :return: bool, True if the rows were accepted
+        """
+        if not self.rows:
+            return True
+        try:
+            if self.socket is None:
+                self.connect()
+            self.socket.sendall(encode_frame(self.host, self.rows))
+            if self.socket.recv(1) != ACK:
+                raise ConnectionError("aggregator closed the connection")
+        except OSError:
+            self.close()
+            return False
+        self.rows = []
+        return True
@@ -0,0 +1,274 @@
+from typing import Dict, List, Optional, Tuple, Deque
+from collections import deque
+from datetime import datetime
+from time import perf_counter
+import subprocess
+import socket
+import json
+import os
+import re
+from addresses import parse_address
+import exceptions
+
+
+MEASUREMENTS = ["temperature", "usage"]
+# how far a value has to fall back past its threshold before an alert clears, in degrees C and percent
+HYSTERESIS = {"temperature": 2.0, "usage": 10.0}
+# seconds a rate of change is measured over unless the rule gives a window
+RATE_WINDOW = 10.0
+RULE = re.compile(r"^(?P<measurement>[a-z]+?)(?P<rate>_rate)?(?P<operator>[<>])(?P<threshold>-?\d+(\.\d+)?)"
+                  r"(?P<options>(,[a-z]+=[^,]+)*)$")
+DURATION = re.compile(r"^(\d+(\.\d+)?)(ms|s|m|h)?$")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}
+
+
+def parse_duration(duration: str) -> float:
+    """
+    :param duration: str, such as '500ms', '30s', '5m' or '1h', seconds if there is no unit
+    :return: float, seconds
+    """
+    match = DURATION.match(duration)
+    if not match:
+        raise exceptions.ArgumentError(f"Duration must be a number followed by ms, s, m or h, got {duration}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(3)]
+
+
+class Rule:
+    """
+    one alert condition that is evaluated for every core on its own
+
+    'temperature>85' fires when a core is above 85 C and clears when it is back below 83 C.
+    'temperature_rate>2' fires when a core warms up faster than 2 C per second over the last 10 seconds.
+    options are added after commas: 'for=30s' only fires once the condition held for 30 seconds,
+    'clear=80' sets the level the value has to get back past to clear, 'window=5s' the window of a rate
+    and 'core=3' only watches core 3. usage is the mean usage in percent of the processors of the core.
+    """
+
+    def __init__(self, text: str):
+        match = RULE.match(text.replace(" ", ""))
+        if not match or match.group("measurement") not in MEASUREMENTS:
+            raise exceptions.ArgumentError(f"Alert rule must look like 'temperature>85,for=30s,clear=80' with "
+                                           f"one of {', '.join(MEASUREMENTS)}, got {text}")
+        self.text = text
+        self.measurement = match.group("measurement")
+        self.rate = bool(match.group("rate"))
+        self.above = match.group("operator") == ">"
+        self.threshold = float(match.group("threshold"))
+        options = dict(option.split("=", 1) for option in match.group("options").split(",") if option)
+        unknown = set(options) - {"for", "clear", "window", "core"}
+        if unknown:
+            raise exceptions.ArgumentError(f"Unknown alert rule option {', '.join(unknown)} in {text}")
+        self.duration = parse_duration(options["for"]) if "for" in options else 0.0
+        self.window = parse_duration(options["window"]) if "window" in options else RATE_WINDOW
+        self.core = int(options["core"]) if "core" in options else None
+        hysteresis = HYSTERESIS[self.measurement] if not self.rate else abs(self.threshold) / 2
+        default_clear = self.threshold - hysteresis if self.above else self.threshold + hysteresis
+        self.clear = float(options["clear"]) if "clear" in options else default_clear
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.text!r})"
+
+
+class RuleState:
+    """
+    what one rule remembers about one core between ticks
+    """
+    __slots__ = ("window", "since", "firing")
+
+    def __init__(self):
+        # (monotonic time, value) of the last 'window' seconds, only used by rates
+        self.window: Deque[Tuple[float, float]] = deque()
+        # when the condition last became true, None while it is not
+        self.since: Optional[float] = None
+        self.firing = False
+
+
+class AlertEngine:
+    """
+    evaluates alert rules against every reading as it is taken and sends alerts to hooks
+
+    everything it needs is kept in memory, a small window per rate rule and core and a few numbers per
+    rule and core, so evaluating never touches the database. an alert is sent once when a rule starts firing
+    for a core and once when it clears, a value has to get back past the clear level before it clears
+    so a value that hovers around the threshold does not send an alert every tick.
+    """
+
+    def __init__(self, rules: List[Rule], hooks: List["Hook"], host: str = None):
+        self.rules = rules
+        self.hooks = hooks
+        self.host = host if host else socket.gethostname()
+        # per rule, dict[core] -> RuleState
+        self.states: List[Dict[int, RuleState]] = [{} for _ in rules]
+        self.evaluations = 0
+        self.seconds = 0.0
+
+    def evaluate(self, now: float, temperatures: Dict[int, float], usages: Dict[int, float]):
+        """
+        :param now: float, monotonic time of the reading
+        :param temperatures: dict[core: int] -> temperature: int, milli degrees C
+        :param usages: dict[core: int] -> usage: float, percent
+        :return: None
+        """
+        began = perf_counter()
+        for rule, states in zip(self.rules, self.states):
+            values = temperatures if rule.measurement == "temperature" else usages
+            scale = 0.001 if rule.measurement == "temperature" else 1.0
+            for core, value in values.items():
+                if rule.core is not None and core != rule.core:
+                    continue
+                value *= scale
+                state = states.get(core)
+                if state is None:
+                    state = states[core] = RuleState()
+                if rule.rate:
+                    window = state.window
+                    window.append((now, value))
+                    while now - window[0][0] > rule.window:
+                        window.popleft()
+                    elapsed = now - window[0][0]
+                    if elapsed <= 0:
+                        continue
+                    value = (value - window[0][1]) / elapsed
+                if not state.firing and state.since is None and \
+                        (value <= rule.threshold if rule.above else value >= rule.threshold):
+                    # the common case, nothing to update
+                    continue
+                self.update(rule, core, state, now, value)
+        self.evaluations += 1
+        self.seconds += perf_counter() - began
+
+    def update(self, rule: Rule, core: int, state: RuleState, now: float, value: float):
+        if state.firing:
+            cleared = value < rule.clear if rule.above else value > rule.clear
+            if cleared:
+                state.firing, state.since = False, None
+                self.send(rule, core, value, "resolved")
+            return
+        triggered = value > rule.threshold if rule.above else value < rule.threshold
+        if not triggered:
+            state.since = None
+            return
+        if state.since is None:
+            state.since = now
+        if now - state.since >= rule.duration:
+            state.firing = True
+            self.send(rule, core, value, "firing")
+
+    def send(self, rule: Rule, core: int, value: float, status: str):
+        alert = {"time": datetime.now().isoformat(timespec="milliseconds"), "host": self.host, "status": status,
+                 "rule": rule.text, "core": core, "value": round(value, 3)}
+        for hook in self.hooks:
+            hook.send(alert)
+
+    def close(self):
+        for hook in self.hooks:
+            hook.close()
+
+    def __str__(self):
+        mean = self.seconds / self.evaluations * 1e6 if self.evaluations else 0.0
+        firing = sum(state.firing for states in self.states for state in states.values())
+        return f"alerts mean {mean:.1f} us per tick, {firing} firing"
+
+
+class Hook:
+    """
+    somewhere alerts are sent, sending never blocks the collector
+    """
+
+    def send(self, alert: dict):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CommandHook(Hook):
+    """
+    starts a command for every alert with the alert in CPU_TEMP_ALERT_* environment variables
+    and as json on stdin, without waiting for it to finish
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.running: List[subprocess.Popen] = []
+
+    def send(self, alert: dict):
+        # reap the commands of earlier alerts that finished
+        self.running = [process for process in self.running if process.poll() is None]
+        environment = dict(os.environ, **{f"CPU_TEMP_ALERT_{key.upper()}": str(value) for key, value in alert.items()})
+        process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, env=environment)
+        try:
+            process.stdin.write(json.dumps(alert).encode() + b"\n")
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.running.append(process)
+
+
+class FileHook(Hook):
+    """
+    appends every alert as a json line to a file
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "a")
+
+    def send(self, alert: dict):
+        self.file.write(json.dumps(alert) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SocketHook(Hook):
+    """
+    sends every alert as one json datagram to a unix or udp socket, alerts are dropped if nobody listens
+    """
+
+    def __init__(self, address: str):
+        kind, self.target = parse_address(address)
+        self.socket = socket.socket(socket.AF_UNIX if kind == "unix" else socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def send(self, alert: dict):
+        try:
+            self.socket.sendto(json.dumps(alert).encode(), self.target)
+        except OSError:
+            pass
+
+    def close(self):
+        self.socket.close()
+
+
+def parse_hook(hook: str) -> Hook:
+    """
+    :param hook: str, 'command:...', 'file:/path', 'socket:unix:/path' or 'socket:host:port'
+    :return: Hook
+    """
+    kind, _, target = hook.partition(":")
+    if kind == "command" and target:
+        return CommandHook(target)
+    if kind == "file" and target:
+        return FileHook(target)
+    if kind == "socket" and target:
+        return SocketHook(target)
+    raise exceptions.ArgumentError(f"Alert hook must be 'command:...', 'file:/path', 'socket:unix:/path' "
+                                   f"or 'socket:host:port', got {hook}")
+
+
+def core_readings(stats: List[tuple]) -> Tuple[Dict[int, float], Dict[int, float]]:
+    """
+    turns the rows of cpu_temp.get_stats into the temperature and mean usage per core
+
+    :param stats: list of tuple(core, processor, processor_usage, process, process_usage, temperature)
+    :return: tuple(temperatures: dict[core] -> milli degrees C, usages: dict[core] -> percent)
+    """
+    temperatures: Dict[int, float] = {}
+    totals: Dict[int, float] = {}
+    counts: Dict[int, int] = {}
+    for core, _, usage, _, _, temperature in stats:
+        temperatures[core] = temperature
+        totals[core] = totals.get(core, 0.0) + usage
+        counts[core] = counts.get(core, 0) + 1
+    return temperatures, {core: totals[core] / counts[core] for core in totals}
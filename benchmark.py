@@ -0,0 +1,449 @@
+from typing import Callable, List, Dict, Optional
+from time import perf_counter, monotonic, sleep
+from datetime import datetime, timedelta
+from pathlib import Path
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+from manager import Manager
+from aggregator import Aggregator, Agent
+from sampler import ProcSampler
+from sensors import SensorRegistry
+from topology import TopologyCache
+from db import Client, Processor, to_timestamp
+from storage import open_storage
+import multiprocessing
+import subprocess
+import statistics
+import tracemalloc
+import resource
+import tempfile
+import argparse
+import random
+import json
+import sys
+import os
+import cpu_temp
+import export
+import fixtures
+
+
+RESULTS = cpu_temp.PROJECT_ROOT.joinpath("benchmark_results.jsonl")
+# modules a one shot --log should not import
+HEAVY_MODULES = ["matplotlib", "apscheduler", "numpy", "sqlalchemy.dialects.postgresql"]
+# run in a fresh interpreter, does what 'cpu_temp.py --log' does against the given /proc, hwmon and database
+ONE_SHOT = """
+import sys
+from time import perf_counter
+from pathlib import Path
+start = perf_counter()
+import cpu_temp
+imported = perf_counter()
+from sampler import ProcSampler
+from sensors import SensorRegistry
+from topology import TopologyCache
+if sys.argv[1]:
+    cpu_temp.SAMPLER = ProcSampler(Path(sys.argv[1]))
+    cpu_temp.SENSORS = SensorRegistry(Path(sys.argv[2]))
+    cpu_temp.TOPOLOGY = TopologyCache(Path(sys.argv[2]).parents[1].joinpath("devices", "system", "cpu"),
+                                      Path(sys.argv[1]))
+cpu_temp.DATABASE_ADRESS = sys.argv[3]
+cpu_temp.store_temp()
+import json
+print(json.dumps({"import": imported - start, "log": perf_counter() - imported,
+                  "heavy": [module for module in sys.argv[4:] if module in sys.modules]}))
+"""
+# a phase whose median got this much slower than the previous run with the same configuration is a regression
+REGRESSION = 0.10
+
+
+def measure(function: Callable, iterations: int) -> List[float]:
+    """
+    times a function over a number of iterations
+
+    :param function: Callable, called without arguments
+    :param iterations: int, how many times to call the function
+    :return: list of durations in seconds
+    """
+    durations = []
+    for _ in range(iterations):
+        start = perf_counter()
+        function()
+        durations.append(perf_counter() - start)
+    return durations
+
+
+def peak_memory(function: Callable) -> int:
+    """
+    runs a function once with tracemalloc and returns the most memory it had allocated at once
+
+    :param function: Callable, called without arguments
+    :return: int, bytes
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_phase(name: str, function: Callable, iterations: int, items: Optional[int] = None) -> Optional[dict]:
+    """
+    warms up, times and measures the peak memory of one phase and prints the summary
+
+    :param name: str, name of the phase
+    :param function: Callable, called without arguments
+    :param iterations: int, timed calls
+    :param items: int, rows or samples handled per call, gives the throughput
+    :return: dict with the results in milliseconds, kilobytes and items per second, None if the phase can not run
+    """
+    # warm up so the sampler has a previous snapshot and the sensors are open like in production
+    try:
+        function()
+    except OSError as error:
+        print(f"{name:<28} skipped, {error}")
+        return None
+    durations = sorted(measure(function, iterations))
+    result = {
+        "mean_ms": statistics.mean(durations) * 1000,
+        "median_ms": statistics.median(durations) * 1000,
+        "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000,
+        "max_ms": durations[-1] * 1000,
+        "peak_kb": peak_memory(function) / 1024}
+    if items:
+        result["throughput"] = items / statistics.median(durations)
+    print(f"{name:<28} median {result['median_ms']:10.3f} ms   p95 {result['p95_ms']:10.3f} ms   "
+          f"max {result['max_ms']:10.3f} ms   peak {result['peak_kb']:10.1f} kB"
+          + (f"   {result['throughput']:14,.0f} /s" if items else ""))
+    return result
+
+
+def collection_phases(live: bool) -> Dict[str, Callable]:
+    phases = {
+        "get_cpu_map": cpu_temp.get_cpu_map,
+        "get_temp": cpu_temp.get_temp,
+        "get_processes": cpu_temp.get_processes,
+        "store_temp": cpu_temp.store_temp,
+    }
+    if live:
+        # ps always reads the real system so it can only be compared there
+        phases["get_processes (ps)"] = cpu_temp.get_processes_ps
+    return phases
+
+
+def plot_phases(host: str, first: datetime, last: datetime) -> Dict[str, Callable]:
+    def plot(measurement: str, core: bool, start_time: datetime):
+        cpu_temp.plot(host, measurement, core, start_time, last)
+        plt.close("all")
+
+    # an hour is read from the raw rows, the full range from the rollups
+    hour = max(first, last - timedelta(hours=1))
+    return {
+        "plot raw hour": (lambda: plot("temperature", False, hour), hour),
+        "plot raw hour --core": (lambda: plot("temperature", True, hour), hour),
+        "plot full range": (lambda: plot("temperature", False, first), first),
+        "plot full range --core": (lambda: plot("temperature", True, first), first),
+    }
+
+
+def benchmark_startup(root: Optional[Path], engine_adress: str, iterations: int) -> Dict[str, dict]:
+    """
+    times a one shot --log from a fresh interpreter the way cron and systemd start it
+
+    the whole process is timed from the outside, the child reports how long importing cpu_temp
+    and taking the reading took and which of HEAVY_MODULES it had imported
+
+    :param root: Path, the generated tree, None reads the real system
+    :param engine_adress: str, database to log to
+    :param iterations: int, processes to start
+    :return: dict[phase: str] -> result
+    """
+    proc, hwmon = (str(root.joinpath("proc")), str(root.joinpath("sys", "class", "hwmon"))) if root else ("", "")
+    command = [sys.executable, "-c", ONE_SHOT, proc, hwmon, engine_adress] + HEAVY_MODULES
+    durations: Dict[str, List[float]] = {"startup (process)": [], "startup (import)": [], "startup (log)": []}
+    heavy = set()
+    for _ in range(iterations):
+        start = perf_counter()
+        process = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True,
+                                 cwd=str(cpu_temp.PROJECT_ROOT), check=True)
+        durations["startup (process)"].append(perf_counter() - start)
+        child = json.loads(process.stdout.splitlines()[-1])
+        durations["startup (import)"].append(child["import"])
+        durations["startup (log)"].append(child["log"])
+        heavy.update(child["heavy"])
+
+    results = {}
+    for name, values in durations.items():
+        results[name] = {"median_ms": statistics.median(values) * 1000, "max_ms": max(values) * 1000}
+        print(f"{name:<28} median {results[name]['median_ms']:10.3f} ms   max {results[name]['max_ms']:10.3f} ms")
+    if heavy:
+        print(f"{'startup':<28} WARNING --log imported {', '.join(sorted(heavy))}")
+    return results
+
+
+def count_rows(engine_adress: str, host: str, start_time: datetime, end_time: datetime) -> int:
+    with Manager(engine_adress) as manager:
+        client = manager.get_client(host)
+        return manager.session.query(Processor).filter(
+            Processor.client_id == client.id, start_time < Processor.time, Processor.time < end_time).count()
+
+
+def benchmark_export(engine_adress: str) -> Dict[str, dict]:
+    """
+    measures how many rows per second every export format writes
+
+    every client in the database is exported in full to os.devnull
+
+    :param engine_adress: str, database to export from
+    :return: dict[phase: str] -> result
+    """
+    results = {}
+    with Manager(engine_adress) as manager, manager.engine.connect() as connection:
+        clients = manager.session.query(Client).all()
+        for formatting in export.FORMATS:
+            rows = 0
+            start = perf_counter()
+            with open(os.devnull, "wb") as file:
+                for client in clients:
+                    rows += export.export(connection, client.id, datetime.fromtimestamp(0), datetime.now(),
+                                          formatting, file)
+            duration = perf_counter() - start
+            name = f"export ({formatting})"
+            results[name] = {"median_ms": duration * 1000, "throughput": rows / duration if duration else 0}
+            print(f"{name:<28} {rows} rows in {duration:.3f} s, {results[name]['throughput']:,.0f} rows/s")
+    return results
+
+
+def directory_size(path: Path) -> int:
+    if path.is_dir():
+        return sum(child.stat().st_size for child in path.iterdir())
+    # the sqlite write ahead log belongs to the database until it is checkpointed
+    return sum(file.stat().st_size for file in path.parent.glob(path.name + "*"))
+
+
+def benchmark_storage(root: Path, rows: int, cpus: int, threads: int) -> Dict[str, dict]:
+    """
+    compares the sqlite database and the binary log of storage.py
+
+    the same readings of one host, one every second, are written to each through the storage interface
+    in batches of 1024 rows like the collector does, then the full range and the last hour are scanned with
+    iter_raw like --stats does. the sqlite write includes keeping the rollups and process counters up to date.
+
+    :param root: Path, directory the storages are created in
+    :param rows: int, processor rows to write
+    :param cpus: int, processors per reading
+    :param threads: int, processors per core
+    :return: dict[phase: str] -> result
+    """
+    generator = random.Random(0)
+    samples = rows // cpus
+    end_time = datetime.now()
+    start_time = end_time - timedelta(seconds=samples)
+    commands = [f"/usr/bin/python3 /srv/app{number}.py" for number in range(20)]
+    readings = [(start_time + timedelta(seconds=sample),
+                 [(processor // threads, processor, generator.random() * 100, generator.choice(commands),
+                   generator.random() * 50, 40000 + generator.randrange(30000)) for processor in range(cpus)])
+                for sample in range(samples)]
+    ranges = {"full": (start_time - timedelta(seconds=1), end_time + timedelta(seconds=1)),
+              "hour": (end_time - timedelta(hours=1), end_time + timedelta(seconds=1))}
+
+    results = {}
+    for name, path, adress in [("sqlite", root.joinpath("storage.db"), f"sqlite:////{root.joinpath('storage.db')}"),
+                               ("log", root.joinpath("storage.log"), f"log://{root.joinpath('storage.log')}")]:
+        start = perf_counter()
+        with open_storage(adress, flush_size=1024, flush_interval=float("inf")) as storage:
+            for time, stats in readings:
+                storage.add("benchmark", time, stats)
+        duration = perf_counter() - start
+        results[f"storage write ({name})"] = {"median_ms": duration * 1000, "throughput": samples * cpus / duration}
+        footprint = directory_size(path)
+        results[f"storage size ({name})"] = {"bytes": footprint, "bytes_per_row": footprint / (samples * cpus)}
+        print(f"{'storage write (' + name + ')':<28} {samples * cpus} rows in {duration:.3f} s, "
+              f"{samples * cpus / duration:,.0f} rows/s, {footprint / 2 ** 20:.1f} MB on disk, "
+              f"{footprint / (samples * cpus):.1f} bytes per row")
+
+        with open_storage(adress) as storage:
+            client_ids = list(storage.hosts("benchmark"))
+            for scan, (scan_start, scan_end) in ranges.items():
+                phase = f"storage scan {scan} ({name})"
+                start = perf_counter()
+                scanned = sum(len(values) for _, _, values, _ in storage.iter_raw(
+                    client_ids, "temperature", "processor", scan_start, scan_end))
+                duration = perf_counter() - start
+                results[phase] = {"median_ms": duration * 1000, "throughput": scanned / duration if duration else 0}
+                print(f"{phase:<28} {scanned} rows in {duration:.3f} s, {results[phase]['throughput']:,.0f} rows/s")
+    return results
+
+
+def get_revision() -> Optional[str]:
+    try:
+        process = subprocess.run("git rev-parse --short HEAD".split(), stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, universal_newlines=True, cwd=str(cpu_temp.PROJECT_ROOT))
+    except OSError:
+        return None
+    return process.stdout.strip() or None
+
+
+def store_results(path: Path, config: dict, phases: Dict[str, dict]):
+    """
+    appends the results to 'path' and prints how each phase changed since the last run with the same config
+
+    :param path: Path, json lines file
+    :param config: dict, the benchmark configuration
+    :param phases: dict[phase: str] -> result
+    :return: None
+    """
+    previous = None
+    if path.exists():
+        with open(str(path)) as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry["config"] == config:
+                    previous = entry
+
+    if previous:
+        print(f"\ncompared to {previous['revision']} at {previous['time']}")
+        for name, result in phases.items():
+            before = previous["phases"].get(name)
+            if not before or not before.get("median_ms"):
+                continue
+            change = result["median_ms"] / before["median_ms"] - 1
+            print(f"{name:<28} {change * 100:+8.1f} %" + ("   REGRESSION" if change > REGRESSION else ""))
+
+    with open(str(path), "a") as file:
+        file.write(json.dumps({"time": datetime.now().isoformat(timespec="seconds"), "revision": get_revision(),
+                               "config": config, "phases": phases}) + "\n")
+
+
+def simulate_agents(address: str, first_host: int, hosts: int, processors: int, seconds: int) -> int:
+    """
+    pretends to be 'hosts' agents that each send one reading of 'processors' processors every second
+
+    :return: int, rows accepted by the aggregator
+    """
+    agents = [Agent(address, host=f"benchmark-{host}") for host in range(first_host, first_host + hosts)]
+    sent = 0
+    start = monotonic()
+    for second in range(seconds):
+        timestamp = to_timestamp(datetime.now())
+        for agent in agents:
+            for processor in range(processors):
+                agent.add([timestamp, processor // 2, processor, 12.5, "/usr/bin/python3 /srv/app.py", 10.0, 45000])
+            count = len(agent.rows)
+            if agent.send():
+                sent += count
+        delay = start + second + 1 - monotonic()
+        if delay > 0:
+            sleep(delay)
+    for agent in agents:
+        agent.close()
+    return sent
+
+
+def benchmark_aggregator(hosts: int, agents: int, seconds: int, processors: int = 8):
+    """
+    runs an aggregator on a unix socket with a temporary database and 'agents' processes
+    that together act as 'hosts' hosts sending a reading every second.
+    the aggregator kept up if every row sent was written within 2 seconds of the last send
+
+    :return: None
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        address = f"unix:{directory}/aggregator.sock"
+        engine_adress = f"sqlite:////{directory}/aggregator.db"
+        server = multiprocessing.Process(target=Aggregator(engine_adress, report_every=None).run, args=(address,))
+        server.start()
+        while not os.path.exists(f"{directory}/aggregator.sock"):
+            sleep(0.05)
+
+        per_agent = [hosts // agents + (1 if agent < hosts % agents else 0) for agent in range(agents)]
+        firsts = [sum(per_agent[:agent]) for agent in range(agents)]
+        with multiprocessing.Pool(agents) as pool:
+            sent = sum(pool.starmap(simulate_agents, [(address, first, count, processors, seconds)
+                                                      for first, count in zip(firsts, per_agent)]))
+        # give the writer the flush interval to catch up before stopping it
+        sleep(2)
+        server.terminate()
+        server.join()
+
+        with Manager(engine_adress) as manager:
+            written = manager.session.query(Processor).count()
+        print(f"{'aggregator':<24} {hosts} hosts x {processors} processors for {seconds} s: "
+              f"{sent} rows sent, {written} written, {written / seconds:,.0f} rows/s "
+              f"({hosts * processors} rows/s needed), {'kept up' if written >= sent else 'fell behind'}")
+
+
+def handle():
+    parser = argparse.ArgumentParser(description="Benchmarks cpu_temp against a generated /proc and /sys/class/hwmon.")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--cpus", type=int, default=8, help="Processors in the generated system.")
+    parser.add_argument("--threads", type=int, default=2, help="Processors per core in the generated system.")
+    parser.add_argument("--sockets", type=int, default=1, help="Physical packages in the generated system.")
+    parser.add_argument("--processes", type=int, default=1000, help="Processes in the generated /proc.")
+    parser.add_argument("--layout", type=str, default="coretemp", help=f"Sensor layout: {', '.join(fixtures.LAYOUTS)}.")
+    parser.add_argument("--rows", type=int, default=0, help="Seed a database with this many rows and benchmark "
+                                                            "plot and export against it.")
+    parser.add_argument("--storage_rows", type=int, default=0, help="Write this many rows to sqlite and to the "
+                                                                    "binary log and compare writing, scanning "
+                                                                    "and size.")
+    parser.add_argument("--live", action="store_true", help="Read the real /proc and /sys instead of generated ones.")
+    parser.add_argument("--database", type=str, help="Database adress to benchmark exports against.")
+    parser.add_argument("--results", type=str, help=f"Where results are stored, defaults to {RESULTS.name}.")
+    parser.add_argument("--aggregator_hosts", type=int, help="Benchmark the aggregator with this many hosts.")
+    parser.add_argument("--aggregator_agents", type=int, default=4, help="Agent processes simulating the hosts.")
+    parser.add_argument("--aggregator_seconds", type=int, default=10)
+    args = parser.parse_args()
+
+    config = {"live": args.live, "iterations": args.iterations, "rows": args.rows, "storage_rows": args.storage_rows}
+    if not args.live:
+        config.update({"cpus": args.cpus, "threads": args.threads, "sockets": args.sockets,
+                       "processes": args.processes, "layout": args.layout})
+
+    phases = {}
+    with tempfile.TemporaryDirectory() as directory:
+        root = Path(directory)
+        if not args.live:
+            fixtures.make_tree(root, args.cpus, args.threads, args.processes, args.layout, args.sockets)
+            cpu_temp.SAMPLER = ProcSampler(root.joinpath("proc"))
+            cpu_temp.SENSORS = SensorRegistry(root.joinpath("sys", "class", "hwmon"))
+            cpu_temp.TOPOLOGY = TopologyCache(root.joinpath("sys", "devices", "system", "cpu"), root.joinpath("proc"))
+        cpu_temp.DATABASE_ADRESS = f"sqlite:////{root.joinpath('store.db')}"
+
+        for name, function in collection_phases(args.live).items():
+            result = run_phase(name, function, args.iterations, items=1)
+            if result:
+                phases[name] = result
+        phases.update(benchmark_startup(None if args.live else root, cpu_temp.DATABASE_ADRESS,
+                                        max(1, args.iterations // 5)))
+
+        if args.rows:
+            engine_adress = f"sqlite:////{root.joinpath('seed.db')}"
+            start = perf_counter()
+            first = fixtures.seed_database(engine_adress, args.rows, args.cpus, args.threads)
+            duration = perf_counter() - start
+            phases["seed"] = {"median_ms": duration * 1000, "throughput": args.rows / duration}
+            print(f"{'seed':<28} {args.rows} rows in {duration:.3f} s, {args.rows / duration:,.0f} rows/s")
+
+            cpu_temp.DATABASE_ADRESS = engine_adress
+            last = datetime.now()
+            for name, (function, start_time) in plot_phases("benchmark", first, last).items():
+                rows = count_rows(engine_adress, "benchmark", start_time, last)
+                result = run_phase(name, function, max(1, args.iterations // 10), items=rows)
+                if result:
+                    phases[name] = result
+            phases.update(benchmark_export(engine_adress))
+        if args.storage_rows:
+            phases.update(benchmark_storage(root, args.storage_rows, args.cpus, args.threads))
+
+    if args.database:
+        phases.update(benchmark_export(args.database))
+    if args.aggregator_hosts:
+        benchmark_aggregator(args.aggregator_hosts, args.aggregator_agents, args.aggregator_seconds)
+
+    print(f"{'peak rss':<28} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:,} kB")
+    store_results(Path(args.results) if args.results else RESULTS, config, phases)
+
+
+if __name__ == '__main__':
+    handle()
@@ -0,0 +1,342 @@
+from typing import Dict, List, Optional, Tuple, Iterator, TYPE_CHECKING
+from datetime import datetime
+from time import monotonic
+from pathlib import Path
+import struct
+import json
+import mmap
+from timestamps import to_timestamp
+from storage import Storage
+
+if TYPE_CHECKING:
+    import numpy as np
+    from retention import Retention
+
+
+# a log is a directory of segments, each segment is a data file and a sparse index file:
+# segment-00000001.log  HEADER_SIZE byte header (MAGIC, uint32 record size, uint32 INDEX_EVERY)
+#                       followed by fixed size RECORD records in the order they were written
+# segment-00000001.idx  one INDEX entry (int64 min time, int64 max time) for every full block of
+#                       INDEX_EVERY records of the segment, the last partial block is not indexed
+# hosts.jsonl and commands.jsonl hold one json string per line, the host or command with id n is on line n.
+# records are only ever appended, a new segment is started when one holds segment_records records
+# and retention deletes whole segments.
+MAGIC = b"CPULOG01"
+HEADER = struct.Struct("<8sII")
+HEADER_SIZE = 64
+RECORD = struct.Struct("<qihhifif")
+RECORD_FIELDS = [("time", "<i8"), ("client_id", "<i4"), ("processor", "<i2"), ("core", "<i2"),
+                 ("temperature", "<i4"), ("processor_usage", "<f4"), ("heaviest_process_id", "<i4"),
+                 ("heaviest_process_usage", "<f4")]
+INDEX = struct.Struct("<qq")
+INDEX_FIELDS = [("min", "<i8"), ("max", "<i8")]
+INDEX_EVERY = 4096
+SEGMENT_RECORDS = 256 * INDEX_EVERY
+CHUNK_SIZE = 100000
+
+
+def load_names(path: Path) -> List[str]:
+    """
+    reads hosts.jsonl or commands.jsonl, a line cut short by a crash is removed
+
+    :param path: Path
+    :return: list of names, the name with id n at index n - 1
+    """
+    if not path.exists():
+        return []
+    with open(str(path), "rb+") as file:
+        data = file.read()
+        if data and not data.endswith(b"\n"):
+            data = data[:data.rfind(b"\n") + 1]
+            file.truncate(len(data))
+    return [json.loads(line) for line in data.splitlines()]
+
+
+def segment_paths(path: Path) -> List[Path]:
+    return sorted(path.glob("segment-*.log"))
+
+
+def record_count(segment: Path) -> int:
+    return max(0, (segment.stat().st_size - HEADER_SIZE) // RECORD.size)
+
+
+def block_bounds(data: bytes) -> Tuple[int, int]:
+    """
+    :param data: bytes, whole records
+    :return: tuple(min time, max time) of the records
+    """
+    times = [time for time, *_ in RECORD.iter_unpack(data)]
+    return min(times), max(times)
+
+
+def segment_bounds(segment: Path) -> Optional[Tuple[int, int]]:
+    """
+    finds the oldest and newest time in a segment from its index and unindexed tail
+
+    :param segment: Path, the .log file
+    :return: tuple(min time, max time) or None if the segment is empty
+    """
+    count = record_count(segment)
+    if not count:
+        return None
+    with open(str(segment), "rb") as file:
+        _, _, index_every = HEADER.unpack(file.read(HEADER.size))
+        bounds = [bounds for bounds in INDEX.iter_unpack(segment.with_suffix(".idx").read_bytes())]
+        bounds = bounds[:count // index_every]
+        tail = len(bounds) * index_every
+        if tail < count:
+            file.seek(HEADER_SIZE + tail * RECORD.size)
+            bounds.append(block_bounds(file.read((count - tail) * RECORD.size)))
+    return min(low for low, _ in bounds), max(high for _, high in bounds)
+
+
+class LogStorage(Storage):
+    """
+    fixed size records in segmented append only files with a sparse time index, read through mmap
+
+    every reading is RECORD.size bytes per processor, hosts and commands are stored once and referred to by id.
+    a range is read by looking up the blocks of INDEX_EVERY records whose time span overlaps it in the index
+    of every segment and only filtering those, straight from the memory mapped file. records are expected
+    to arrive roughly in time order, late records are still found as every block knows its own span.
+
+    writing loads neither sqlalchemy nor numpy so a one shot --log stays light, numpy is only loaded to read.
+    a crash can cut the last record short, it is dropped the next time the log is opened for writing.
+    there are no rollups and no ticks, retention deletes segments once all their records are older than
+    the raw age of the policy.
+    """
+
+    def __init__(self, path: str, flush_size: int = 1024, flush_interval: float = 30.0,
+                 retention: Optional["Retention"] = None, segment_records: int = SEGMENT_RECORDS,
+                 index_every: int = INDEX_EVERY):
+        """
+        :param path: str, the directory of the log, created if missing
+        :param flush_size: int, records buffered before they are written
+        :param flush_interval: float, longest time in seconds records are buffered
+        :param retention: retention.Retention, deletes old segments after every flush
+        :param segment_records: int, records per segment, a multiple of index_every
+        :param index_every: int, records per index entry of new segments
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.segment_records = segment_records
+        self.index_every = index_every
+        self.host_names = load_names(self.path.joinpath("hosts.jsonl"))
+        self.host_ids = {name: number for number, name in enumerate(self.host_names, start=1)}
+        self.command_ids: Optional[Dict[str, int]] = None
+        self.buffer: List[tuple] = []
+        self.last_flush = monotonic()
+        # the segment being written, opened on the first flush
+        self.data = None
+        # closed segments never change so their time span is only read once, for retention
+        self.bounds: Dict[Path, Optional[Tuple[int, int]]] = {}
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        if self.data:
+            self.data.close()
+            self.index.close()
+
+    def intern(self, names: Dict[str, int], file_name: str, name: str) -> int:
+        if name not in names:
+            # written before any record that refers to it
+            with open(str(self.path.joinpath(file_name)), "a") as file:
+                file.write(json.dumps(name) + "\n")
+            names[name] = len(names) + 1
+        return names[name]
+
+    def add(self, host: str, time: datetime, stats: List[tuple]):
+        if self.command_ids is None:
+            self.command_ids = {name: number for number, name in
+                                enumerate(load_names(self.path.joinpath("commands.jsonl")), start=1)}
+        client_id = self.intern(self.host_ids, "hosts.jsonl", host)
+        timestamp = to_timestamp(time)
+        for core, cpu, cpu_usage, process, process_usage, temperature in stats:
+            self.buffer.append((timestamp, client_id, cpu, core, temperature, cpu_usage,
+                                self.intern(self.command_ids, "commands.jsonl", process), process_usage))
+        if len(self.buffer) >= self.flush_size or monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def open_segment(self, segment: Path):
+        """
+        opens a segment for appending, creating it or repairing what a crash left behind
+
+        :param segment: Path, the .log file
+        :return: None
+        """
+        index_path = segment.with_suffix(".idx")
+        if not segment.exists():
+            with open(str(segment), "wb") as file:
+                file.write(HEADER.pack(MAGIC, RECORD.size, self.index_every).ljust(HEADER_SIZE, b"\0"))
+            index_path.write_bytes(b"")
+        with open(str(segment), "rb+") as file:
+            magic, record_size, self.segment_index_every = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD.size:
+                raise ValueError(f"{segment} is not a cpu_temp log segment")
+            self.count = record_count(segment)
+            file.truncate(HEADER_SIZE + self.count * RECORD.size)
+            blocks = self.count // self.segment_index_every
+            with open(str(index_path), "rb+") as index:
+                entries = index.read()[:blocks * INDEX.size]
+                for block in range(len(entries) // INDEX.size, blocks):
+                    file.seek(HEADER_SIZE + block * self.segment_index_every * RECORD.size)
+                    entries += INDEX.pack(*block_bounds(file.read(self.segment_index_every * RECORD.size)))
+                index.seek(0)
+                index.write(entries)
+                index.truncate()
+            tail = blocks * self.segment_index_every
+            file.seek(HEADER_SIZE + tail * RECORD.size)
+            self.block = block_bounds(file.read()) if tail < self.count else None
+        self.segment = segment
+        self.data = open(str(segment), "ab")
+        self.index = open(str(index_path), "ab")
+
+    def flush(self):
+        """
+        appends the buffered records, starting new segments as they fill up
+
+        :return: None
+        """
+        if self.buffer:
+            if self.data is None:
+                segments = segment_paths(self.path)
+                self.open_segment(segments[-1] if segments else self.path.joinpath("segment-00000001.log"))
+            records = self.buffer
+            while records:
+                if self.count >= self.segment_records:
+                    self.data.close()
+                    self.index.close()
+                    number = int(self.segment.stem.split("-")[1]) + 1
+                    self.open_segment(self.path.joinpath(f"segment-{number:08d}.log"))
+                part = records[:self.segment_records - self.count]
+                records = records[len(part):]
+                self.data.write(b"".join(RECORD.pack(*record) for record in part))
+                for record in part:
+                    time = record[0]
+                    self.block = (min(self.block[0], time), max(self.block[1], time)) if self.block else (time, time)
+                    self.count += 1
+                    if self.count % self.segment_index_every == 0:
+                        self.index.write(INDEX.pack(*self.block))
+                        self.block = None
+            self.data.flush()
+            self.index.flush()
+            self.buffer = []
+        self.last_flush = monotonic()
+        if self.retention:
+            self.expire()
+
+    def expire(self, now: datetime = None) -> int:
+        """
+        deletes the segments whose newest record is older than the raw age of the retention policy
+
+        the segment being written is never deleted
+
+        :param now: datetime, defaults to datetime.now()
+        :return: int, segments deleted
+        """
+        age = self.retention.policy.get("raw")
+        if age is None:
+            return 0
+        cutoff = to_timestamp((now if now else datetime.now()) - age)
+        deleted = 0
+        for segment in segment_paths(self.path):
+            if self.data is not None and segment == self.segment:
+                continue
+            if segment not in self.bounds:
+                self.bounds[segment] = segment_bounds(segment)
+            bounds = self.bounds[segment]
+            if bounds is None or bounds[1] < cutoff:
+                segment.unlink()
+                segment.with_suffix(".idx").unlink()
+                del self.bounds[segment]
+                deleted += 1
+        return deleted
+
+    def hosts(self, host: Optional[str] = None) -> Dict[int, str]:
+        self.host_names = load_names(self.path.joinpath("hosts.jsonl"))
+        return {number: name for number, name in enumerate(self.host_names, start=1) if not host or name == host}
+
+    def scan(self, client_ids: List[int], start_time: datetime, end_time: datetime,
+             chunk_size: int = CHUNK_SIZE) -> Iterator["np.ndarray"]:
+        """
+        yields the records of the clients after start_time and before end_time
+
+        only the blocks whose indexed time span overlaps the range and the unindexed tail of each segment
+        are looked at, at most chunk_size records at a time
+
+        :param client_ids: list of int
+        :param start_time: datetime
+        :param end_time: datetime
+        :param chunk_size: int, records filtered at once
+        :return: iterator of structured arrays with RECORD_FIELDS, copies that stay valid after the scan
+        """
+        import numpy as np
+
+        record = np.dtype(RECORD_FIELDS)
+        start, end = to_timestamp(start_time), to_timestamp(end_time)
+        ids = np.array(client_ids, dtype=np.int32)
+        for segment in segment_paths(self.path):
+            try:
+                file = open(str(segment), "rb")
+            except FileNotFoundError:
+                # deleted by retention since it was listed
+                continue
+            with file:
+                # records written after this point are left for the next scan
+                count = record_count(segment)
+                if not count:
+                    continue
+                _, _, index_every = HEADER.unpack(file.read(HEADER.size))
+                index = np.fromfile(str(segment.with_suffix(".idx")), dtype=np.dtype(INDEX_FIELDS))
+                index = index[:count // index_every]
+                blocks = np.flatnonzero((index["max"] > start) & (index["min"] < end))
+                # runs of neighbouring blocks are read as one range
+                runs = np.split(blocks, np.flatnonzero(np.diff(blocks) != 1) + 1) if len(blocks) else []
+                ranges = [(int(run[0]) * index_every, (int(run[-1]) + 1) * index_every) for run in runs]
+                if len(index) * index_every < count:
+                    ranges.append((len(index) * index_every, count))
+                if not ranges:
+                    continue
+
+                view = mmap.mmap(file.fileno(), HEADER_SIZE + count * RECORD.size, access=mmap.ACCESS_READ)
+                records = np.frombuffer(view, dtype=record, count=count, offset=HEADER_SIZE)
+                part = times = None
+                try:
+                    for first, last in ranges:
+                        for low in range(first, last, chunk_size):
+                            part = records[low:min(last, low + chunk_size)]
+                            times = part["time"]
+                            selected = (times > start) & (times < end) & np.isin(part["client_id"], ids)
+                            if selected.any():
+                                yield part[selected]
+                finally:
+                    # the map can only be closed once nothing points into it
+                    del records, part, times
+                    view.close()
+
+    def read_raw(self, client_id: int, measurement: str, start_time: datetime, end_time: datetime):
+        import numpy as np
+
+        parts = list(self.scan([client_id], start_time, end_time))
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), \
+                np.empty(0)
+        records = np.concatenate(parts)
+        return records["time"].astype(np.int64), records["processor"].astype(np.int64), \
+            records["core"].astype(np.int64), records[measurement].astype(np.float64)
+
+    def iter_raw(self, client_ids: List[int], measurement: str, by: str, start_time: datetime, end_time: datetime):
+        import numpy as np
+
+        for records in self.scan(client_ids, start_time, end_time):
+            keys = records[by].astype(np.float64) if by != "host" else np.zeros(len(records))
+            # every record is a single reading
+            yield [records["client_id"].astype(np.float64), keys, records[measurement].astype(np.float64),
+                   np.ones(len(records))]
+
+    def iter_rollups(self, client_id: int, measurement: str, by: str, resolution: int, start_time: datetime,
+                     until: int):
+        # the log keeps no rollups, rollups is False so stats only reads the raw records
+        return iter(())
@@ -0,0 +1,94 @@
+from typing import Dict, List, Optional, Tuple
+from datetime import timedelta
+import exceptions
+
+
+# how far a reading has to move from the stored row before a new row is written, in degrees C and percent
+DEFAULT_EPSILON: Dict[str, float] = {"temperature": 1.0, "usage": 5.0}
+# longest time in seconds a row stands for, stored rows of a processor are never further apart than this
+MAX_RUN = 60.0
+
+
+def parse_epsilon(epsilon: str) -> Dict[str, float]:
+    """
+    parses 'measurement=value,...' such as 'temperature=0.5,usage=2'
+
+    measurements that are not given keep the value of DEFAULT_EPSILON
+
+    :param epsilon: str
+    :return: dict[measurement: str] -> float
+    """
+    parsed = dict(DEFAULT_EPSILON)
+    for part in epsilon.split(","):
+        measurement, _, value = part.strip().partition("=")
+        if measurement not in DEFAULT_EPSILON or not value.replace(".", "", 1).isdigit():
+            raise exceptions.ArgumentError(f"Epsilon must be 'measurement=value,...' with measurements "
+                                           f"{', '.join(DEFAULT_EPSILON)} and values of 0 or more, got {part}")
+        parsed[measurement] = float(value)
+    return parsed
+
+
+class ChangeFilter:
+    """
+    keeps back the processor rows of readings that stay within epsilon of the row stored before them
+
+    a stored row stands for a run of readings of one processor. it holds the values of the first reading of the run,
+    the time of the last one in 'until' and how many readings there were in 'samples'.
+    a run ends when a reading moves more than epsilon away from it or when it is max_run seconds long,
+    its row is then handed back to be written and the reading starts the next run.
+    the heaviest process of a run is the one of its first reading.
+    """
+
+    def __init__(self, epsilon: Optional[Dict[str, float]] = None, max_run: float = MAX_RUN):
+        """
+        :param epsilon: dict[measurement: str] -> float, degrees C for 'temperature' and percent for 'usage',
+                        defaults to DEFAULT_EPSILON
+        :param max_run: float, longest run in seconds
+        """
+        epsilon = dict(DEFAULT_EPSILON, **epsilon) if epsilon else DEFAULT_EPSILON
+        # temperatures are stored in milli degrees C
+        self.temperature = epsilon["temperature"] * 1000
+        self.usage = epsilon["usage"]
+        self.max_run = timedelta(seconds=max_run)
+        self.runs: Dict[Tuple[int, int], dict] = {}
+
+    def moved(self, usage: Optional[float], temperature: Optional[int], previous_usage: Optional[float],
+              previous_temperature: Optional[int]) -> bool:
+        """
+        :return: bool, True if usage or temperature moved more than epsilon
+        """
+        for value, previous, epsilon in ((usage, previous_usage, self.usage),
+                                         (temperature, previous_temperature, self.temperature)):
+            if value is None or previous is None:
+                # a sensor that appeared or went away
+                if value is not previous:
+                    return True
+            elif abs(value - previous) > epsilon:
+                return True
+        return False
+
+    def add(self, row: dict) -> Optional[dict]:
+        """
+        adds the processor row of one reading
+
+        :param row: dict, a processor row as buffered by Manager.buffer_cpu
+        :return: dict, the row of the run the reading ended or None if the reading continues the run
+        """
+        key = (row["client_id"], row["processor"])
+        run = self.runs.get(key)
+        if run is not None and row["time"] - run["time"] < self.max_run and not self.moved(
+                row["processor_usage"], row["temperature"], run["processor_usage"], run["temperature"]):
+            run["until"] = row["time"]
+            run["samples"] += 1
+            return None
+        self.runs[key] = dict(row, until=row["time"], samples=1)
+        return run
+
+    def close(self) -> List[dict]:
+        """
+        ends every run, called when the collector stops so the last readings are not lost
+
+        :return: list of the rows of the runs
+        """
+        runs, self.runs = list(self.runs.values()), {}
+        return runs
@@ -0,0 +1,280 @@
+from typing import Dict, List, Optional
+from socket import gethostname
+from time import monotonic, sleep, perf_counter
+from pathlib import Path
+from datetime import datetime
+from manager import Manager
+from sampler import ProcSampler
+from ring import RingBuffer, RECORD
+from aggregator import Agent
+from db import to_timestamp
+from instrument import TickProfiler
+from retention import Retention
+from alerts import AlertEngine, core_readings
+from changes import ChangeFilter
+import numpy as np
+import statistics
+import signal
+import sys
+import cpu_temp
+
+
+class TickStats:
+    """
+    keeps track of how long each collector tick took and how late it started
+
+    latency is the time spent taking and storing a reading,
+    jitter is how long after its scheduled time a tick started.
+    """
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.jitters: List[float] = []
+        self.missed = 0
+
+    def add(self, jitter: float, latency: float):
+        self.jitters.append(jitter)
+        self.latencies.append(latency)
+
+    def __len__(self):
+        return len(self.latencies)
+
+    def __str__(self):
+        return f"{len(self)} ticks, " \
+            f"latency mean {statistics.mean(self.latencies) * 1000:.3f} ms " \
+            f"max {max(self.latencies) * 1000:.3f} ms, " \
+            f"jitter mean {statistics.mean(self.jitters) * 1000:.3f} ms " \
+            f"max {max(self.jitters) * 1000:.3f} ms, " \
+            f"missed {self.missed}"
+
+
+class Collector:
+    """
+    collects readings on a fixed interval within one long lived process
+
+    the database engine, session, cpu map and sensor handles are set up once when entered
+    and kept alive between ticks. ticks are scheduled from a monotonic clock relative to the
+    first tick so the interval does not drift, ticks that can not be made in time are skipped.
+    rows are buffered by the manager and written in bulk, see Manager for how much can be lost on a crash.
+    alerts are evaluated on every reading before it is buffered, see AlertEngine.
+
+    with a min_interval the interval adapts: a reading where the temperature or usage of any processor moved
+    more than epsilon since the previous reading drops it to min_interval, and every reading where nothing
+    moved doubles it back up to 'interval'. with a change filter a processor row is only written
+    when its readings move more than epsilon, see changes.ChangeFilter.
+    """
+
+    def __init__(self, engine_adress: str, interval: float, report_every: Optional[int] = 60,
+                 flush_size: int = 1024, flush_interval: float = 30.0, retention: Optional[Retention] = None,
+                 alerts: Optional[AlertEngine] = None, changes: Optional[ChangeFilter] = None,
+                 min_interval: Optional[float] = None):
+        self.engine_adress = engine_adress
+        self.retention = retention
+        self.alerts = alerts
+        self.changes = changes
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.interval = interval
+        self.min_interval = min_interval
+        # what counts as moving for the adaptive interval, the same epsilon as the change filter
+        self.epsilon = changes if changes else ChangeFilter()
+        self.previous: Dict[int, tuple] = {}
+        self.moving = False
+        self.report_every = report_every
+        self.stats = TickStats()
+
+    def __enter__(self):
+        self.manager = Manager(self.engine_adress, self.flush_size, self.flush_interval, self.retention,
+                               self.changes).__enter__()
+        self.core_map = cpu_temp.get_cpu_map()
+        self.client = self.manager.get_client(gethostname())
+        self.profiler = TickProfiler()
+        self.jitter = None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.manager.__exit__(exc_type, exc_val, exc_tb)
+        if self.alerts:
+            self.alerts.close()
+
+    def tick(self):
+        """
+        takes and stores one reading
+
+        the phase timings of the tick are buffered as a ticks row, the write phase includes the flush
+        on the ticks where the buffer is flushed
+
+        :return: None
+        """
+        timings = {"cpu_map": None}
+        top, packages = {}, {}
+        time, stats = cpu_temp.get_stats(self.core_map, timings=timings, top=top, packages=packages)
+        if self.alerts:
+            self.alerts.evaluate(monotonic(), *core_readings(stats))
+        if self.min_interval:
+            self.moving = self.moved(stats)
+        began = perf_counter()
+        # before the processor rows so a flush they trigger writes the processes of the reading as well
+        self.manager.buffer_top(self.client, time, top)
+        self.manager.buffer_packages(self.client, time, packages)
+        for core, cpu, cpu_usage, process, process_usage, temperature in stats:
+            self.manager.buffer_cpu(self.client, core, cpu, cpu_usage, process, process_usage, temperature, time)
+        timings["write"] = perf_counter() - began
+        self.manager.buffer_tick(self.client, self.profiler.measure(time, timings, self.jitter))
+
+    def moved(self, stats: List[tuple]) -> bool:
+        """
+        :param stats: list of rows from cpu_temp.get_stats
+        :return: bool, True if any processor moved more than epsilon since the previous reading
+        """
+        previous, self.previous = self.previous, {cpu: (usage, temperature)
+                                                  for _, cpu, usage, _, _, temperature in stats}
+        return any(self.epsilon.moved(*reading, *previous[cpu]) for cpu, reading in self.previous.items()
+                   if cpu in previous)
+
+    def run(self, ticks: Optional[int] = None):
+        """
+        ticks on the interval until stopped
+
+        SIGTERM is turned into SystemExit so the collector shuts down cleanly under systemd
+
+        :param ticks: int, stop after this many ticks, runs forever if None
+        :return: None
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        start = monotonic()
+        interval = self.interval
+        count = 0
+        scheduled_tick = 0
+        while ticks is None or count < ticks:
+            scheduled = start + scheduled_tick * interval
+            delay = scheduled - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            began = monotonic()
+            self.jitter = began - scheduled
+            self.tick()
+            done = monotonic()
+            self.stats.add(began - scheduled, done - began)
+            count += 1
+
+            scheduled_tick += 1
+            if self.min_interval:
+                adapted = self.min_interval if self.moving else min(interval * 2, self.interval)
+                if adapted != interval:
+                    # the schedule starts over from this tick with the new interval
+                    start, scheduled_tick, interval = scheduled, 1, adapted
+            if done > start + scheduled_tick * interval:
+                # running behind, skip the ticks that already passed instead of bursting to catch up
+                next_tick = int((done - start) // interval) + 1
+                self.stats.missed += next_tick - scheduled_tick
+                scheduled_tick = next_tick
+
+            if self.report_every and len(self.stats) >= self.report_every:
+                print(self.stats, flush=True)
+                if self.min_interval:
+                    print(f"sampling every {interval:g} s", flush=True)
+                if self.alerts:
+                    print(self.alerts, flush=True)
+                self.stats = TickStats()
+
+
+class BurstCollector(Collector):
+    """
+    samples temperatures and processor usage many times a second into a ring buffer
+
+    nothing is written to the database by the burst collector, ring.drain moves the records
+    from the ring into the database at a slower pace. the process scan is skipped as it is
+    too expensive to run at these rates, only /proc/stat and the temperature inputs are read.
+    """
+
+    def __init__(self, ring_path: Path, interval: float, capacity: int, report_every: Optional[int] = 60,
+                 alerts: Optional[AlertEngine] = None):
+        super(BurstCollector, self).__init__(None, interval, report_every, alerts=alerts)
+        self.ring_path = ring_path
+        self.capacity = capacity
+
+    def __enter__(self):
+        self.core_map = cpu_temp.get_cpu_map()
+        self.sampler = ProcSampler()
+        self.sampler.sample_cpus()
+        self.ring = RingBuffer(self.ring_path, self.capacity)
+        self.records = np.zeros(len(self.core_map), dtype=RECORD)
+        self.records["processor"] = list(self.core_map.keys())
+        self.records["core"] = list(self.core_map.values())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.ring.close()
+        if self.alerts:
+            self.alerts.close()
+
+    def tick(self):
+        """
+        takes one reading of every processor and appends it to the ring
+
+        :return: None
+        """
+        time = to_timestamp(datetime.now())
+        temperatures = cpu_temp.get_temp()
+        usage = self.sampler.sample_cpus()
+        if self.alerts:
+            self.alerts.evaluate(monotonic(), temperatures, self.core_usage(usage))
+        self.records["time"] = time
+        self.records["temperature"] = [temperatures[core] for core in self.core_map.values()]
+        self.records["processor_usage"] = [usage.get(processor, 0.0) for processor in self.core_map.keys()]
+        self.ring.append(self.records)
+
+    def core_usage(self, usage: Dict[int, float]) -> Dict[int, float]:
+        """
+        :param usage: dict[processor: int] -> usage: float
+        :return: dict[core: int] -> mean usage of its processors: float
+        """
+        totals: Dict[int, List[float]] = {}
+        for processor, core in self.core_map.items():
+            totals.setdefault(core, []).append(usage.get(processor, 0.0))
+        return {core: sum(values) / len(values) for core, values in totals.items()}
+
+
+class AgentCollector(Collector):
+    """
+    collects readings like Collector but sends them to an aggregator instead of a local database
+
+    readings are sent in one batch every flush_interval seconds and when the collector exits
+    """
+
+    def __init__(self, aggregator_adress: str, interval: float, report_every: Optional[int] = 60,
+                 flush_interval: float = 5.0, alerts: Optional[AlertEngine] = None):
+        super(AgentCollector, self).__init__(None, interval, report_every, flush_interval=flush_interval,
+                                             alerts=alerts)
+        self.aggregator_adress = aggregator_adress
+
+    def __enter__(self):
+        self.core_map = cpu_temp.get_cpu_map()
+        self.agent = Agent(self.aggregator_adress)
+        self.last_send = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.agent.send()
+        self.agent.close()
+        if self.alerts:
+            self.alerts.close()
+
+    def tick(self):
+        """
+        takes one reading and sends the buffered readings if the flush interval passed
+
+        :return: None
+        """
+        time, stats = cpu_temp.get_stats(self.core_map)
+        if self.alerts:
+            self.alerts.evaluate(monotonic(), *core_readings(stats))
+        timestamp = to_timestamp(time)
+        for core, cpu, cpu_usage, process, process_usage, temperature in stats:
+            self.agent.add([timestamp, core, cpu, cpu_usage, process, process_usage, temperature])
+        if monotonic() - self.last_send >= self.flush_interval:
+            self.agent.send()
+            self.last_send = monotonic()
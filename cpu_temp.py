@@ -1,38 +1,30 @@
-from typing import Dict, Union, Tuple, Pattern, List
-from apscheduler.schedulers.blocking import BlockingScheduler
+from typing import Dict, Union, Tuple, Pattern, List, Optional
 from socket import gethostname
 from pathlib import Path
-from time import sleep
-from manager import Manager
+from time import perf_counter, sleep
+from sampler import ProcSampler, FIRST_WINDOW
+from sensors import SensorRegistry
+from topology import TopologyCache
 from datetime import datetime
-from datetime import timedelta
 import exceptions
 import argparse
+import sys
 import subprocess
 import re
-from db import Client, Processor
-from matplotlib import pyplot as plt
+from instrument import TickProfiler
 
-
-# TODO solve issue with gathering cpu_usage stats as they are ps command is wonky
-# TODO add functionality to draw heavy usage stats from db to a table within given timeframe
+# --log is run once a minute by cron and systemd so only what it needs is imported here,
+# the modules for plotting, scheduling, exporting and the other modes are imported by the function that uses them
 
 
 PROJECT_ROOT = Path(__file__).absolute().parent
 DATABASE_ADRESS = f'sqlite:////{str(PROJECT_ROOT.joinpath("db.db"))}'
-
-
-def read_file(path: Path) -> str:
-    """
-    open a file and read its first line
-
-    reads the first line of a file
-
-    :param path: Path, path to the file
-    :return: str, the first line of a file
-    """
-    with open(str(path)) as file:
-        return file.readline().strip()
+MEASUREMENTS = {"usage": "processor_usage", "cpu_usage": "processor_usage"}
+SAMPLER = ProcSampler()
+SENSORS = SensorRegistry()
+TOPOLOGY = TopologyCache()
+# the retention.Retention of the database, see get_retention
+RETENTION = None
 
 
 def parse_ps(row: str, regex: Pattern) -> Tuple[int, float, str]:
@@ -67,8 +59,22 @@ def get_processes() -> Dict[int, dict]:
     """
     finds the heaviest processes in the system for each processor
 
+    reads /proc directly through the module sampler, usage is calculated from the delta
+    since the previous call so it reflects the current load rather than a lifetime average.
+    keys: 'process_usage', 'command', 'processor_usage' and 'top', see sampler.ProcSampler.sample
+
+    :return: dict(processor_id: int) -> dict
+    """
+    return SAMPLER.sample()
+
+
+def get_processes_ps() -> Dict[int, dict]:
+    """
+    finds the heaviest processes in the system for each processor using the ps command
+
     searches the full list of processes in the system and maps the heaviest process,
     the command to the heaviest process aswell as the full processor usage.
+    kept as a reference for benchmark.py, get_processes is the faster replacement.
     keys: 'process_usage', 'command' and 'processor_usage'
 
     :return: dict(processor_id: int) -> dict
@@ -92,34 +98,33 @@ def get_processes() -> Dict[int, dict]:
 
 def get_cpu_map() -> dict:
     """
-    maps each systems processor id to its core id
+    maps each systems processor id to its core
 
     On multithraded processors there will be 2 processors that bellongs to the same core
-    this function creates a map of which processor (their id) bellongs to what core (id)
-
-    :return: dict[processor_id: int] -> core_id: int
-    """
-
-    path = Path("/proc/cpuinfo")
-    if path.exists():
-        process = subprocess.run("cat /proc/cpuinfo".split(), stdout=subprocess.PIPE, universal_newlines=True)
-        out = process.stdout.strip("\n")
-        cpu_map = {}
-        for processor in out.split("\n\n"):
-            processor_id = re.search(r"processor.*(\d)+", processor)
-            if processor_id:
-                thread = int(processor_id.groups()[0])
-                core = re.search(r"core id.*(\d)+", processor)
-                if core:
-                    core = int(core.groups()[0])
-                    cpu_map[thread] = core
-                else:
-                    raise exceptions.CPULoggingNotSupported("Can not find info about core id in /proc/cpuinfo")
-            else:
-                raise exceptions.CPULoggingNotSupported("Can not find info about processor id in /proc/cpuinfo")
-    else:
-        raise exceptions.CPULoggingNotSupported("Can not find file /proc/cpuinfo")
-    return cpu_map
+    this function creates a map of which processor (their id) bellongs to what core.
+    cores are numbered so they are unique on hosts with more than one package, see topology.Topology.
+    the topology is read from /sys/devices/system/cpu, or the cpuinfo of the /proc the module sampler reads
+    when that is not there, and kept until the online processors change.
+
+    :return: dict[processor_id: int] -> core: int
+    """
+    return TOPOLOGY.get().core_map()
+
+
+def get_retention():
+    """
+    the retention of the database, the default policy unless --retention was given
+
+    imported and built on first use as the database modules import the sqlalchemy orm,
+    which is most of what importing this module would cost
+
+    :return: retention.Retention
+    """
+    global RETENTION
+    if RETENTION is None:
+        from retention import Retention
+        RETENTION = Retention()
+    return RETENTION
 
 
 def get_session_time() -> Tuple[datetime, datetime]:
@@ -136,62 +141,99 @@ def get_session_time() -> Tuple[datetime, datetime]:
     return session_start, now
 
 
-def get_temp(need_sleep: bool) -> dict:
+def get_temp() -> dict:
     """
     reads the temperature on each core in the system
 
-    reads the temperature from each core in the system, for production pass need_sleep as True
-    if the reading is taken at the same time as python boots up. Booting python ups the temperature
-    on the scheduled core by around 2 degrees C
-
     the temperature is mapped to the physical core the temperature was read on
-    as mili degrees C
+    as mili degrees C. the sensors are discovered once and kept open by the module sensor registry
+    and matched to the cores of get_cpu_map, cores without a sensor of their own get the one of their package
 
-    :param need_sleep: bool, pass true if python is booted within 3 second of first reading
-    :return: dict[core_id: int] -> temperature: int
+    :return: dict[core: int] -> temperature: int
     """
+    return SENSORS.read(TOPOLOGY.get())
+
 
-    base = Path("/sys/class/hwmon/")
-    for hwmon in base.iterdir():
-        name = read_file(hwmon.joinpath("name").absolute())
-        if name.lower() == "coretemp":
-            labels = [file for file in hwmon.iterdir()
-                      if file.stem.endswith("_label")
-                      and "core" in read_file(file.absolute()).lower()]
-            temps = [hwmon.joinpath(label.stem.replace("label", "input"))
-                     for label in labels]
-            if need_sleep:
-                sleep(3)  # needed for the processor to cool down from the heat generated to launch python
-            temporary = zip([int(re.search(r"(\d)+", read_file(label)).groups()[0]) for label in labels],
-                            [int(read_file(temp)) for temp in temps])
+def get_package_temp() -> Dict[int, int]:
+    """
+    the temperature of each package in the last reading of get_temp, as mili degrees C
 
-            return {core: temp for core, temp in temporary}
+    :return: dict[package: int] -> temperature: int
+    """
+    return dict(SENSORS.packages)
 
 
-def store_temp(need_sleep: bool = False):
+def get_stats(core_map: Dict[int, int], timings: Optional[Dict[str, float]] = None,
+              top: Optional[Dict[int, List[tuple]]] = None,
+              packages: Optional[Dict[int, int]] = None) -> Tuple[datetime, List[tuple]]:
     """
-    makes a database entry at the current time
+    takes one reading of every processor in the system
 
-    stats is a table where each row stores:
+    each row in stats is:
     core: int, processor: int, processor_usage: float, heaviest_process: str, ...
     ... heaviest_process_usage: float, temperature: int
 
-    :param need_sleep: bool, pass True if reading is taken within 3 seconds of python boot
-    :return: None
+    :param core_map: dict[processor_id: int] -> core_id: int, from get_cpu_map
+    :param timings: dict, if given the seconds spent on 'temperature' and 'processes' are stored in it
+    :param top: dict, if given the heaviest processes of every processor are stored in it,
+                dict[processor: int] -> list of tuple(pid, start_time, command, usage)
+    :param packages: dict, if given the temperature of every package is stored in it, see get_package_temp
+    :return: tuple(time: datetime, stats: list)
     """
-
-    core_map = get_cpu_map()
+    if SAMPLER.previous_uptime is None:
+        # the first reading, such as the only one of a one shot --log, would otherwise store the usage
+        # since boot and since each process started, it is taken over FIRST_WINDOW seconds instead
+        SAMPLER.snapshot()
+        sleep(FIRST_WINDOW)
     time = datetime.now()
-    temperatures = get_temp(need_sleep)
+    began = perf_counter()
+    temperatures = get_temp()
+    read = perf_counter()
     processes = get_processes()
+    if timings is not None:
+        timings["temperature"], timings["processes"] = read - began, perf_counter() - read
     stats = [(core_map[cpu], cpu, processes[cpu]["processor_usage"], processes[cpu]["command"],
               processes[cpu]["process_usage"], temperatures[core_map[cpu]])
              for cpu in core_map.keys()]
+    if top is not None:
+        top.update((cpu, processes[cpu].get("top", [])) for cpu in core_map.keys())
+    if packages is not None:
+        packages.update(get_package_temp())
+    return time, stats
 
-    with Manager(DATABASE_ADRESS) as manager:
-        client = manager.get_client(gethostname())
-        for core, cpu, cpu_usage, process, process_usage, temperature in stats:
-            manager.add_cpu(client, core, cpu, cpu_usage, process, process_usage, temperature, time)
+
+def store_temp():
+    """
+    makes a database entry at the current time
+
+    stats is a table where each row stores:
+    core: int, processor: int, processor_usage: float, heaviest_process: str, ...
+    ... heaviest_process_usage: float, temperature: int
+
+    the heaviest processes of every processor and the temperature of every package are stored next to it,
+    see sampler.ProcSampler.sample and get_package_temp.
+    a batch of the rows that expired by RETENTION is deleted after the entry is written.
+    the storage is imported after the reading is taken so the import does not heat up the processor first
+
+    :return: None
+    """
+    profiler = TickProfiler(one_shot=True)
+    began = perf_counter()
+    core_map = get_cpu_map()
+    timings = {"cpu_map": perf_counter() - began}
+    top, packages = {}, {}
+    time, stats = get_stats(core_map, timings, top, packages)
+
+    from storage import open_storage
+    with open_storage(DATABASE_ADRESS, retention=get_retention()) as storage:
+        began = perf_counter()
+        host = gethostname()
+        storage.add(host, time, stats)
+        storage.add_top(host, time, top)
+        storage.add_packages(host, time, packages)
+        storage.flush()
+        timings["write"] = perf_counter() - began
+        storage.add_tick(host, profiler.measure(time, timings))
 
 
 def try_timestamp(timestamp: str, formating: str) -> Union[datetime, None]:
@@ -241,15 +283,255 @@ def schedule(parsed_args: Union[argparse.Namespace, Dict[str, int]]):
     else:
         config = {key: value for key, value in config.items() if value is not None}
 
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
     scheduler = BlockingScheduler()
     scheduler.add_executor("processpool")
     scheduler.add_job(store_temp, parsed_args.job_type, misfire_grace_time=parsed_args.misfire, **config)
     scheduler.start()
 
 
+def get_alerts(args: argparse.Namespace):
+    """
+    builds the alert engine of the long lived modes from the command line
+
+    :param args: argparse.Namespace, uses 'alert' and 'alert_hook'
+    :return: alerts.AlertEngine or None if no alert rules were given
+    """
+    if not args.alert:
+        if args.alert_hook:
+            raise exceptions.ArgumentError("--alert_hook needs at least one --alert rule.")
+        return None
+    import alerts
+
+    rules = [alerts.Rule(rule) for rule in args.alert]
+    hooks = [alerts.parse_hook(hook) for hook in args.alert_hook] if args.alert_hook else []
+    if not hooks:
+        raise exceptions.ArgumentError("--alert needs at least one --alert_hook to send alerts to.")
+    return alerts.AlertEngine(rules, hooks)
+
+
+def collect(args: argparse.Namespace):
+    """
+    runs the long lived collector until it is stopped
+
+    :param args: argparse.Namespace, uses 'interval', 'report', 'flush_interval', 'alert', 'alert_hook',
+                 'adaptive', 'min_interval' and 'epsilon'
+    :return: None
+    """
+    # imported here as collector builds on the functions in this module
+    from collector import Collector
+    from changes import ChangeFilter, parse_epsilon
+
+    interval = args.interval if args.interval else 1.0
+    flush_interval = args.flush_interval if args.flush_interval is not None else 30.0
+    min_interval = (args.min_interval if args.min_interval else 0.25) if args.adaptive else None
+    if min_interval and min_interval > interval:
+        raise exceptions.ArgumentError(f"--min_interval {min_interval:g} is longer than --interval {interval:g}")
+    changes = ChangeFilter(parse_epsilon(args.epsilon)) if args.epsilon else None
+    with Collector(DATABASE_ADRESS, interval, report_every=args.report, flush_interval=flush_interval,
+                   retention=get_retention(), alerts=get_alerts(args), changes=changes,
+                   min_interval=min_interval) as collector:
+        collector.run()
+
+
+def aggregate(args: argparse.Namespace):
+    """
+    runs the aggregator that agents on other hosts send their readings to
+
+    :param args: argparse.Namespace, uses 'listen' and 'flush_interval'
+    :return: None
+    """
+    from aggregator import Aggregator, DEFAULT_ADDRESS
+
+    address = args.listen if args.listen else DEFAULT_ADDRESS
+    flush_interval = args.flush_interval if args.flush_interval is not None else 1.0
+    Aggregator(DATABASE_ADRESS, flush_interval=flush_interval, report_every=args.report,
+               retention=get_retention()).run(address)
+
+
+def agent(args: argparse.Namespace):
+    """
+    runs a collector that sends its readings to an aggregator
+
+    :param args: argparse.Namespace, uses 'aggregator', 'interval', 'report', 'flush_interval', 'alert'
+                 and 'alert_hook'
+    :return: None
+    """
+    # imported here as collector builds on the functions in this module
+    from collector import AgentCollector
+
+    if not args.aggregator:
+        raise exceptions.ArgumentError("--agent needs the --aggregator to send to.")
+    interval = args.interval if args.interval else 1.0
+    flush_interval = args.flush_interval if args.flush_interval is not None else 5.0
+    with AgentCollector(args.aggregator, interval, report_every=args.report,
+                        flush_interval=flush_interval, alerts=get_alerts(args)) as collector:
+        collector.run()
+
+
+def burst(args: argparse.Namespace):
+    """
+    samples into the ring buffer many times a second while a separate process drains it into the database
+
+    :param args: argparse.Namespace, uses 'hz', 'ring', 'ring_seconds', 'drain_interval', 'drain_raw', 'report',
+                 'alert' and 'alert_hook'
+    :return: None
+    """
+    # imported here as collector builds on the functions in this module
+    from collector import BurstCollector
+    import multiprocessing
+    import ring
+
+    hz = args.hz if args.hz else 50.0
+    ring_path = Path(args.ring) if args.ring else PROJECT_ROOT.joinpath("ring.buf")
+    capacity = int(hz * (args.ring_seconds if args.ring_seconds else 60) * len(get_cpu_map()))
+    drain_interval = args.drain_interval if args.drain_interval else 5.0
+
+    with BurstCollector(ring_path, 1 / hz, capacity, report_every=args.report, alerts=get_alerts(args)) as collector:
+        flusher = multiprocessing.Process(
+            target=ring.drain, args=(ring_path, DATABASE_ADRESS, drain_interval, not args.drain_raw, get_retention()))
+        flusher.start()
+        try:
+            collector.run()
+        finally:
+            flusher.terminate()
+            flusher.join()
+
+
+def export_rows(args: argparse.Namespace):
+    """
+    streams the rows of a host within a time range to a file or stdout
+
+    :param args: argparse.Namespace, uses 'host', 'start_time', 'end_time', 'format' and 'output'
+    :return: None
+    """
+    from manager import Manager
+    import export
+
+    host = args.host if args.host else gethostname()
+    start_time = get_time_from_user(args.start_time) if args.start_time else datetime.fromtimestamp(0)
+    end_time = get_time_from_user(args.end_time) if args.end_time else datetime.now()
+    formatting = args.format if args.format else "csv"
+    if formatting not in export.FORMATS:
+        raise exceptions.ArgumentError(f"--format must be one of {', '.join(export.FORMATS)}")
+
+    with Manager(DATABASE_ADRESS) as manager:
+        client = manager.get_client(host)
+        if client.id is None:
+            raise exceptions.ArgumentError(f"There is no data about host {host}")
+        with manager.engine.connect() as connection:
+            if args.output:
+                with open(args.output, "wb") as file:
+                    export.export(connection, client.id, start_time, end_time, formatting, file)
+            else:
+                export.export(connection, client.id, start_time, end_time, formatting, sys.stdout.buffer)
+                sys.stdout.flush()
+
+
+def profile(args: argparse.Namespace):
+    """
+    prints what collecting cost on a host within a time range
+
+    :param args: argparse.Namespace, uses 'host', 'start_time' and 'end_time'
+    :return: None
+    """
+    from manager import Manager
+    import instrument
+
+    host = args.host if args.host else gethostname()
+    start_time = get_time_from_user(args.start_time) if args.start_time else datetime.fromtimestamp(0)
+    end_time = get_time_from_user(args.end_time) if args.end_time else datetime.now()
+
+    with Manager(DATABASE_ADRESS) as manager:
+        client = manager.get_client(host)
+        if client.id is None:
+            raise exceptions.ArgumentError(f"There is no data about host {host}")
+        with manager.engine.connect() as connection:
+            instrument.report(connection, client.id, start_time, end_time)
+
+
+def summarize(args: argparse.Namespace):
+    """
+    prints the mean, median, standard deviation, min, max and percentiles of a measurement
+    per host, core or processor within a time range
+
+    :param args: argparse.Namespace, uses 'host', 'measurement', 'by', 'source', 'start_time' and 'end_time'
+    :return: None
+    """
+    from storage import open_storage
+    import rollup
+    import stats
+
+    measurement = MEASUREMENTS.get(args.measurement, args.measurement) if args.measurement else "temperature"
+    if measurement not in rollup.MEASUREMENTS:
+        raise exceptions.ArgumentError("--measurement must be one of temperature, usage or cpu_usage")
+    by = args.by if args.by else "host"
+    if by not in stats.GROUPS:
+        raise exceptions.ArgumentError(f"--by must be one of {', '.join(stats.GROUPS)}")
+    source = args.source if args.source else "auto"
+    if source not in stats.SOURCES:
+        raise exceptions.ArgumentError(f"--source must be one of {', '.join(stats.SOURCES)}")
+    start_time = get_time_from_user(args.start_time) if args.start_time else datetime.fromtimestamp(0)
+    end_time = get_time_from_user(args.end_time) if args.end_time else datetime.now()
+
+    with open_storage(DATABASE_ADRESS) as storage:
+        stats.report(storage, measurement, by, start_time, end_time, source, args.host)
+
+
+def top(args: argparse.Namespace):
+    """
+    prints the processes that were most often the heaviest, or used the most, per core within a time range
+
+    :param args: argparse.Namespace, uses 'host', 'by', 'rank', 'limit', 'start_time' and 'end_time'
+    :return: None
+    """
+    from manager import Manager
+    import top as heavy
+
+    host = args.host if args.host else gethostname()
+    by = args.by if args.by else "core"
+    if by not in heavy.GROUPS:
+        raise exceptions.ArgumentError(f"--by must be one of {', '.join(heavy.GROUPS)}")
+    rank = args.rank if args.rank else "count"
+    if rank not in heavy.RANKINGS:
+        raise exceptions.ArgumentError(f"--rank must be one of {', '.join(heavy.RANKINGS)}")
+    start_time = get_time_from_user(args.start_time) if args.start_time else datetime.fromtimestamp(0)
+    end_time = get_time_from_user(args.end_time) if args.end_time else datetime.now()
+
+    with Manager(DATABASE_ADRESS) as manager:
+        client = manager.get_client(host)
+        if client.id is None:
+            raise exceptions.ArgumentError(f"There is no data about host {host}")
+        with manager.engine.connect() as connection:
+            heavy.report(connection, client.id, start_time, end_time, by, rank, args.limit)
+
+
+def space():
+    """
+    prints how much each retention tier stores and how long it is kept
+
+    :return: None
+    """
+    from manager import Manager
+    import retention
+
+    with Manager(DATABASE_ADRESS) as manager:
+        retention.report(manager.engine, get_retention().policy)
+
+
 def view(args: Union[argparse.Namespace, Dict[str, int]]):
     host = args.host if args.host else gethostname()
     core = args.core if args.core else False
+    if args.live:
+        import live
+        import rollup
+        measurement = MEASUREMENTS.get(args.measurement, args.measurement) if args.measurement else "temperature"
+        if measurement not in rollup.MEASUREMENTS:
+            raise exceptions.ArgumentError("--measurement must be one of temperature, usage or cpu_usage")
+        live.LiveView(DATABASE_ADRESS, host, measurement, core, window=args.window if args.window else 600.0,
+                      interval=args.interval if args.interval else 1.0).run()
+        return
     if args.this_session:
         start_time, end_time = get_session_time()
     else:
@@ -268,7 +550,7 @@ def plot(host: str, measurment: str, core=False, start_time: datetime = None, en
 
     If 'core' is False on a multithreaded system there will be one line per virtual processor.
     If 'core' is True on a multithreaded system the data from each virtual processor on that core will be avaraged
-    to show one line per core.
+    to show one line per core, every virtual processor on the core weighs the same.
     The value of 'core' wont matter on non multithreaded systems.
 
     If a value is given to 'start_time' only data availeble from that time will be used in the graph.
@@ -277,45 +559,32 @@ def plot(host: str, measurment: str, core=False, start_time: datetime = None, en
     If a value is given to 'end_time' only data availeble up untill that time will be used in the graph
     If not value not given there will be no upper limit on the data used in the graph.
 
+    When the time range is long enough the mean of each minute, hour or day is drawn instead of the raw rows,
+    read from the rollups where the storage keeps them, see storage.Storage.read_series.
+
     :param host: str, the hostname to plot
-    :param measurment: str, takes value 'usage' or 'temperature'
+    :param measurment: str, takes value 'usage', 'processor_usage' or 'temperature'
     :param core: bool, mutithreaded systems are avaraged if True
     :param start_time: datetime, specific date to start showing data
     :param end_time: datetime, specific date to stop showing date
     :return:
     """
+    from matplotlib import pyplot as plt
+    from storage import open_storage
+    import query
 
+    measurment = MEASUREMENTS.get(measurment, measurment)
     if not start_time:
         start_time = 0
     if not end_time:
         end_time = datetime.now()
 
-    with Manager(DATABASE_ADRESS) as cursor:
-        client: Client = cursor.get_client(host)
-        processors: List[Processor] = cursor.session.query(Processor).filter(
-            start_time < Processor.time, Processor.time < end_time, client == Processor.client
-        ).all()
-
-    data = {}
-    if not core:
-        for processor in processors:
-            if processor.processor not in data:
-                data[processor.processor] = [
-                    [processor.time], [getattr(processor, measurment)], f"Processor {processor.processor}"]
-            else:
-                data[processor.processor][0].append(processor.time)
-                data[processor.processor][1].append(getattr(processor, measurment))
-    else:
-        for processor in processors:
-            if processor.core not in data:
-                data[processor.core] = [
-                    [processor.time], [getattr(processor, measurment)], f"Core {processor.core}"]
-            else:
-                if data[processor.core][0][-1] == processor.time:
-                    data[processor.core][1][-1] = (data[processor.core][1][-1] + getattr(processor, measurment)) / 2
-                else:
-                    data[processor.core][0].append(processor.time)
-                    data[processor.core][1].append(getattr(processor, measurment))
+    with open_storage(DATABASE_ADRESS) as storage:
+        times, keys, values = storage.read_series(host, measurment, core, start_time, end_time)
+
+    name = "Core" if core else "Processor"
+    data = {key: [query.to_local_datetime64(key_times), key_values, f"{name} {key}"]
+            for key, (key_times, key_values) in query.split(keys, times, values).items()}
 
     fig = plt.figure()
 
@@ -334,13 +603,25 @@ def handle():
 
     parses the given system arguments and proceeds with the program depending
     on what was given
-    OBS! --log can always be passed but --view and --schedule can not be passed at the same time
+    OBS! --log can always be passed but only one of --view, --schedule, --collect, --burst, --export,
+    --profile, --space, --stats, --top, --aggregate and --agent can be passed at the same time
 
     :return: None
     """
 
     parser = argparse.ArgumentParser(description="Logs and views a systems cpu temperature.")
     parser.add_argument("--log", action="store_true")
+    parser.add_argument("--database", type=str, help="Where readings are stored, a sqlalchemy url or "
+                                                     "log:///path/to/directory for the binary log. "
+                                                     "Defaults to db.db next to cpu_temp.py.")
+    parser.add_argument("--migrate", action="store_true", help="Convert the database to the current schema.")
+    parser.add_argument("--rebuild_rollups", action="store_true", help="Rebuild the rollups from the raw data.")
+    parser.add_argument("--retention", type=str, help="How long each tier is kept as 'tier=age,...', tiers are "
+                                                      "raw, minute, hour and day, ages like 30m, 12h, 7d, 2w, 1y or "
+                                                      "forever. Defaults to raw=7d,minute=90d,hour=1y,day=forever.")
+    parser.add_argument("--vacuum", action="store_true", help="Rewrite the database once so space freed by "
+                                                              "retention is given back to the file system.")
+    parser.add_argument("--space", action="store_true", help="Print the rows and space of each retention tier.")
 
     parser.add_argument("--schedule", action="store_true")
     parser.add_argument("--job_type", help="valid values 'cron', 'interval'", type=str)
@@ -353,6 +634,63 @@ def handle():
     parser.add_argument("--second", "--seconds", type=int)
     parser.add_argument("--misfire", type=int, help="If system is unavaileble to execute at desired run time "
                                                     "how long in seconds is it allow to execute past set time.")
+    parser.add_argument("--collect", action="store_true", help="Run as a long lived collector.")
+    parser.add_argument("--interval", type=float, help="Seconds between each collector sample, defaults to 1.")
+    parser.add_argument("--report", type=int, default=60, help="Print collector latency and jitter every n ticks "
+                                                                       "or aggregator throughput every n seconds.")
+    parser.add_argument("--flush_interval", type=float, help="Longest time in seconds the collector holds samples "
+                                                             "in memory before writing them, defaults to 30.")
+    parser.add_argument("--adaptive", action="store_true", help="Let --collect sample every --min_interval seconds "
+                                                                "while readings move more than --epsilon and back "
+                                                                "off to --interval while they are stable.")
+    parser.add_argument("--min_interval", type=float, help="Shortest seconds between samples of --adaptive, "
+                                                           "defaults to 0.25.")
+    parser.add_argument("--epsilon", type=str, help="Only store a processor row of --collect when a reading moves "
+                                                    "more than this from it, such as 'temperature=1,usage=5' in "
+                                                    "degrees C and percent. Also what --adaptive counts as moving.")
+    parser.add_argument("--top_k", type=int, help="Heaviest processes stored per processor and reading by --log, "
+                                                  "--schedule and --collect, 0 stores none, defaults to 5.")
+    parser.add_argument("--alert", type=str, action="append",
+                        help="Alert rule checked on every reading of --collect, --agent and --burst, such as "
+                             "'temperature>85', 'temperature>85,for=30s,clear=80', 'temperature_rate>2,window=10s' "
+                             "or 'usage>95,for=1m,core=3'. Can be given more than once.")
+    parser.add_argument("--alert_hook", type=str, action="append",
+                        help="Where alerts are sent: 'command:...', 'file:/path', 'socket:unix:/path' or "
+                             "'socket:host:port' for udp. Can be given more than once.")
+    parser.add_argument("--aggregate", action="store_true", help="Receive readings from agents and store them.")
+    parser.add_argument("--listen", type=str, help="Aggregator address, 'host:port' or 'unix:/path', "
+                                                   "defaults to 127.0.0.1:8765. The port has no "
+                                                   "authentication, only listen on trusted networks.")
+    parser.add_argument("--agent", action="store_true", help="Run a collector that sends to an aggregator.")
+    parser.add_argument("--aggregator", type=str, help="Address of the aggregator, 'host:port' or 'unix:/path'.")
+    parser.add_argument("--burst", action="store_true", help="Sample many times a second into a ring buffer.")
+    parser.add_argument("--hz", type=float, help="Samples per second in burst mode, defaults to 50.")
+    parser.add_argument("--ring", type=str, help="Ring buffer file, defaults to ring.buf next to cpu_temp.py.")
+    parser.add_argument("--ring_seconds", type=float, help="Seconds of samples the ring buffer holds, defaults to 60.")
+    parser.add_argument("--drain_interval", type=float, help="Seconds between moving the ring buffer into the "
+                                                             "database, defaults to 5.")
+    parser.add_argument("--drain_raw", action="store_true", help="Store every burst sample as a row instead of "
+                                                                 "only updating the rollups.")
+    parser.add_argument("--export", action="store_true", help="Write the data of --host between --start_time "
+                                                                "and --end_time to --output or stdout.")
+    parser.add_argument("--format", type=str, help="Export format: csv (default), jsonl or binary.")
+    parser.add_argument("--output", type=str, help="File to export to, defaults to stdout.")
+    parser.add_argument("--profile", action="store_true", help="Print the collectors own phase timings, cpu use "
+                                                                 "and memory for --host between --start_time "
+                                                                 "and --end_time.")
+    parser.add_argument("--stats", action="store_true", help="Print the mean, median, standard deviation, min, "
+                                                             "max, p95 and p99 of --measurement between "
+                                                             "--start_time and --end_time.")
+    parser.add_argument("--top", action="store_true", help="Print the processes that were most often the heaviest "
+                                                           "per core between --start_time and --end_time and the "
+                                                           "temperature while they were.")
+    parser.add_argument("--rank", type=str, help="Rank --top by count (default), how often a process was the "
+                                                 "heaviest, or usage, how much it used.")
+    parser.add_argument("--limit", type=int, default=5, help="Processes per core in --top, defaults to 5.")
+    parser.add_argument("--by", type=str, help="Group --stats by host (default), core or processor, "
+                                               "--top by core (default), processor or host.")
+    parser.add_argument("--source", type=str, help="What --stats reads: auto (default, raw rows and the rollups "
+                                                   "where they were deleted), raw, minute, hour or day.")
     parser.add_argument("--view", action="store_true")
     parser.add_argument("--host", type=str, help="The hostname of the client to draw data about.")
     parser.add_argument("--measurement", type=str, help="temperature or cpu_usage")
@@ -360,21 +698,79 @@ def handle():
     parser.add_argument("--start_time", type=str, help="Date to start draw data from.")
     parser.add_argument("--end_time", type=str, help="Date to end draw data from.")
     parser.add_argument("--core", action="store_true")
+    parser.add_argument("--live", action="store_true", help="Keep the --view open and add new samples as they are "
+                                                            "written, every --interval seconds.")
+    parser.add_argument("--window", type=float, help="Seconds the --live view shows, defaults to 600.")
 
     args = parser.parse_args()
-    if args.log or args.schedule or args.view:
+    global RETENTION, DATABASE_ADRESS
+    if args.database:
+        DATABASE_ADRESS = args.database
+    # storage.LOG_SCHEME, storage is not imported before a mode needs it
+    if DATABASE_ADRESS.startswith("log://"):
+        unsupported = [flag for flag in ["migrate", "rebuild_rollups", "vacuum", "collect", "burst", "export",
+                                         "profile", "space", "top", "aggregate", "agent", "live"] if getattr(args, flag)]
+        if unsupported:
+            raise exceptions.ArgumentError(f"The binary log only supports --log, --schedule, --view and --stats, "
+                                           f"not --{', --'.join(unsupported)}.")
+    if (args.adaptive or args.min_interval or args.epsilon) and not args.collect:
+        raise exceptions.ArgumentError("--adaptive, --min_interval and --epsilon only apply to --collect.")
+    if args.min_interval and not args.adaptive:
+        raise exceptions.ArgumentError("--min_interval needs --adaptive.")
+    if args.top_k is not None:
+        if args.top_k < 0:
+            raise exceptions.ArgumentError(f"--top_k can not be negative, got {args.top_k}")
+        SAMPLER.top_k = args.top_k
+    if args.retention:
+        import retention
+        RETENTION = retention.Retention(retention.parse_policy(args.retention))
+    if args.migrate:
+        from migrate import migrate
+        migrate(DATABASE_ADRESS)
+    if args.rebuild_rollups:
+        from manager import Manager
+        import rollup
+        with Manager(DATABASE_ADRESS) as manager:
+            rollup.rebuild(manager.engine)
+    if args.vacuum:
+        from manager import Manager
+        import retention
+        with Manager(DATABASE_ADRESS) as manager:
+            retention.enable_incremental_vacuum(manager.engine)
+    modes = [args.schedule, args.view, args.collect, args.burst, args.export, args.profile, args.space,
+             args.stats, args.top, args.aggregate, args.agent]
+    if args.log or any(modes):
+        if sum(modes) > 1:
+            raise exceptions.ArgumentError("Can only handle one of --view, --schedule, --collect, --burst, --export, "
+                                           "--profile, --space, --stats, --top, --aggregate and --agent at the same time.")
         if args.log:
-            store_temp(need_sleep=True)
+            store_temp()
         if args.schedule:
-            if args.view:
-                raise exceptions.ArgumentError("Can not handle both --view and --schedule at the same time.")
             schedule(args)
+        elif args.collect:
+            collect(args)
+        elif args.burst:
+            burst(args)
+        elif args.aggregate:
+            aggregate(args)
+        elif args.agent:
+            agent(args)
+        elif args.export:
+            export_rows(args)
+        elif args.profile:
+            profile(args)
+        elif args.space:
+            space()
+        elif args.stats:
+            summarize(args)
+        elif args.top:
+            top(args)
         elif args.view:
-            if args.schedule:
-                raise exceptions.ArgumentError("Can not handle both --view and --schedule at the same time.")
             view(args)
-    else:
-        raise exceptions.NothingToDo("Need to add '--log', '--view' or '--schedule' to args")
+    elif not args.migrate and not args.rebuild_rollups and not args.vacuum:
+        raise exceptions.NothingToDo("Need to add '--log', '--view', '--schedule', '--collect', '--burst', "
+                                     "'--export', '--profile', '--space', '--stats', '--top', '--aggregate', "
+                                     "'--agent', '--migrate', '--rebuild_rollups' or '--vacuum' to args")
 
 
 if __name__ == '__main__':
@@ -1,7 +1,52 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float
+from typing import Union
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, Index, UniqueConstraint, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
+# the timestamp helpers are kept in a module without dependencies so the binary log can use them
+from timestamps import to_timestamp, from_timestamp
+
+SCHEMA_VERSION = 8
+
+
+class Timestamp(TypeDecorator):
+    """
+    datetime stored as integer milliseconds since epoch
+    """
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else to_timestamp(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else from_timestamp(value)
+
+
+def get_schema_version(engine) -> Union[int, None]:
+    """
+    finds the schema version of a database
+
+    databases from before the schema was versioned store the heaviest process as a string in processors,
+    a database where a migration from that schema was interrupted still has processors_v1
+
+    :param engine: sqlalchemy engine
+    :return: int, None if the database is empty
+    """
+    inspector = inspect(engine)
+    names = inspector.get_table_names()
+    if "processors_v1" in names:
+        return 1
+    if "processors" in names and "heaviest_process" in [column["name"] for column in inspector.get_columns("processors")]:
+        return 1
+    if "schema_version" in names:
+        with engine.connect() as connection:
+            version = connection.execute(text("SELECT max(version) FROM schema_version")).scalar()
+        if version is not None:
+            return version
+    return None
+
 
 Base = declarative_base()
 initial = {i for i in globals().keys()}
@@ -26,8 +71,42 @@ class Client(Base):
         cls.metadata.create_all(engine)
 
 
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+
+    def __init__(self, version: int):
+        super(SchemaVersion, self).__init__()
+        self.version = version
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(version={self.version})"
+
+    @classmethod
+    def create(cls, engine):
+        cls.metadata.create_all(engine)
+
+
+class Process(Base):
+    __tablename__ = "processes"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    command = Column(String, unique=True, nullable=False)
+
+    def __init__(self, command: str):
+        super(Process, self).__init__()
+        self.command = command
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(command={self.command})"
+
+    @classmethod
+    def create(cls, engine):
+        cls.metadata.create_all(engine)
+
+
 class Processor(Base):
     __tablename__ = "processors"
+    __table_args__ = (Index("ix_processors_client_id_time", "client_id", "time"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     client_id = Column(Integer, ForeignKey("clients.id"))
     client = relationship("Client", back_populates=__tablename__)
@@ -35,22 +114,31 @@ class Processor(Base):
     core = Column(Integer)
     processor = Column(Integer)
     processor_usage = Column(Float)
-    heaviest_process = Column(String)
+    heaviest_process_id = Column(Integer, ForeignKey("processes.id"))
+    process = relationship("Process")
     heaviest_process_usage = Column(Float)
     temperature = Column(Integer)
-    time = Column(DateTime)
+    time = Column(Timestamp)
+    # the readings a row stands for and the time of the last of them, see changes.ChangeFilter,
+    # NULL when the row is a single reading
+    samples = Column(Integer)
+    until = Column(Timestamp)
 
-    def __init__(self, core: int, cpu: int, process: str, cpu_usage: float,
+    def __init__(self, core: int, cpu: int, process: Process, cpu_usage: float,
                  process_usage: float, temperature: int, time: datetime):
         super(Processor, self).__init__()
         self.core = core
         self.processor = cpu
         self.processor_usage = cpu_usage
-        self.heaviest_process = process
+        self.process = process
         self.heaviest_process_usage = process_usage
         self.temperature = temperature
         self.time = time
 
+    @property
+    def heaviest_process(self) -> str:
+        return self.process.command if self.process else None
+
     def __str__(self):
         return f"{self.core} reached temperature {self.temperature} @ {self.time}"
 
@@ -72,6 +160,154 @@ class Processor(Base):
         cls.metadata.create_all(engine)
 
 
+class Rollup(Base):
+    """
+    aggregate of the processor rows of one processor within one bucket of 'resolution' seconds
+    """
+    __tablename__ = "rollups"
+    __table_args__ = (UniqueConstraint("client_id", "resolution", "processor", "bucket",
+                                       name="uq_rollups_client_id_resolution_processor_bucket"),
+                      Index("ix_rollups_client_id_resolution_bucket", "client_id", "resolution", "bucket"))
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    resolution = Column(Integer, nullable=False)
+    bucket = Column(Timestamp, nullable=False)
+
+    core = Column(Integer)
+    processor = Column(Integer, nullable=False)
+    count = Column(Integer)
+    temperature_min = Column(Integer)
+    temperature_max = Column(Integer)
+    temperature_sum = Column(Integer)
+    temperature_squares = Column(Float)
+    processor_usage_min = Column(Float)
+    processor_usage_max = Column(Float)
+    processor_usage_sum = Column(Float)
+    processor_usage_squares = Column(Float)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(client_id={self.client_id}, resolution={self.resolution}, " \
+            f"processor={self.processor}, bucket={self.bucket.__repr__()}, count={self.count})"
+
+    @classmethod
+    def create(cls, engine):
+        cls.metadata.create_all(engine)
+
+
+class ProcessRollup(Base):
+    """
+    how often and how hard one process was the heaviest process of one processor within one hour
+
+    the counters behind --top, so it never has to group the raw rows of more than the partial hours of a window
+    """
+    __tablename__ = "process_rollups"
+    __table_args__ = (UniqueConstraint("client_id", "bucket", "processor", "process_id",
+                                       name="uq_process_rollups_client_id_bucket_processor_process_id"),
+                      Index("ix_process_rollups_client_id_bucket", "client_id", "bucket"))
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    bucket = Column(Timestamp, nullable=False)
+    processor = Column(Integer, nullable=False)
+    core = Column(Integer)
+    process_id = Column(Integer, ForeignKey("processes.id"), nullable=False)
+
+    count = Column(Integer)
+    usage_sum = Column(Float)
+    temperature_sum = Column(Float)
+    temperature_max = Column(Integer)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(client_id={self.client_id}, bucket={self.bucket.__repr__()}, " \
+            f"processor={self.processor}, process_id={self.process_id}, count={self.count})"
+
+    @classmethod
+    def create(cls, engine):
+        cls.metadata.create_all(engine)
+
+
+class ProcessSample(Base):
+    """
+    one of the heaviest processes of one processor in one reading, rank 0 is the heaviest
+
+    a process is identified by its pid and start time as pids are reused, its command is interned in processes
+    """
+    __tablename__ = "process_samples"
+    __table_args__ = (Index("ix_process_samples_client_id_time", "client_id", "time"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    time = Column(Timestamp, nullable=False)
+
+    processor = Column(Integer, nullable=False)
+    rank = Column(Integer, nullable=False)
+    pid = Column(Integer, nullable=False)
+    start_time = Column(Timestamp)
+    process_id = Column(Integer, ForeignKey("processes.id"), nullable=False)
+    usage = Column(Float)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(client_id={self.client_id}, time={self.time.__repr__()}, " \
+            f"processor={self.processor}, rank={self.rank}, pid={self.pid})"
+
+    @classmethod
+    def create(cls, engine):
+        cls.metadata.create_all(engine)
+
+
+class PackageTemperature(Base):
+    """
+    the temperature of one package in one reading, as mili degrees C
+
+    the package sensor such as 'Package id 0' of coretemp or Tctl of k10temp, see sensors.SensorRegistry
+    """
+    __tablename__ = "package_temperatures"
+    __table_args__ = (Index("ix_package_temperatures_client_id_time", "client_id", "time"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    time = Column(Timestamp, nullable=False)
+
+    package = Column(Integer, nullable=False)
+    temperature = Column(Integer)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(client_id={self.client_id}, time={self.time.__repr__()}, " \
+            f"package={self.package}, temperature={self.temperature})"
+
+    @classmethod
+    def create(cls, engine):
+        cls.metadata.create_all(engine)
+
+
+class Tick(Base):
+    """
+    how long each phase of one collection took and what the collector itself cost
+
+    phases that did not run in a tick, such as cpu_map when the map is cached, are NULL
+    """
+    __tablename__ = "ticks"
+    __table_args__ = (Index("ix_ticks_client_id_time", "client_id", "time"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    time = Column(Timestamp, nullable=False)
+
+    cpu_map_ms = Column(Float)
+    temperature_ms = Column(Float)
+    processes_ms = Column(Float)
+    write_ms = Column(Float)
+    total_ms = Column(Float)
+    jitter_ms = Column(Float)
+    cpu_ms = Column(Float)
+    wall_ms = Column(Float)
+    rss_kb = Column(Integer)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(client_id={self.client_id}, time={self.time.__repr__()}, " \
+            f"total_ms={self.total_ms})"
+
+    @classmethod
+    def create(cls, engine):
+        cls.metadata.create_all(engine)
+
+
 # add tables above
 tables = [table for name, table in list(globals().items())
           if not name.startswith("__") and name not in {"initial"}.union(initial)]
@@ -21,3 +21,7 @@ class NoScript(_Base):
 
 class BadFormatting(_Base):
     pass
+
+
+class OutdatedSchema(_Base):
+    pass
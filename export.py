@@ -0,0 +1,182 @@
+from typing import Iterator, List, BinaryIO, Dict, Tuple
+from sqlalchemy import select, func, Integer, type_coerce
+from datetime import datetime
+import itertools
+import struct
+import json
+import csv
+import io
+import numpy as np
+from db import Processor, Process, to_timestamp
+
+
+CHUNK_SIZE = 10000
+# a row stands for 'samples' readings from 'time' to 'until', see changes.ChangeFilter, single readings have
+# one sample and end where they start
+COLUMNS = ["time", "core", "processor", "processor_usage", "heaviest_process", "heaviest_process_usage", "temperature",
+           "samples", "until"]
+FORMATS = ["csv", "jsonl", "binary"]
+
+# binary format, little endian:
+# file:  MAGIC, then blocks until end of file
+# block: uint32 new process count, per new process (int32 id, uint16 length, utf-8 command),
+#        uint32 row count, then one array per column of BINARY_COLUMNS
+# NULL is nan in the float columns and the smallest value of the type in the integer columns
+MAGIC = b"CPUTEMP2"
+BINARY_COLUMNS: List[Tuple[str, str]] = [
+    ("time", "<i8"), ("core", "<i4"), ("processor", "<i4"), ("processor_usage", "<f4"),
+    ("heaviest_process_id", "<i4"), ("heaviest_process_usage", "<f4"), ("temperature", "<i4"),
+    ("samples", "<i4"), ("until", "<i8")]
+# files written before runs were exported, without samples and until
+MAGIC_1 = b"CPUTEMP1"
+
+
+def stream_rows(connection, client_id: int, start_time: datetime, end_time: datetime,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[List[tuple]]:
+    """
+    streams the processor rows of a client within a time range in chunks
+
+    the result is read with a server side cursor chunk_size rows at a time so memory use does not
+    depend on how much history there is. rows are ordered by time.
+    each row is (time: int ms, core, processor, processor_usage, heaviest_process_id,
+    heaviest_process_usage, temperature, samples, until: int ms)
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param start_time: datetime
+    :param end_time: datetime
+    :param chunk_size: int
+    :return: iterator of lists of rows
+    """
+    table = Processor.__table__
+    statement = select(
+        type_coerce(table.c.time, Integer), table.c.core, table.c.processor, table.c.processor_usage,
+        table.c.heaviest_process_id, table.c.heaviest_process_usage, table.c.temperature,
+        func.coalesce(table.c.samples, 1), type_coerce(func.coalesce(table.c.until, table.c.time), Integer)
+    ).where(
+        table.c.client_id == client_id, table.c.time > to_timestamp(start_time), table.c.time < to_timestamp(end_time)
+    ).order_by(table.c.time)
+    result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(statement)
+    for partition in result.partitions(chunk_size):
+        yield partition
+
+
+def get_processes(connection) -> Dict[int, str]:
+    """
+    reads the process lookup table, it holds one row per distinct command
+
+    :param connection: sqlalchemy connection
+    :return: dict[id: int] -> command: str
+    """
+    table = Process.__table__
+    return {id_: command for id_, command in connection.execute(select(table.c.id, table.c.command))}
+
+
+def write_csv(chunks: Iterator[List[tuple]], processes: Dict[int, str], file: BinaryIO) -> int:
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(COLUMNS)
+    count = 0
+    for chunk in chunks:
+        writer.writerows((time, core, cpu, cpu_usage, processes.get(process), process_usage, temperature,
+                          samples, until)
+                         for time, core, cpu, cpu_usage, process, process_usage, temperature, samples, until in chunk)
+        count += len(chunk)
+    text.detach()
+    return count
+
+
+def write_jsonl(chunks: Iterator[List[tuple]], processes: Dict[int, str], file: BinaryIO) -> int:
+    count = 0
+    for chunk in chunks:
+        file.write("".join(
+            json.dumps(dict(zip(COLUMNS, (time, core, cpu, cpu_usage, processes.get(process),
+                                          process_usage, temperature, samples, until)))) + "\n"
+            for time, core, cpu, cpu_usage, process, process_usage, temperature, samples, until in chunk).encode())
+        count += len(chunk)
+    return count
+
+
+def write_binary(chunks: Iterator[List[tuple]], processes: Dict[int, str], file: BinaryIO) -> int:
+    file.write(MAGIC)
+    written = set()
+    count = 0
+    for chunk in chunks:
+        try:
+            table = np.fromiter(itertools.chain.from_iterable(chunk), dtype=np.float64,
+                                count=len(chunk) * len(BINARY_COLUMNS))
+        except TypeError:
+            # NULL values, the slower conversion turns them into nan like query.iter_columns
+            table = np.array(chunk, dtype=np.float64)
+        table = table.reshape(-1, len(BINARY_COLUMNS))
+        ids = np.unique(table[:, 4][~np.isnan(table[:, 4])]).astype(np.int64).tolist()
+        new = [id_ for id_ in ids if id_ not in written and id_ in processes]
+        file.write(struct.pack("<I", len(new)))
+        for id_ in new:
+            command = processes[id_].encode()
+            file.write(struct.pack("<iH", id_, len(command)) + command)
+            written.add(id_)
+        file.write(struct.pack("<I", len(chunk)))
+        for column, (name, dtype) in enumerate(BINARY_COLUMNS):
+            values = table[:, column]
+            if np.dtype(dtype).kind == "i":
+                values = np.where(np.isnan(values), np.iinfo(dtype).min, values)
+            file.write(values.astype(dtype).tobytes())
+        count += len(chunk)
+    return count
+
+
+def read_binary(file: BinaryIO) -> Iterator[Tuple[Dict[str, np.ndarray], Dict[int, str]]]:
+    """
+    reads a file written in the binary export format one block at a time
+
+    :param file: binary file
+    files written before runs were exported are read as well, their blocks have no samples and until
+
+    :return: iterator of tuple(columns: dict[name: str] -> array, processes: dict[id: int] -> command: str),
+        processes holds every command seen so far
+    """
+    magic = file.read(len(MAGIC))
+    if magic not in (MAGIC, MAGIC_1):
+        raise ValueError("Not a cpu_temp binary export")
+    binary_columns = BINARY_COLUMNS if magic == MAGIC else BINARY_COLUMNS[:-2]
+    processes = {}
+    while True:
+        header = file.read(4)
+        if not header:
+            return
+        for _ in range(struct.unpack("<I", header)[0]):
+            id_, length = struct.unpack("<iH", file.read(6))
+            processes[id_] = file.read(length).decode()
+        rows = struct.unpack("<I", file.read(4))[0]
+        columns = {}
+        for name, dtype in binary_columns:
+            size = np.dtype(dtype).itemsize * rows
+            columns[name] = np.frombuffer(file.read(size), dtype=dtype)
+        yield columns, processes
+
+
+WRITERS = {"csv": write_csv, "jsonl": write_jsonl, "binary": write_binary}
+
+
+def export(connection, client_id: int, start_time: datetime, end_time: datetime,
+           formatting: str, file: BinaryIO, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    writes the processor rows of a client within a time range to a file
+
+    time is written as integer milliseconds since epoch and the process as its command.
+    rows that stand for a run of readings are written as stored, with the number of readings and the time of
+    the last one in samples and until
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param start_time: datetime
+    :param end_time: datetime
+    :param formatting: str, one of FORMATS
+    :param file: binary file
+    :param chunk_size: int, rows held in memory at a time
+    :return: int, the number of rows written
+    """
+    processes = get_processes(connection)
+    chunks = stream_rows(connection, client_id, start_time, end_time, chunk_size)
+    return WRITERS[formatting](chunks, processes, file)
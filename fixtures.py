@@ -0,0 +1,188 @@
+from typing import List
+from pathlib import Path
+from datetime import datetime, timedelta
+import random
+from sqlalchemy import create_engine
+from manager import Manager
+from db import to_timestamp
+import rollup
+
+
+LAYOUTS = ["coretemp", "coretemp+acpitz", "coretemp-per-socket", "k10temp"]
+COMMANDS = ["/usr/bin/python3 /srv/app.py", "/usr/lib/firefox/firefox", "/usr/sbin/sshd", "[kworker/0:1]",
+            "/usr/bin/postgres", "/usr/bin/dockerd", "/usr/lib/systemd/systemd-journald", "/usr/bin/node"]
+
+
+def write(path: Path, content: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), "w") as file:
+        file.write(content)
+
+
+def write_bytes(path: Path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), "wb") as file:
+        file.write(content)
+
+
+def make_proc(root: Path, cpus: int, threads: int, processes: int, sockets: int = 1, seed: int = 0):
+    """
+    writes a fake /proc with cpuinfo, stat, uptime and 'processes' processes
+
+    processors are numbered so processor n and n + cpus / threads share a core the way linux numbers them
+
+    :param root: Path, becomes the /proc directory
+    :param cpus: int, number of processors
+    :param threads: int, processors per core
+    :param processes: int, number of /proc/[pid] directories
+    :param sockets: int, number of physical packages
+    :param seed: int, seed for the generated counters
+    :return: None
+    """
+    generator = random.Random(seed)
+    cores = cpus // threads
+    cores_per_socket = max(1, cores // sockets)
+
+    blocks = []
+    for processor in range(cpus):
+        core = processor % cores
+        blocks.append(f"processor\t: {processor}\nvendor_id\t: GenuineIntel\n"
+                      f"physical id\t: {core // cores_per_socket}\nsiblings\t: {cpus // sockets}\n"
+                      f"core id\t\t: {core % cores_per_socket}\ncpu cores\t: {cores_per_socket}\n")
+    write(root.joinpath("cpuinfo"), "\n".join(blocks) + "\n")
+
+    lines = ["cpu  0 0 0 0 0 0 0 0 0 0"]
+    for processor in range(cpus):
+        user, system, idle = (generator.randrange(10 ** 6) for _ in range(3))
+        lines.append(f"cpu{processor} {user} 0 {system} {idle} 0 0 0 0 0 0")
+    write(root.joinpath("stat"), "\n".join(lines) + "\nintr 0\nctxt 0\nbtime 0\n")
+    write(root.joinpath("uptime"), "100000.00 90000.00\n")
+
+    for pid in range(1, processes + 1):
+        command = generator.choice(COMMANDS)
+        name = command.split("/")[-1].split(" ")[0].strip("[]")[:15]
+        fields = ["S"] + ["0"] * 49
+        fields[11] = str(generator.randrange(10 ** 5))
+        fields[12] = str(generator.randrange(10 ** 5))
+        fields[19] = str(generator.randrange(10 ** 6))
+        fields[36] = str(generator.randrange(cpus))
+        write(root.joinpath(str(pid), "stat"), f"{pid} ({name}) {' '.join(fields)}\n")
+        cmdline = b"" if command.startswith("[") else command.replace(" ", "\0").encode() + b"\0"
+        write_bytes(root.joinpath(str(pid), "cmdline"), cmdline)
+
+
+def make_topology(root: Path, cpus: int, threads: int, sockets: int = 1):
+    """
+    writes a fake /sys/devices/system/cpu with the topology of every processor, numbered the same way as make_proc
+
+    :param root: Path, becomes the /sys/devices/system/cpu directory
+    :param cpus: int, number of processors
+    :param threads: int, processors per core
+    :param sockets: int, number of physical packages
+    :return: None
+    """
+    cores = cpus // threads
+    cores_per_socket = max(1, cores // sockets)
+    for processor in range(cpus):
+        core = processor % cores
+        topology = root.joinpath(f"cpu{processor}", "topology")
+        write(topology.joinpath("physical_package_id"), f"{core // cores_per_socket}\n")
+        write(topology.joinpath("die_id"), "0\n")
+        write(topology.joinpath("core_id"), f"{core % cores_per_socket}\n")
+    write(root.joinpath("online"), f"0-{cpus - 1}\n")
+
+
+def make_hwmon(root: Path, cpus: int, threads: int, layout: str = "coretemp", sockets: int = 1):
+    """
+    writes a fake /sys/class/hwmon
+
+    'coretemp' is one coretemp device per socket with a package and one input per core like intel machines,
+    'coretemp+acpitz' adds an unrelated device before them, 'coretemp-per-socket' is the same as 'coretemp'
+    and kept so earlier benchmark results can still be compared and
+    'k10temp' has one k10temp device per socket without core inputs like amd machines
+
+    :param root: Path, becomes the /sys/class/hwmon directory
+    :param cpus: int, number of processors
+    :param threads: int, processors per core
+    :param layout: str, one of LAYOUTS
+    :param sockets: int, number of physical packages
+    :return: None
+    """
+    cores = cpus // threads
+    devices = []
+    if layout == "coretemp+acpitz":
+        devices.append(("acpitz", [("", 45000)]))
+    if layout == "k10temp":
+        for socket in range(sockets):
+            devices.append(("k10temp", [("Tctl", 52000 + socket * 1000), ("Tdie", 50000 + socket * 1000)]))
+    else:
+        # core ids count within a socket the same way make_topology numbers them
+        cores_per_socket = max(1, cores // sockets)
+        for socket in range(sockets):
+            devices.append(("coretemp", [(f"Package id {socket}", 50000)] +
+                            [(f"Core {core}", 40000 + core * 100) for core in range(cores_per_socket)]))
+
+    for number, (name, inputs) in enumerate(devices):
+        device = root.joinpath(f"hwmon{number}")
+        write(device.joinpath("name"), f"{name}\n")
+        for index, (label, temperature) in enumerate(inputs, start=1):
+            if label:
+                write(device.joinpath(f"temp{index}_label"), f"{label}\n")
+            write(device.joinpath(f"temp{index}_input"), f"{temperature}\n")
+
+
+def make_tree(root: Path, cpus: int = 8, threads: int = 2, processes: int = 500,
+              layout: str = "coretemp", sockets: int = 1, seed: int = 0):
+    """
+    writes a fake /proc at root/proc, a fake /sys/class/hwmon at root/sys/class/hwmon
+    and a fake /sys/devices/system/cpu at root/sys/devices/system/cpu
+
+    :return: None
+    """
+    make_proc(root.joinpath("proc"), cpus, threads, processes, sockets, seed)
+    make_topology(root.joinpath("sys", "devices", "system", "cpu"), cpus, threads, sockets)
+    make_hwmon(root.joinpath("sys", "class", "hwmon"), cpus, threads, layout, sockets)
+
+
+def seed_database(engine_adress: str, rows: int, cpus: int = 8, threads: int = 2, host: str = "benchmark",
+                  interval: float = 1.0, end_time: datetime = None, chunk_size: int = 100000,
+                  seed: int = 0) -> datetime:
+    """
+    fills a database with 'rows' processor rows of one host sampled every 'interval' seconds up to end_time
+
+    rows are inserted with the DBAPI in chunks and the rollups are rebuilt at the end
+
+    :return: datetime, the time of the first sample
+    """
+    generator = random.Random(seed)
+    cores = cpus // threads
+    end_time = end_time if end_time else datetime.now()
+    samples = rows // cpus
+    start_time = end_time - timedelta(seconds=samples * interval)
+    start = to_timestamp(start_time)
+    step = int(interval * 1000)
+
+    with Manager(engine_adress) as manager:
+        client = manager.get_client(host)
+        ids: List[int] = [manager.get_process_id(command) for command in COMMANDS]
+        manager.session.add(client)
+        manager.session.commit()
+        client_id = client.id
+
+    engine = create_engine(engine_adress)
+    insert = ("INSERT INTO processors (client_id, core, processor, processor_usage, heaviest_process_id, "
+              "heaviest_process_usage, temperature, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    per_chunk = max(1, chunk_size // cpus)
+    with engine.connect() as connection:
+        for first in range(0, samples, per_chunk):
+            chunk = []
+            for sample in range(first, min(samples, first + per_chunk)):
+                time = start + sample * step
+                for processor in range(cpus):
+                    usage = generator.random() * 100
+                    chunk.append((client_id, processor % cores, processor, round(usage, 1), generator.choice(ids),
+                                  round(usage / 2, 1), 40000 + int(usage * 300), time))
+            with connection.begin():
+                connection.exec_driver_sql(insert, chunk)
+    rollup.rebuild(engine)
+    return start_time
@@ -0,0 +1,117 @@
+from typing import Dict, Optional
+from time import monotonic, process_time
+from datetime import datetime
+from pathlib import Path
+import resource
+import os
+
+
+PHASES = ["cpu_map", "temperature", "processes", "write"]
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+STATM = Path("/proc/self/statm")
+
+
+def read_rss() -> int:
+    """
+    reads the current resident memory of this process
+
+    falls back to the peak resident memory where /proc/self/statm is missing
+
+    :return: int, kilobytes
+    """
+    try:
+        with open(str(STATM), "rb") as file:
+            return int(file.read().split()[1]) * PAGE_KB
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class TickProfiler:
+    """
+    turns the phase timings of a tick into a row of the ticks table
+
+    cpu_ms and wall_ms are the cpu time the process used and the time that passed since the previous tick,
+    their ratio is the share of one processor the collector costs. a one shot reading has no previous tick,
+    its cpu_ms is all cpu time since python started and wall_ms is NULL.
+    """
+
+    def __init__(self, one_shot: bool = False):
+        self.last_cpu = 0.0 if one_shot else process_time()
+        self.last_wall = None if one_shot else monotonic()
+
+    def measure(self, time: datetime, timings: Dict[str, Optional[float]], jitter: Optional[float] = None) -> dict:
+        """
+        :param time: datetime, time of the reading
+        :param timings: dict[phase: str] -> seconds, None for phases that did not run
+        :param jitter: float, seconds the tick started after its scheduled time
+        :return: dict, a ticks row without client_id
+        """
+        cpu, wall = process_time(), monotonic()
+        row = {f"{phase}_ms": timings[phase] * 1000 if timings.get(phase) is not None else None for phase in PHASES}
+        row.update({
+            "time": time,
+            "total_ms": sum(timings[phase] for phase in PHASES if timings.get(phase) is not None) * 1000,
+            "jitter_ms": jitter * 1000 if jitter is not None else None,
+            "cpu_ms": (cpu - self.last_cpu) * 1000,
+            "wall_ms": (wall - self.last_wall) * 1000 if self.last_wall is not None else None,
+            "rss_kb": read_rss()})
+        self.last_cpu, self.last_wall = cpu, wall
+        return row
+
+
+def report(connection, client_id: int, start_time: datetime, end_time: datetime):
+    """
+    prints what the collector cost between start_time and end_time
+
+    per phase mean, 95th percentile and max latency for the whole range and the mean per day,
+    so the day a phase got slower stands out, as well as the collectors cpu share and memory use
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param start_time: datetime
+    :param end_time: datetime
+    :return: None
+    """
+    # numpy and sqlalchemy are only needed for the report, TickProfiler runs on every --log
+    from sqlalchemy import select, Integer, type_coerce
+    from db import Tick, to_timestamp
+    import numpy as np
+    import query
+
+    table = Tick.__table__
+    columns = ["time"] + [f"{phase}_ms" for phase in PHASES] + ["total_ms", "jitter_ms", "cpu_ms", "wall_ms", "rss_kb"]
+    statement = select(type_coerce(table.c.time, Integer), *[table.c[column] for column in columns[1:]]).where(
+        table.c.client_id == client_id, table.c.time > to_timestamp(start_time), table.c.time < to_timestamp(end_time)
+    ).order_by(table.c.time)
+    data = dict(zip(columns, query.fetch_columns(connection, statement)))
+    if not len(data["time"]):
+        print("No ticks recorded in the given time range.")
+        return
+
+    print(f"{len(data['time'])} ticks from {datetime.fromtimestamp(data['time'][0] / 1000)} "
+          f"to {datetime.fromtimestamp(data['time'][-1] / 1000)}\n")
+    print(f"{'phase':<12} {'mean ms':>10} {'p95 ms':>10} {'max ms':>10}")
+    for column in columns[1:7]:
+        values = data[column][~np.isnan(data[column])]
+        if len(values):
+            print(f"{column[:-3]:<12} {values.mean():10.3f} {np.percentile(values, 95):10.3f} {values.max():10.3f}")
+
+    timed = ~np.isnan(data["wall_ms"])
+    if timed.any():
+        share = data["cpu_ms"][timed].sum() / data["wall_ms"][timed].sum() * 100
+        print(f"\ncollector cpu use {share:.4f} % of one processor")
+    print(f"collector memory mean {data['rss_kb'].mean():,.0f} kB max {data['rss_kb'].max():,.0f} kB")
+
+    days = (data["time"] // 86400000).astype(np.int64)
+    print(f"\n{'day':<12}" + "".join(f"{phase:>12}" for phase in PHASES) + f"{'cpu %':>10}")
+    for day in np.unique(days):
+        selected = days == day
+        line = f"{datetime.fromtimestamp(day * 86400).date()!s:<12}"
+        for phase in PHASES:
+            values = data[f"{phase}_ms"][selected]
+            values = values[~np.isnan(values)]
+            line += f"{values.mean():12.3f}" if len(values) else f"{'-':>12}"
+        day_timed = selected & timed
+        if day_timed.any():
+            line += f"{data['cpu_ms'][day_timed].sum() / data['wall_ms'][day_timed].sum() * 100:10.4f}"
+        print(line)
@@ -0,0 +1,199 @@
+from typing import Dict, Set
+from datetime import datetime
+import numpy as np
+from matplotlib import pyplot as plt
+from manager import Manager
+from db import Client, to_timestamp
+import query
+
+
+class Series:
+    """
+    the samples of one line within the window
+
+    samples are appended to preallocated arrays and the ones that scrolled out of the window
+    are dropped from the front. when the end of the arrays is reached what is left is moved to the front,
+    the arrays only grow until they hold one window so memory use does not creep up over hours.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.times = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def extend(self, times: np.ndarray, values: np.ndarray):
+        """
+        :param times: int64 array of milliseconds, ordered and newer than what the series holds
+        :param values: float64 array
+        :return: None
+        """
+        if self.end + len(times) > len(self.times):
+            kept = len(self)
+            capacity = len(self.times)
+            while kept + len(times) > capacity // 2:
+                capacity *= 2
+            old_times, old_values = self.times[self.start:self.end], self.values[self.start:self.end]
+            if capacity != len(self.times):
+                self.times = np.empty(capacity, dtype=np.int64)
+                self.values = np.empty(capacity, dtype=np.float64)
+            # copied as the old samples may overlap where they go
+            self.times[:kept] = old_times.copy()
+            self.values[:kept] = old_values.copy()
+            self.start, self.end = 0, kept
+        self.times[self.end:self.end + len(times)] = times
+        self.values[self.end:self.end + len(times)] = values
+        self.end += len(times)
+
+    def trim(self, cutoff: int):
+        """
+        drops the samples older than cutoff
+
+        :param cutoff: int, milliseconds since epoch
+        :return: None
+        """
+        self.start += int(np.searchsorted(self.times[self.start:self.end], cutoff))
+
+    def data(self, now: int):
+        """
+        :param now: int, milliseconds since epoch
+        :return: tuple(seconds before now: float64 array, values: float64 array)
+        """
+        return (self.times[self.start:self.end] - now) / 1000, self.values[self.start:self.end]
+
+
+class LiveView:
+    """
+    keeps a plot of the last 'window' seconds open and adds new samples as they are written
+
+    every 'interval' seconds only the rows newer than the newest sample already shown are read,
+    through the (client_id, time) index. the x axis is seconds before now so it stays still while the lines
+    scroll, which lets the lines be redrawn on top of a saved background (blitting) instead of redrawing
+    the whole figure. the figure is only redrawn in full when a value falls outside the y axis,
+    a new processor shows up or the window is resized.
+    """
+
+    def __init__(self, engine_adress: str, host: str, measurement: str, core: bool = False,
+                 window: float = 600.0, interval: float = 1.0):
+        """
+        :param engine_adress: str, database to read
+        :param host: str, the hostname to plot
+        :param measurement: str, 'temperature' or 'processor_usage'
+        :param core: bool, mean per core instead of one line per processor
+        :param window: float, seconds shown
+        :param interval: float, seconds between reading new samples
+        """
+        self.engine_adress = engine_adress
+        self.host = host
+        self.measurement = measurement
+        self.core = core
+        self.window = window
+        self.interval = interval
+        self.series: Dict[int, Series] = {}
+        self.lines = {}
+        self.background = None
+        # lowest and highest value shown so far, the y axis only ever grows so it does not jump around
+        self.low, self.high = np.inf, -np.inf
+        self.last = to_timestamp(datetime.now()) - int(window * 1000)
+
+    def poll(self) -> Set[int]:
+        """
+        reads the samples written since the last poll into the series
+
+        :return: set of the keys that got their first samples
+        """
+        with self.engine.connect() as connection:
+            times, processors, cores, values = query.query_after(
+                connection, self.client_id, self.measurement, self.last)
+        if not len(times):
+            return set()
+        self.last = int(times.max())
+        if self.core:
+            keys, times, values = query.step_mean(cores, processors, times, values)
+        else:
+            keys = processors
+        new = set()
+        for key, (key_times, key_values) in query.split(keys, times, values).items():
+            if key not in self.series:
+                self.series[key] = Series()
+                new.add(key)
+            series = self.series[key]
+            if len(series):
+                # runs are written when they end, so a core can get points from before the ones it shows
+                newer = key_times > series.times[series.end - 1]
+                key_times, key_values = key_times[newer], key_values[newer]
+                if not len(key_times):
+                    continue
+            series.extend(key_times, key_values)
+            self.low = min(self.low, float(np.nanmin(key_values)))
+            self.high = max(self.high, float(np.nanmax(key_values)))
+        return new
+
+    def update(self):
+        new = self.poll()
+        now = to_timestamp(datetime.now())
+        for series in self.series.values():
+            series.trim(now - int(self.window * 1000))
+        for key in sorted(new):
+            self.lines[key], = self.axes.plot([], [], label=f"{'Core' if self.core else 'Processor'} {key}",
+                                              animated=True)
+        bottom, top = self.axes.get_ylim()
+        if new or self.low < bottom or self.high > top:
+            if new:
+                self.axes.legend(loc="upper left", fontsize="small", ncol=max(1, len(self.lines) // 16))
+            margin = max((self.high - self.low) * 0.05, 1.0)
+            if len(new) < len(self.lines):
+                # keep what the axis already shows
+                self.axes.set_ylim(min(bottom, self.low - margin), max(top, self.high + margin))
+            else:
+                self.axes.set_ylim(self.low - margin, self.high + margin)
+            # on_draw saves the new background and draws the lines on it
+            self.figure.canvas.draw_idle()
+            return
+        self.blit(now)
+
+    def draw_lines(self, now: int):
+        for key, line in self.lines.items():
+            line.set_data(*self.series[key].data(now))
+            self.axes.draw_artist(line)
+
+    def blit(self, now: int):
+        if self.background is None:
+            return
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        self.draw_lines(now)
+        canvas.blit(self.axes.bbox)
+        canvas.flush_events()
+
+    def on_draw(self, event):
+        self.background = self.figure.canvas.copy_from_bbox(self.axes.bbox)
+        self.draw_lines(to_timestamp(datetime.now()))
+
+    def run(self):
+        """
+        opens the plot and keeps it updated until the window is closed
+
+        :return: None
+        """
+        with Manager(self.engine_adress) as manager:
+            client: Client = manager.get_client(self.host)
+            self.client_id = client.id
+            self.engine = manager.engine
+
+            self.figure = plt.figure()
+            self.axes = self.figure.add_subplot(
+                111, ylabel=self.measurement, xlabel="Seconds ago",
+                title=f"{self.measurement.capitalize()} of {self.host}, last {self.window:g} seconds.")
+            self.axes.set_xlim(-self.window, 0)
+            self.figure.canvas.mpl_connect("draw_event", self.on_draw)
+            self.update()
+
+            timer = self.figure.canvas.new_timer(interval=int(self.interval * 1000))
+            timer.add_callback(self.update)
+            timer.start()
+            plt.show()
+            timer.stop()
@@ -1,25 +1,104 @@
-from sqlalchemy import create_engine
+from typing import List, Dict, Optional
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy.orm.exc as exceptions
 from datetime import datetime
-from db import Client, Processor, tables
+from time import monotonic
+from db import Client, Process, Processor, ProcessSample, PackageTemperature, SchemaVersion, Tick, tables, \
+    get_schema_version, SCHEMA_VERSION
+from exceptions import OutdatedSchema
+from retention import Retention
+from changes import ChangeFilter
+import rollup
+
+
+def tune_sqlite(dbapi_connection, connection_record):
+    """
+    sets up a sqlite connection for append heavy workloads
+
+    WAL lets readers such as --view run while the collector writes and with synchronous=NORMAL
+    a commit does not wait for fsync. a commit can be lost on power loss but not on a crash of the application.
+    auto_vacuum only takes effect when it is set before the first table is created,
+    so new databases can give the space of expired rows back, see retention.py.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
 
 
 class Manager:
-    def __init__(self, engine_adress: str):
+    """
+    owns the database connection
+
+    rows added with buffer_cpu are held in memory and written in one bulk insert when flush_size rows
+    are buffered, when flush_interval seconds passed since the last flush or when the manager exits
+    without an error, whichever comes first. the buffered rows are rolled back when it exits with an error.
+    if the process is killed without exiting the manager, at most the rows of the last flush_interval seconds
+    (and never more than flush_size rows) are lost. with a changes.ChangeFilter the runs that are still open
+    are held outside the buffer as well, so the processor rows of up to flush_interval + changes.MAX_RUN
+    seconds can be lost while the rollups still only lose the last flush_interval seconds.
+
+    with a retention.Retention every flush is followed by deleting expired rows, see Retention.expire.
+    with a changes.ChangeFilter a processor row is only written when a run of readings that stayed within
+    epsilon ends, the rollups and heaviest process counters are still updated with every reading.
+    """
+
+    def __init__(self, engine_adress: str, flush_size: int = 1024, flush_interval: float = 30.0,
+                 retention: Optional[Retention] = None, changes: Optional[ChangeFilter] = None):
         self.engine = create_engine(engine_adress)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", tune_sqlite)
+        version = get_schema_version(self.engine)
+        if version is not None and version < SCHEMA_VERSION:
+            raise OutdatedSchema(f"Database schema is version {version} but {SCHEMA_VERSION} is needed, "
+                                 f"run with --migrate to convert it.")
         for table in tables:
             table.create(self.engine)
+        if version is None:
+            with self.engine.begin() as connection:
+                connection.execute(SchemaVersion.__table__.insert(), {"version": SCHEMA_VERSION})
+        self.processes: Dict[str, int] = {}
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer: List[dict] = []
+        # every reading since the last flush, the same rows as buffer without a change filter
+        self.readings: List[dict] = []
+        self.changes = changes
+        self.samples: List[dict] = []
+        self.packages: List[dict] = []
+        self.ticks: List[dict] = []
+        self.retention = retention
+        self.last_flush = monotonic()
 
     def __enter__(self):
-        session = sessionmaker()
+        # keep loaded objects such as clients usable after a flush without reloading them
+        session = sessionmaker(expire_on_commit=False)
         session.configure(bind=self.engine)
         self.session = session()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # a stop by SIGTERM (SystemExit) or ctrl+c leaves complete readings behind that are still written,
+        # after any other error the buffered rows and the open transaction may be half done and are rolled back
+        if exc_type is None or issubclass(exc_type, (SystemExit, KeyboardInterrupt)):
+            if self.changes:
+                self.buffer.extend(self.changes.close())
+            self.flush()
+        else:
+            self.discard()
         self.session.close()
 
+    def discard(self):
+        """
+        drops every buffered row and rolls back what the session has not committed, used after a failed flush
+
+        :return: None
+        """
+        self.session.rollback()
+        self.buffer, self.readings, self.samples, self.packages, self.ticks = [], [], [], [], []
+
     def get_client(self, client_identifier: str) -> Client:
         try:
             client: Client = self.session.query(Client).filter_by(identifier=client_identifier).one()
@@ -32,41 +111,137 @@ class Manager:
         if commit:
             self.session.commit()
 
+    def get_process_id(self, command: str) -> int:
+        """
+        finds the id of a command in the processes table, adding it if it is new
+
+        ids are cached so a known command never touches the database again
+
+        :param command: str
+        :return: int
+        """
+        if command not in self.processes:
+            process = self.session.query(Process).filter_by(command=command).one_or_none()
+            if process is None:
+                process = Process(command)
+                self.session.add(process)
+                self.session.flush()
+            self.processes[command] = process.id
+        return self.processes[command]
+
     def add_cpu(self, client: Client, core: int, cpu: int, cpu_usage: float, process: str,
                 process_usage: float, temperature: int, time: datetime, commit=True):
         client.processors.append(Processor(
-            core=core, cpu=cpu, cpu_usage=cpu_usage, process=process,
+            core=core, cpu=cpu, cpu_usage=cpu_usage, process=self.session.get(Process, self.get_process_id(process)),
             process_usage=process_usage, temperature=temperature, time=time))
         self.session.add(client)
+        self.session.flush()
+        row = {"client_id": client.id, "core": core, "processor": cpu, "processor_usage": cpu_usage,
+               "heaviest_process_id": self.get_process_id(process), "heaviest_process_usage": process_usage,
+               "temperature": temperature, "time": time}
+        rollup.upsert(self.session, rollup.aggregate([row]), self.engine.dialect.name)
+        rollup.upsert_processes(self.session, rollup.aggregate_processes([row]), self.engine.dialect.name)
         if commit:
             self.session.commit()
 
+    def buffer_cpu(self, client: Client, core: int, cpu: int, cpu_usage: float, process: str,
+                   process_usage: float, temperature: int, time: datetime):
+        """
+        buffers a processor row to be written on the next flush
+
+        same arguments as add_cpu, flushes if the buffer is full or the flush interval passed.
+        with a change filter the row is only buffered once its run ends, see changes.ChangeFilter
+
+        :return: None
+        """
+        if client.id is None:
+            self.session.add(client)
+            self.session.commit()
+        row = {"client_id": client.id, "core": core, "processor": cpu, "processor_usage": cpu_usage,
+               "heaviest_process_id": self.get_process_id(process), "heaviest_process_usage": process_usage,
+               "temperature": temperature, "time": time}
+        self.readings.append(row)
+        if self.changes is None:
+            self.buffer.append(row)
+        else:
+            run = self.changes.add(row)
+            if run is not None:
+                self.buffer.append(run)
+        if len(self.readings) >= self.flush_size or monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def buffer_top(self, client: Client, time: datetime, top: Dict[int, List[tuple]]):
+        """
+        buffers the heaviest processes of every processor in one reading to be written on the next flush
+
+        the commands are interned through get_process_id like the heaviest process of a processor row
+
+        :param client: Client
+        :param time: datetime, time of the reading
+        :param top: dict[processor: int] -> list of tuple(pid, start_time, command, usage), heaviest first
+        :return: None
+        """
+        if client.id is None:
+            self.session.add(client)
+            self.session.commit()
+        for processor, processes in top.items():
+            for rank, (pid, start_time, command, usage) in enumerate(processes):
+                self.samples.append({
+                    "client_id": client.id, "time": time, "processor": processor, "rank": rank, "pid": pid,
+                    "start_time": start_time, "process_id": self.get_process_id(command), "usage": usage})
+
+    def buffer_packages(self, client: Client, time: datetime, packages: Dict[int, int]):
+        """
+        buffers the package temperatures of one reading to be written on the next flush
+
+        :param client: Client
+        :param time: datetime, time of the reading
+        :param packages: dict[package: int] -> temperature: int, see cpu_temp.get_package_temp
+        :return: None
+        """
+        if client.id is None:
+            self.session.add(client)
+            self.session.commit()
+        for package, temperature in packages.items():
+            self.packages.append({"client_id": client.id, "time": time, "package": package,
+                                  "temperature": temperature})
+
+    def buffer_tick(self, client: Client, tick: dict):
+        """
+        buffers a ticks row from instrument.TickProfiler to be written on the next flush
+
+        :return: None
+        """
+        if client.id is None:
+            self.session.add(client)
+            self.session.commit()
+        self.ticks.append(dict(tick, client_id=client.id))
+
+    def flush(self):
+        """
+        writes all buffered rows in one transaction
 
-if __name__ == '__main__':
-    import statistics
-    from socket import gethostname
-
-    with Manager() as cursor:
-        cursor.add_client(gethostname())
-        # cursor.add_cpu(gethostname(), )
-        # c: Client = cursor.session.query(Client).filter_by().first()
-        # processors = cursor.session.query(Processor).filter(
-        #     datetime(2019, 7, 22) <= Processor.time
-        # ).filter(
-        #     Processor.time < datetime(2019, 7, 23)
-        # ).all()
-    # print(len(processors))
-    #     c: Client = cursor.session.query(Client).first()
-        # temperatures = [temp.temperature for temp in c.processors]
-        # print(c.processors)
-
-    # d = {temp.core: [value for value in c.processors] for temp in c.processors}
-    # print(d)
-    # print(f"Systems mean CPU temperature                         {statistics.mean(temperatures) / 1000} C")
-    # print(f"Systems median CPU temperature                       {statistics.median(temperatures) / 1000} C")
-    # print(f"Systems standard deviation from mean CPU temperature {statistics.stdev(temperatures) / 1000} C")
-    # print(f"Systems Max temperature                              {max(temperatures) / 1000} C")
-    # print(f"Systems Min temperature                              {min(temperatures) / 1000} C")
-    # for core, processors in d.items():
-    #     print(f"System {core} avarage temperature is {statistics.mean(processors)}")
+        the rollups and heaviest process counters of the buffered readings are updated in the same transaction
 
+        :return: None
+        """
+        if self.buffer:
+            self.session.execute(Processor.__table__.insert(), self.buffer)
+            self.buffer = []
+        if self.readings:
+            rollup.upsert(self.session, rollup.aggregate(self.readings), self.engine.dialect.name)
+            rollup.upsert_processes(self.session, rollup.aggregate_processes(self.readings), self.engine.dialect.name)
+            self.readings = []
+        if self.samples:
+            self.session.execute(ProcessSample.__table__.insert(), self.samples)
+            self.samples = []
+        if self.packages:
+            self.session.execute(PackageTemperature.__table__.insert(), self.packages)
+            self.packages = []
+        if self.ticks:
+            self.session.execute(Tick.__table__.insert(), self.ticks)
+            self.ticks = []
+        self.session.commit()
+        self.last_flush = monotonic()
+        if self.retention:
+            self.retention.expire(self.session)
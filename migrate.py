@@ -0,0 +1,196 @@
+from typing import Dict, Callable
+from sqlalchemy import create_engine, event, inspect, select, func, text
+from datetime import datetime
+from manager import tune_sqlite
+import rollup
+from db import Base, Process, Processor, SchemaVersion, get_schema_version, to_timestamp, SCHEMA_VERSION
+
+
+def set_version(connection, version: int):
+    connection.execute(SchemaVersion.__table__.delete())
+    connection.execute(SchemaVersion.__table__.insert(), {"version": version})
+
+
+def migrate_1(engine, chunk_size: int):
+    """
+    migrates from the unversioned schema to version 2
+
+    processors is renamed to processors_v1 and copied into the new processors table
+    chunk_size rows at a time, each chunk in its own transaction. process commands are moved
+    to the processes table and timestamps become integer milliseconds.
+    the copy continues where it left of if it is interrupted and run again.
+
+    :param engine: sqlalchemy engine
+    :param chunk_size: int, rows copied per transaction
+    :return: None
+    """
+    with engine.begin() as connection:
+        if "processors_v1" not in inspect(connection).get_table_names():
+            connection.execute(text("ALTER TABLE processors RENAME TO processors_v1"))
+        Base.metadata.create_all(connection)
+
+    with engine.connect() as connection:
+        last = connection.execute(select(func.max(Processor.id))).scalar() or 0
+        processes: Dict[str, int] = {command: id_ for id_, command in connection.execute(
+            select(Process.id, Process.command))}
+
+    old = text("SELECT id, client_id, core, processor, processor_usage, heaviest_process, "
+               "heaviest_process_usage, temperature, time FROM processors_v1 "
+               "WHERE id > :last ORDER BY id LIMIT :limit")
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(old, {"last": last, "limit": chunk_size}).fetchall()
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                command = row.heaviest_process if row.heaviest_process is not None else ""
+                if command not in processes:
+                    result = connection.execute(Process.__table__.insert(), {"command": command})
+                    processes[command] = result.inserted_primary_key[0]
+                time = datetime.fromisoformat(row.time) if row.time is not None else None
+                chunk.append({
+                    "id": row.id, "client_id": row.client_id, "core": row.core, "processor": row.processor,
+                    "processor_usage": row.processor_usage, "heaviest_process_id": processes[command],
+                    "heaviest_process_usage": row.heaviest_process_usage, "temperature": row.temperature,
+                    "time": to_timestamp(time) if time else None})
+            connection.execute(Processor.__table__.insert(), chunk)
+            last = rows[-1].id
+        print(f"migrated processors up to id {last}", flush=True)
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE processors_v1"))
+        set_version(connection, 2)
+
+
+def migrate_2(engine, chunk_size: int):
+    """
+    migrates from version 2 to version 3 by adding the rollups of all existing rows
+
+    :param engine: sqlalchemy engine
+    :param chunk_size: int, unused, the rollups are aggregated inside the database
+    :return: bool, True as the rollups have to be rebuilt
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        set_version(connection, 3)
+    return True
+
+
+def migrate_3(engine, chunk_size: int):
+    """
+    migrates from version 3 to version 4 by adding the sums of squares to the rollups
+
+    the sums are filled in by rebuilding the rollups that still have raw rows,
+    older rollups keep NULL and --stats leaves out the standard deviation where they are used
+
+    :param engine: sqlalchemy engine
+    :param chunk_size: int, unused, the rollups are aggregated inside the database
+    :return: bool, True as the rollups have to be rebuilt
+    """
+    with engine.begin() as connection:
+        columns = [column["name"] for column in inspect(connection).get_columns("rollups")]
+        for measurement in rollup.MEASUREMENTS:
+            if f"{measurement}_squares" not in columns:
+                connection.execute(text(f"ALTER TABLE rollups ADD COLUMN {measurement}_squares FLOAT"))
+        set_version(connection, 4)
+    return True
+
+
+def migrate_4(engine, chunk_size: int):
+    """
+    migrates from version 4 to version 5 by building the heaviest process counters of the existing rows
+
+    :param engine: sqlalchemy engine
+    :param chunk_size: int, unused, the counters are aggregated inside the database
+    :return: bool, True as the rollups have to be rebuilt
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        set_version(connection, 5)
+    return True
+
+
+def migrate_5(engine, chunk_size: int):
+    """
+    migrates from version 5 to version 6 by adding the process_samples table,
+    readings taken before have no processes besides the heaviest one
+
+    :param engine: sqlalchemy engine
+    :param chunk_size: int, unused, nothing is copied
+    :return: None
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        set_version(connection, 6)
+
+
+def migrate_6(engine, chunk_size: int):
+    """
+    migrates from version 6 to version 7 by adding the samples and until columns of processor rows
+    that stand for a run of readings, existing rows keep NULL as they are single readings
+
+    :param engine: sqlalchemy engine
+    :param chunk_size: int, unused, nothing is copied
+    :return: None
+    """
+    with engine.begin() as connection:
+        columns = [column["name"] for column in inspect(connection).get_columns("processors")]
+        for column in ["samples", "until"]:
+            if column not in columns:
+                connection.execute(text(f"ALTER TABLE processors ADD COLUMN {column} INTEGER"))
+        set_version(connection, 7)
+
+
+def migrate_7(engine, chunk_size: int):
+    """
+    migrates from version 7 to version 8 by adding the package_temperatures table,
+    readings taken before only have the temperatures of their cores
+
+    :param engine: sqlalchemy engine
+    :param chunk_size: int, unused, nothing is copied
+    :return: None
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        set_version(connection, 8)
+
+
+MIGRATIONS: Dict[int, Callable] = {
+    1: migrate_1,
+    2: migrate_2,
+    3: migrate_3,
+    4: migrate_4,
+    5: migrate_5,
+    6: migrate_6,
+    7: migrate_7,
+}
+
+
+def migrate(engine_adress: str, chunk_size: int = 10000):
+    """
+    migrates a database to the current schema version in place
+
+    the steps that change the rollups only tell if they have to be rebuilt,
+    they are rebuilt once after the last step. if the rebuild is interrupted run --rebuild_rollups
+
+    :param engine_adress: str, database adress
+    :param chunk_size: int, rows copied per transaction
+    :return: None
+    """
+    engine = create_engine(engine_adress)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", tune_sqlite)
+    version = get_schema_version(engine)
+    if version is None:
+        print("database is empty, nothing to migrate")
+        return
+    stale = False
+    while version < SCHEMA_VERSION:
+        print(f"migrating from schema version {version}", flush=True)
+        stale = MIGRATIONS[version](engine, chunk_size) or stale
+        version = get_schema_version(engine)
+    if stale:
+        print("rebuilding the rollups", flush=True)
+        rollup.rebuild(engine)
+    print(f"database is at schema version {version}")
@@ -0,0 +1,270 @@
+from typing import Dict, List, Tuple, Iterator
+from sqlalchemy import select, func, Integer, type_coerce
+from datetime import datetime
+import itertools
+import numpy as np
+from db import Processor, Rollup, to_timestamp
+from changes import MAX_RUN
+
+
+CHUNK_SIZE = 100000
+
+
+def iter_columns(connection, statement, chunk_size: int = CHUNK_SIZE) -> Iterator[List[np.ndarray]]:
+    """
+    runs a select and yields its columns as numpy arrays chunk_size rows at a time
+
+    the rows are read from the DBAPI cursor and copied straight into float64 arrays
+    so no orm objects or sqlalchemy rows are built. integer millisecond timestamps are exact in float64
+    and NULL becomes nan. results are streamed so memory use does not grow with the number of rows,
+    sqlite cursors always stream, other databases get a server side cursor. sqlalchemy buffers rows
+    of a server side cursor itself so those are read through the result.
+
+    :param connection: sqlalchemy connection
+    :param statement: sqlalchemy select
+    :param chunk_size: int, rows read per fetch
+    :return: iterator of lists of one float64 array per selected column
+    """
+    if connection.dialect.name == "sqlite":
+        result = connection.execute(statement)
+        fetch = result.cursor.fetchmany
+    else:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        fetch = result.fetchmany
+    width = len(result.keys())
+    try:
+        while True:
+            rows = fetch(chunk_size)
+            if not rows:
+                break
+            try:
+                chunk = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64,
+                                    count=len(rows) * width)
+            except TypeError:
+                # NULL values, the slower conversion turns them into nan
+                chunk = np.array(rows, dtype=np.float64)
+            chunk = chunk.reshape(-1, width)
+            yield [chunk[:, column] for column in range(width)]
+    finally:
+        result.close()
+
+
+def fetch_columns(connection, statement, chunk_size: int = CHUNK_SIZE) -> List[np.ndarray]:
+    """
+    runs a select and reads its columns into numpy arrays, see iter_columns
+
+    :param connection: sqlalchemy connection
+    :param statement: sqlalchemy select
+    :param chunk_size: int, rows read per fetch
+    :return: list of one float64 array per selected column
+    """
+    chunks = list(iter_columns(connection, statement, chunk_size))
+    if not chunks:
+        return [np.empty(0) for _ in statement.selected_columns]
+    return [np.concatenate(columns) for columns in zip(*chunks)]
+
+
+def query_raw(connection, client_id: int, measurement: str, start_time: datetime,
+              end_time: datetime) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    reads the raw samples of one measurement for a client within a time range
+
+    rows that stand for a run of readings give a point where the run starts and one where it ends, see expand_runs.
+    a run that overlaps the range is read even if it starts before it, which it can do by at most
+    changes.MAX_RUN seconds like in query_after, and its points are clipped to the range
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param measurement: str, 'temperature' or 'processor_usage'
+    :param start_time: datetime
+    :param end_time: datetime
+    :return: tuple(times: int64 ms, processors: int64, cores: int64, values: float64)
+    """
+    table = Processor.__table__
+    until = func.coalesce(table.c.until, table.c.time)
+    start, end = to_timestamp(start_time), to_timestamp(end_time)
+    statement = select(
+        type_coerce(table.c.time, Integer), type_coerce(until, Integer), table.c.processor, table.c.core,
+        table.c[measurement]
+    ).where(
+        table.c.client_id == client_id, table.c.time > start - int(MAX_RUN * 1000), until > start, table.c.time < end
+    )
+    times, processors, cores, values = expand_runs(*fetch_columns(connection, statement))
+    return np.clip(times, start, end).astype(np.int64), processors.astype(np.int64), cores.astype(np.int64), values
+
+
+def query_after(connection, client_id: int, measurement: str,
+                after: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    reads the raw samples of one measurement for a client that are newer than a timestamp
+
+    only the end of the (client_id, time) index is read so polling for new samples stays cheap
+    no matter how large the table is. a row that stands for a run is written when the run ends,
+    so rows are new when their run ends after 'after', which they can only do if they start at most
+    changes.MAX_RUN seconds before it
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param measurement: str, 'temperature' or 'processor_usage'
+    :param after: int, milliseconds since epoch of the newest sample already read
+    :return: tuple(times: int64 ms, processors: int64, cores: int64, values: float64)
+    """
+    table = Processor.__table__
+    until = func.coalesce(table.c.until, table.c.time)
+    statement = select(
+        type_coerce(table.c.time, Integer), type_coerce(until, Integer), table.c.processor, table.c.core,
+        table.c[measurement]
+    ).where(table.c.client_id == client_id, table.c.time > after - int(MAX_RUN * 1000), until > after)
+    times, processors, cores, values = expand_runs(*fetch_columns(connection, statement))
+    return times.astype(np.int64), processors.astype(np.int64), cores.astype(np.int64), values
+
+
+def expand_runs(times: np.ndarray, untils: np.ndarray, *columns: np.ndarray) -> List[np.ndarray]:
+    """
+    turns rows that stand for a run of readings into a point where the run starts and one where it ends
+
+    the value of a run is drawn flat from its first to its last reading and single readings stay one point,
+    so a line through the points is the series of every reading within the epsilon of changes.ChangeFilter.
+    points are not ordered
+
+    :param times: float64 array, milliseconds the rows start at
+    :param untils: float64 array, milliseconds the rows end at, the same as times for single readings
+    :param columns: float64 arrays of the other columns of the rows
+    :return: list of times followed by columns with one entry per point
+    """
+    runs = untils > times
+    if not runs.any():
+        return [times, *columns]
+    return [np.concatenate((times, untils[runs]))] + [np.concatenate((column, column[runs])) for column in columns]
+
+
+def query_rollup(connection, client_id: int, measurement: str, start_time: datetime, end_time: datetime,
+                 resolution: int, core: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    reads the mean of one measurement per processor or core and bucket from the rollups
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param measurement: str, 'temperature' or 'processor_usage'
+    :param start_time: datetime
+    :param end_time: datetime
+    :param resolution: int, seconds of the rollup to read
+    :param core: bool, mean per core instead of per processor
+    :return: tuple(times: int64 ms, keys: int64, values: float64)
+    """
+    table = Rollup.__table__
+    key = table.c.core if core else table.c.processor
+    mean = func.sum(table.c[f"{measurement}_sum"]) * 1.0 / func.sum(table.c.count)
+    statement = select(type_coerce(table.c.bucket, Integer), key, mean).where(
+        table.c.client_id == client_id, table.c.resolution == resolution,
+        table.c.bucket > to_timestamp(start_time), table.c.bucket < to_timestamp(end_time)
+    ).group_by(key, table.c.bucket)
+    times, keys, values = fetch_columns(connection, statement)
+    return times.astype(np.int64), keys.astype(np.int64), values
+
+
+def group_mean(keys: np.ndarray, times: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    takes the mean of the values that share both key and time
+
+    used to average the processors of a core, every processor on the core weighs the same
+    no matter how many threads the core has
+
+    :param keys: int64 array
+    :param times: int64 array
+    :param values: float64 array
+    :return: tuple(keys, times, means) with one entry per unique key and time
+    """
+    if not len(keys):
+        return keys, times, values
+    order = np.lexsort((times, keys))
+    keys, times, values = keys[order], times[order], values[order]
+    starts = np.flatnonzero(np.concatenate(([True], (keys[1:] != keys[:-1]) | (times[1:] != times[:-1]))))
+    sums = np.add.reduceat(values, starts)
+    counts = np.diff(np.append(starts, len(values)))
+    return keys[starts], times[starts], sums / counts
+
+
+def step_mean(groups: np.ndarray, keys: np.ndarray, times: np.ndarray,
+              values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    takes the mean of the series of every key in a group at every time one of them has a point
+
+    each series holds its last value until its next point, used to average the processors of a core
+    when their rows stand for runs that start and end at different times. when every key has a point
+    at the same times, as with single readings, it gives the same means as group_mean except that
+    missing values are left out instead of making the mean nan
+
+    :param groups: int64 array, such as the core of each point
+    :param keys: int64 array, such as the processor of each point
+    :param times: int64 array
+    :param values: float64 array
+    :return: tuple(groups, times, means) with one entry per unique group and time
+    """
+    if not len(groups):
+        return groups, times, values
+    # one sort for every group, each group and each of its keys is then a contiguous slice
+    order = np.lexsort((times, keys, groups))
+    groups, keys, times, values = groups[order], keys[order], times[order], values[order]
+    group_starts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+    key_starts = np.flatnonzero(np.concatenate(([True], (groups[1:] != groups[:-1]) | (keys[1:] != keys[:-1]))))
+    group_ends = np.append(group_starts[1:], len(groups))
+    group_keys = np.searchsorted(key_starts, group_starts)
+    result = []
+    for start, end, first, last in zip(group_starts.tolist(), group_ends.tolist(), group_keys.tolist(),
+                                       np.append(group_keys[1:], len(key_starts)).tolist()):
+        starts = key_starts[first:last].tolist()
+        group_times = times[start:end]
+        if len(set(np.diff(starts + [end]).tolist())) == 1:
+            grid = group_times.reshape(len(starts), -1)
+            if (grid == grid[0]).all() and (np.diff(grid[0]) > 0).all():
+                # every key has a point at the same times, such as single readings, a plain mean of the columns
+                held = values[start:end].reshape(len(starts), -1)
+                used = ~np.isnan(held)
+                with np.errstate(invalid="ignore"):
+                    means = np.where(used, held, 0).sum(axis=0) / used.sum(axis=0)
+                result.append((groups[start:start + grid.shape[1]], grid[0], means))
+                continue
+        grid = np.unique(group_times)
+        totals = np.zeros(len(grid))
+        counts = np.zeros(len(grid))
+        for key_start, key_end in zip(starts, starts[1:] + [end]):
+            positions = np.searchsorted(times[key_start:key_end], grid, side="right") - 1
+            held = values[key_start:key_end][np.maximum(positions, 0)]
+            used = (positions >= 0) & ~np.isnan(held)
+            totals[used] += held[used]
+            counts[used] += 1
+        with np.errstate(invalid="ignore"):
+            result.append((np.full(len(grid), groups[start], dtype=groups.dtype), grid, totals / counts))
+    return tuple(np.concatenate(columns) for columns in zip(*result))
+
+
+def split(keys: np.ndarray, times: np.ndarray, values: np.ndarray) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    splits the samples into one time ordered series per key
+
+    :param keys: int64 array
+    :param times: int64 array
+    :param values: float64 array
+    :return: dict[key: int] -> tuple(times, values)
+    """
+    order = np.lexsort((times, keys))
+    keys, times, values = keys[order], times[order], values[order]
+    unique, starts = np.unique(keys, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    return {int(key): (times[start:end], values[start:end]) for key, start, end in zip(unique, starts, ends)}
+
+
+def to_local_datetime64(times: np.ndarray) -> np.ndarray:
+    """
+    converts integer millisecond timestamps to local time datetime64 for matplotlib
+
+    the utc offset is looked up once per hour in the data so daylight saving time is followed
+
+    :param times: int64 array of milliseconds since epoch
+    :return: datetime64[ms] array
+    """
+    hours, inverse = np.unique(times // 3600000, return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(hour * 3600).astimezone().utcoffset().total_seconds() * 1000
+                        for hour in hours.tolist()], dtype=np.int64)
+    return (times + offsets[inverse]).astype("datetime64[ms]")
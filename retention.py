@@ -0,0 +1,323 @@
+from typing import Dict, Optional, List, Tuple, Deque, TYPE_CHECKING
+from collections import deque
+from datetime import datetime, timedelta
+from time import monotonic
+from pathlib import Path
+from timestamps import to_timestamp, from_timestamp, RESOLUTIONS
+import exceptions
+
+if TYPE_CHECKING:
+    # sqlalchemy is only imported where it is used, the binary log only needs the policy of a Retention
+    from sqlalchemy.sql.elements import TextClause
+
+
+# 'raw' is the processor rows, the heaviest processes of each reading and the collectors own tick rows,
+# the others are the rollups of timestamps.RESOLUTIONS,
+# the hourly heaviest process counters are kept as long as the hour rollups
+TIERS = ["raw"] + list(RESOLUTIONS)
+# None keeps a tier forever
+DEFAULT_POLICY: Dict[str, Optional[timedelta]] = {
+    "raw": timedelta(days=7), "minute": timedelta(days=90), "hour": timedelta(days=365), "day": None}
+UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400, "y": 365 * 86400}
+FOREVER = "forever"
+
+# each statement deletes at most :batch rows through the (client_id, time) or (client_id, resolution, bucket) index
+DELETE_RAW = ("DELETE FROM processors WHERE id IN (SELECT id FROM processors "
+              "WHERE client_id = :client_id AND time < :cutoff LIMIT :batch)")
+DELETE_TICKS = ("DELETE FROM ticks WHERE id IN (SELECT id FROM ticks "
+                "WHERE client_id = :client_id AND time < :cutoff LIMIT :batch)")
+DELETE_PROCESS_SAMPLES = ("DELETE FROM process_samples WHERE id IN (SELECT id FROM process_samples "
+                          "WHERE client_id = :client_id AND time < :cutoff LIMIT :batch)")
+DELETE_PACKAGE_TEMPERATURES = ("DELETE FROM package_temperatures WHERE id IN (SELECT id FROM package_temperatures "
+                               "WHERE client_id = :client_id AND time < :cutoff LIMIT :batch)")
+DELETE_PROCESS_ROLLUPS = ("DELETE FROM process_rollups WHERE id IN (SELECT id FROM process_rollups "
+                          "WHERE client_id = :client_id AND bucket < :cutoff LIMIT :batch)")
+DELETE_ROLLUPS = ("DELETE FROM rollups WHERE id IN (SELECT id FROM rollups "
+                  "WHERE client_id = :client_id AND resolution = :resolution AND bucket < :cutoff LIMIT :batch)")
+
+
+def expired_clients(table: str, condition: str) -> str:
+    # one index seek per client instead of a scan of the whole table
+    return (f"SELECT id FROM clients WHERE EXISTS (SELECT 1 FROM {table} "
+            f"WHERE client_id = clients.id AND {condition})")
+
+
+# the clients with expired rows in the table of each DELETE statement
+FIND_RAW = expired_clients("processors", "time < :cutoff")
+FIND_TICKS = expired_clients("ticks", "time < :cutoff")
+FIND_PROCESS_SAMPLES = expired_clients("process_samples", "time < :cutoff")
+FIND_PACKAGE_TEMPERATURES = expired_clients("package_temperatures", "time < :cutoff")
+FIND_PROCESS_ROLLUPS = expired_clients("process_rollups", "bucket < :cutoff")
+FIND_ROLLUPS = expired_clients("rollups", "resolution = :resolution AND bucket < :cutoff")
+
+
+def parse_age(age: str) -> Optional[timedelta]:
+    """
+    parses an age such as '30m', '12h', '7d', '2w', '1y' or 'forever'
+
+    :param age: str
+    :return: timedelta or None for forever
+    """
+    if age == FOREVER:
+        return None
+    number, unit = age[:-1], age[-1:]
+    if unit not in UNITS or not number.isdigit():
+        raise exceptions.ArgumentError(f"Retention must be a number followed by one of "
+                                       f"{', '.join(UNITS)} or '{FOREVER}', got {age}")
+    return timedelta(seconds=int(number) * UNITS[unit])
+
+
+def parse_policy(policy: str) -> Dict[str, Optional[timedelta]]:
+    """
+    parses 'tier=age,...' such as 'raw=7d,hour=1y,day=forever'
+
+    tiers that are not given keep the age of DEFAULT_POLICY
+
+    :param policy: str
+    :return: dict[tier: str] -> timedelta or None
+    """
+    parsed = dict(DEFAULT_POLICY)
+    for part in policy.split(","):
+        tier, _, age = part.strip().partition("=")
+        if tier not in TIERS or not age:
+            raise exceptions.ArgumentError(f"Retention must be 'tier=age,...' with tiers {', '.join(TIERS)}, "
+                                           f"got {part}")
+        parsed[tier] = parse_age(age)
+    return parsed
+
+
+def format_age(age: Optional[timedelta]) -> str:
+    if age is None:
+        return FOREVER
+    seconds = int(age.total_seconds())
+    for unit, size in sorted(UNITS.items(), key=lambda item: -item[1]):
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+
+def vacuum(engine, pages: Optional[int] = None):
+    """
+    gives free pages of a sqlite database back to the file system
+
+    needs the database to be in auto_vacuum=INCREMENTAL mode, new databases are, see manager.tune_sqlite.
+    runs through executescript as the sqlite3 module only steps a statement once
+    and incremental_vacuum frees one page per step
+
+    :param engine: sqlalchemy engine
+    :param pages: int, most pages to free, all free pages if None
+    :return: None
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    connection = engine.raw_connection()
+    try:
+        connection.cursor().executescript(f"PRAGMA incremental_vacuum({pages if pages else ''})")
+    finally:
+        connection.close()
+
+
+def enable_incremental_vacuum(engine):
+    """
+    turns on auto_vacuum=INCREMENTAL in an existing sqlite database
+
+    rewrites the whole file with VACUUM so it locks the database for as long as that takes,
+    only needed once for databases created before retention existed
+
+    :param engine: sqlalchemy engine
+    :return: None
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    connection = engine.raw_connection()
+    try:
+        connection.cursor().executescript("PRAGMA auto_vacuum=INCREMENTAL; VACUUM;")
+    finally:
+        connection.close()
+
+
+class Retention:
+    """
+    deletes rows older than the age of their tier a small batch at a time
+
+    expire is called after every flush of the Manager but only looks for expired rows every interval seconds,
+    with one query per table for the clients that have any. every batch is its own transaction so none of them
+    holds the write lock for long, batches are deleted until a table has no expired rows left. once time_budget
+    seconds passed the call returns and the next call resumes with the table and client it stopped at,
+    so a flush never waits long for retention and a backlog of expired rows is still worked off.
+    the pages the deleted rows used are given back to the file system with an incremental vacuum
+    of at most vacuum_pages pages per call.
+    """
+
+    def __init__(self, policy: Dict[str, Optional[timedelta]] = None, batch_size: int = 1000,
+                 vacuum_pages: int = 256, time_budget: float = 1.0, interval: float = 60.0):
+        """
+        :param policy: dict[tier: str] -> timedelta or None to keep forever, defaults to DEFAULT_POLICY
+        :param batch_size: int, most rows deleted per client and table in one transaction
+        :param vacuum_pages: int, most pages given back to the file system in one call to expire
+        :param time_budget: float, seconds after which expire returns, what is left is deleted on the next call
+        :param interval: float, seconds between two searches for expired rows
+        """
+        self.policy = policy if policy is not None else dict(DEFAULT_POLICY)
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.time_budget = time_budget
+        self.interval = interval
+        # DELETE statements and their parameters with client_id still to run, left over from the last call
+        self.pending: Deque[Tuple["TextClause", dict]] = deque()
+        self.last_search: Optional[float] = None
+
+    def statements(self, now: datetime) -> List[Tuple[str, str, dict]]:
+        """
+        :param now: datetime
+        :return: list of tuple(find: str, delete: str, parameters: dict), see expired_clients
+        """
+        statements = []
+        for tier, age in self.policy.items():
+            if age is None:
+                continue
+            cutoff = to_timestamp(now - age)
+            if tier == "raw":
+                statements.append((FIND_RAW, DELETE_RAW, {"cutoff": cutoff}))
+                statements.append((FIND_PROCESS_SAMPLES, DELETE_PROCESS_SAMPLES, {"cutoff": cutoff}))
+                statements.append((FIND_PACKAGE_TEMPERATURES, DELETE_PACKAGE_TEMPERATURES, {"cutoff": cutoff}))
+                statements.append((FIND_TICKS, DELETE_TICKS, {"cutoff": cutoff}))
+            else:
+                statements.append((FIND_ROLLUPS, DELETE_ROLLUPS,
+                                   {"cutoff": cutoff, "resolution": RESOLUTIONS[tier]}))
+            if tier == "hour":
+                # the heaviest process counters are hourly
+                statements.append((FIND_PROCESS_ROLLUPS, DELETE_PROCESS_ROLLUPS, {"cutoff": cutoff}))
+        return statements
+
+    def search(self, session, now: datetime):
+        """
+        queues a DELETE statement for every client and table with expired rows
+
+        :param session: sqlalchemy session
+        :param now: datetime
+        :return: None
+        """
+        from sqlalchemy import text
+
+        for find, delete, parameters in self.statements(now):
+            delete = text(delete)
+            for (client_id,) in session.execute(text(find), parameters):
+                self.pending.append((delete, dict(parameters, client_id=client_id)))
+        session.commit()
+
+    def expire(self, session, now: datetime = None) -> int:
+        """
+        deletes expired rows batch_size rows per transaction until none are left or time_budget seconds passed
+
+        searches for expired rows when nothing is left from the last call and interval seconds passed
+        since the last search, the first call always searches
+
+        :param session: sqlalchemy session, committed by this call
+        :param now: datetime, defaults to datetime.now()
+        :return: int, rows deleted
+        """
+        began = monotonic()
+        if not self.pending:
+            if self.last_search is not None and began - self.last_search < self.interval:
+                return 0
+            self.last_search = began
+            self.search(session, now if now else datetime.now())
+        deleted = 0
+        while self.pending and monotonic() - began <= self.time_budget:
+            statement, parameters = self.pending[0]
+            count = session.execute(statement, dict(parameters, batch=self.batch_size)).rowcount
+            session.commit()
+            deleted += count
+            if count < self.batch_size:
+                self.pending.popleft()
+        if deleted:
+            vacuum(session.get_bind(), self.vacuum_pages)
+        return deleted
+
+
+def table_sizes(connection) -> Optional[Dict[str, int]]:
+    """
+    bytes used by each table including its indexes
+
+    :param connection: sqlalchemy connection
+    :return: dict[table: str] -> bytes or None if the database can not tell
+    """
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    if connection.dialect.name == "postgresql":
+        return {table: connection.execute(text("SELECT pg_total_relation_size(:table)"), {"table": table}).scalar()
+                for table in ["processors", "rollups", "process_rollups", "process_samples",
+                              "package_temperatures", "ticks", "processes"]}
+    if connection.dialect.name != "sqlite":
+        return None
+    try:
+        # dbstat is an optional part of sqlite
+        rows = connection.execute(text("SELECT master.tbl_name, SUM(stat.pgsize) FROM dbstat AS stat "
+                                       "JOIN sqlite_master AS master ON stat.name = master.name "
+                                       "GROUP BY master.tbl_name"))
+    except OperationalError:
+        return None
+    return {table: size for table, size in rows}
+
+
+def report(engine, policy: Dict[str, Optional[timedelta]]):
+    """
+    prints the rows, time span and space of each tier and how long it is kept
+
+    the rollup tiers share one table so its space is split between them by their share of the rows
+
+    :param engine: sqlalchemy engine
+    :param policy: dict[tier: str] -> timedelta or None
+    :return: None
+    """
+    from sqlalchemy import text
+
+    with engine.connect() as connection:
+        sizes = table_sizes(connection)
+        tiers = {"raw": connection.execute(text("SELECT COUNT(*), MIN(time), MAX(time) FROM processors")).one()}
+        for tier, resolution in RESOLUTIONS.items():
+            tiers[tier] = connection.execute(
+                text("SELECT COUNT(*), MIN(bucket), MAX(bucket) FROM rollups WHERE resolution = :resolution"),
+                {"resolution": resolution}).one()
+        # tables that follow the age of another tier, name -> (table, tier)
+        followers = {"ticks": ("ticks", "raw"), "samples": ("process_samples", "raw"),
+                     "packages": ("package_temperatures", "raw"), "top": ("process_rollups", "hour")}
+        spans = {name: connection.execute(text(
+            f"SELECT COUNT(*), MIN({'bucket' if table == 'process_rollups' else 'time'}), "
+            f"MAX({'bucket' if table == 'process_rollups' else 'time'}) FROM {table}")).one()
+            for name, (table, _) in followers.items()}
+
+        if engine.dialect.name == "sqlite":
+            page_size = connection.execute(text("PRAGMA page_size")).scalar()
+            free = connection.execute(text("PRAGMA freelist_count")).scalar() * page_size
+            incremental = connection.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+
+    rollup_rows = sum(tiers[tier][0] for tier in RESOLUTIONS)
+
+    def size(tier: str) -> Optional[int]:
+        if sizes is None:
+            return None
+        if tier == "raw":
+            return sizes.get("processors", 0) + sizes.get("processes", 0)
+        if tier in followers:
+            return sizes.get(followers[tier][0], 0)
+        return sizes.get("rollups", 0) * tiers[tier][0] // rollup_rows if rollup_rows else 0
+
+    def date(timestamp: Optional[int]) -> str:
+        return str(from_timestamp(timestamp).date()) if timestamp is not None else "-"
+
+    print(f"{'tier':<8} {'rows':>14} {'oldest':>12} {'newest':>12} {'MB':>10} {'kept':>9}")
+    for tier, (count, oldest, newest) in list(tiers.items()) + list(spans.items()):
+        megabytes = size(tier)
+        print(f"{tier:<8} {count:>14,} {date(oldest):>12} {date(newest):>12} "
+              f"{megabytes / 2 ** 20 if megabytes is not None else float('nan'):>10.1f} "
+              f"{format_age(policy[followers[tier][1] if tier in followers else tier]):>9}")
+
+    if engine.dialect.name == "sqlite":
+        path = Path(engine.url.database)
+        print(f"\nfile {path.stat().st_size / 2 ** 20:.1f} MB, {free / 2 ** 20:.1f} MB of it free pages")
+        if not incremental:
+            print("the database is not in incremental vacuum mode, run with --vacuum once "
+                  "so space freed by retention is given back")
@@ -0,0 +1,175 @@
+from typing import Optional, Tuple
+from pathlib import Path
+from time import sleep
+from socket import gethostname
+import signal
+import mmap
+import numpy as np
+from manager import Manager
+from retention import Retention
+import rollup
+
+
+MAGIC = b"CPURING1"
+HEADER = np.dtype([("magic", "S8"), ("record_size", "<u4"), ("padding", "<u4"),
+                   ("capacity", "<u8"), ("written", "<u8"), ("flushed", "<u8")])
+HEADER_SIZE = 64
+RECORD = np.dtype([("time", "<i8"), ("processor", "<i4"), ("core", "<i4"),
+                   ("temperature", "<i4"), ("processor_usage", "<f4")])
+
+
+class RingBuffer:
+    """
+    fixed size ring of RECORD records in a memory mapped file
+
+    the file starts with a HEADER_SIZE byte header followed by 'capacity' records.
+    'written' in the header counts every record ever appended, record n is stored at slot n % capacity.
+    'flushed' is how far the flusher has read. there is one writer, any number of processes can open
+    the file read only and look at 'records' without copying.
+    """
+
+    def __init__(self, path: Path, capacity: Optional[int] = None, writable: bool = False):
+        """
+        :param path: Path, the ring file
+        :param capacity: int, records to hold, creates or resizes the file if given
+        :param writable: bool, the ring is opened read only unless this is True or capacity is given
+        """
+        self.path = Path(path)
+        self.writable = writable or capacity is not None
+        if capacity is not None and (not self.path.exists() or self.read_capacity() != capacity):
+            with open(str(self.path), "wb") as file:
+                file.truncate(HEADER_SIZE + capacity * RECORD.itemsize)
+                header = np.zeros(1, dtype=HEADER)
+                header["magic"], header["record_size"], header["capacity"] = MAGIC, RECORD.itemsize, capacity
+                file.write(header.tobytes())
+
+        self.file = open(str(self.path), "r+b" if self.writable else "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+        self.header = np.frombuffer(self.map, dtype=HEADER, count=1)
+        if self.header["magic"][0] != MAGIC or self.header["record_size"][0] != RECORD.itemsize:
+            self.close()
+            raise ValueError(f"{self.path} is not a cpu_temp ring buffer")
+        self.capacity = int(self.header["capacity"][0])
+        self.records = np.frombuffer(self.map, dtype=RECORD, count=self.capacity, offset=HEADER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read_capacity(self) -> Optional[int]:
+        with open(str(self.path), "rb") as file:
+            header = np.frombuffer(file.read(HEADER.itemsize), dtype=HEADER)
+        return int(header["capacity"][0]) if len(header) and header["magic"][0] == MAGIC else None
+
+    def close(self):
+        # the numpy views have to be released before the map can be closed
+        self.header = self.records = None
+        self.map.close()
+        self.file.close()
+
+    @property
+    def written(self) -> int:
+        return int(self.header["written"][0])
+
+    @property
+    def flushed(self) -> int:
+        return int(self.header["flushed"][0])
+
+    @flushed.setter
+    def flushed(self, index: int):
+        self.header["flushed"] = index
+
+    def append(self, records: np.ndarray):
+        """
+        appends records, overwriting the oldest ones when the ring is full
+
+        the records are copied in before 'written' is moved so readers never see a half written record
+
+        :param records: array of RECORD, at most capacity long
+        :return: None
+        """
+        written = self.written
+        start = written % self.capacity
+        first = min(len(records), self.capacity - start)
+        self.records[start:start + first] = records[:first]
+        self.records[:len(records) - first] = records[first:]
+        self.header["written"] = written + len(records)
+
+    def read(self, since: int) -> Tuple[np.ndarray, int, int]:
+        """
+        copies the records appended since index 'since'
+
+        :param since: int, the 'written' count of the previous read
+        :return: tuple(records: array of RECORD, next since: int, lost: int records that were overwritten before read)
+        """
+        written = self.written
+        oldest = max(0, written - self.capacity)
+        lost = max(0, oldest - since)
+        since = max(since, oldest)
+        records = self.records[np.arange(since, written) % self.capacity]
+        # the writer may have lapped the start of the copy while copying
+        overwritten = self.written - self.capacity - since
+        if overwritten > 0:
+            records = records[overwritten:]
+            lost += overwritten
+        return records, written, lost
+
+    def latest(self, count: int) -> np.ndarray:
+        """
+        copies the newest 'count' records
+
+        :param count: int
+        :return: array of RECORD
+        """
+        return self.read(max(0, self.written - count))[0]
+
+
+def drain(path: Path, engine_adress: str, interval: float, rollups_only: bool = True,
+          retention: Optional[Retention] = None):
+    """
+    moves the records of a ring buffer into the database every 'interval' seconds until stopped
+
+    with rollups_only only the minute, hour and day rollups are updated, otherwise every record
+    is stored as a processor row without a heaviest process. resumes from the 'flushed' index of the ring.
+
+    :param path: Path, the ring file, it has to exist
+    :param engine_adress: str, database adress
+    :param interval: float, seconds between each drain
+    :param rollups_only: bool
+    :param retention: Retention, expired rows are deleted after each drain
+    :return: None
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    with RingBuffer(path, writable=True) as ring, Manager(engine_adress, retention=retention) as manager:
+        client = manager.get_client(gethostname())
+        if client.id is None:
+            manager.session.add(client)
+            manager.session.commit()
+        client_id = client.id
+        while True:
+            records, index, lost = ring.read(ring.flushed)
+            if lost:
+                print(f"ring buffer flusher fell behind, {lost} records lost", flush=True)
+            if len(records):
+                rows = [{"client_id": client_id, "time": int(time), "core": int(core), "processor": int(processor),
+                         "temperature": int(temperature), "processor_usage": float(usage)}
+                        for time, processor, core, temperature, usage in records.tolist()]
+                if rollups_only:
+                    rollup.upsert(manager.session, rollup.aggregate(rows), manager.engine.dialect.name)
+                    manager.session.commit()
+                    if retention:
+                        retention.expire(manager.session)
+                else:
+                    for row in rows:
+                        manager.buffer_cpu(client, row["core"], row["processor"], row["processor_usage"], "", 0.0,
+                                           row["temperature"], row["time"])
+                    manager.flush()
+            ring.flushed = index
+            if stopping:
+                return
+            sleep(interval)
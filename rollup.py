@@ -0,0 +1,210 @@
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func, text
+from sqlalchemy.dialects import sqlite
+from datetime import datetime
+from db import Rollup, ProcessRollup, to_timestamp
+from timestamps import RESOLUTIONS
+
+
+# the least amount of points per line a resolution has to give to be used for a plot
+MIN_POINTS = 500
+
+MEASUREMENTS = ["temperature", "processor_usage"]
+# seconds per bucket of the heaviest process counters
+PROCESS_RESOLUTION = RESOLUTIONS["hour"]
+
+
+def aggregate(rows: List[dict]) -> List[dict]:
+    """
+    aggregates processor rows into rollup rows for every resolution
+
+    buckets start at whole minutes, hours and days since epoch, so days follow UTC
+
+    :param rows: list of processor rows as passed to Manager.buffer_cpu
+    :return: list of rollup rows
+    """
+    rollups: Dict[Tuple[int, int, int, int], dict] = {}
+    for row in rows:
+        timestamp = to_timestamp(row["time"])
+        for resolution in RESOLUTIONS.values():
+            bucket = timestamp - timestamp % (resolution * 1000)
+            key = (row["client_id"], resolution, row["processor"], bucket)
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollups[key] = rollup = {
+                    "client_id": row["client_id"], "resolution": resolution, "bucket": bucket,
+                    "core": row["core"], "processor": row["processor"], "count": 0}
+                for measurement in MEASUREMENTS:
+                    rollup[f"{measurement}_min"] = row[measurement]
+                    rollup[f"{measurement}_max"] = row[measurement]
+                    rollup[f"{measurement}_sum"] = 0
+                    rollup[f"{measurement}_squares"] = 0.0
+            rollup["count"] += 1
+            for measurement in MEASUREMENTS:
+                value = row[measurement]
+                rollup[f"{measurement}_min"] = min(rollup[f"{measurement}_min"], value)
+                rollup[f"{measurement}_max"] = max(rollup[f"{measurement}_max"], value)
+                rollup[f"{measurement}_sum"] += value
+                rollup[f"{measurement}_squares"] += float(value) * value
+    return list(rollups.values())
+
+
+def aggregate_processes(rows: List[dict]) -> List[dict]:
+    """
+    aggregates processor rows into heaviest process counters per hour, processor and process
+
+    rows whose heaviest process used nothing are left out, the processor was idle and the sampler
+    still names a process then
+
+    :param rows: list of processor rows as passed to Manager.buffer_cpu
+    :return: list of process rollup rows
+    """
+    counters: Dict[Tuple[int, int, int, int], dict] = {}
+    size = PROCESS_RESOLUTION * 1000
+    for row in rows:
+        if not row["heaviest_process_usage"]:
+            continue
+        timestamp = to_timestamp(row["time"])
+        bucket = timestamp - timestamp % size
+        key = (row["client_id"], bucket, row["processor"], row["heaviest_process_id"])
+        counter = counters.get(key)
+        if counter is None:
+            counters[key] = counter = {
+                "client_id": row["client_id"], "bucket": bucket, "processor": row["processor"], "core": row["core"],
+                "process_id": row["heaviest_process_id"], "count": 0, "usage_sum": 0.0, "temperature_sum": 0.0,
+                "temperature_max": row["temperature"]}
+        counter["count"] += 1
+        counter["usage_sum"] += row["heaviest_process_usage"]
+        counter["temperature_sum"] += row["temperature"]
+        counter["temperature_max"] = max(counter["temperature_max"], row["temperature"])
+    return list(counters.values())
+
+
+def insert(table, dialect: str):
+    """
+    :return: tuple(insert statement with on_conflict_do_update, least function, greatest function)
+    """
+    if dialect == "postgresql":
+        # only loaded when used, it is a noticeable part of the startup of a one shot --log
+        from sqlalchemy.dialects import postgresql
+        return postgresql.insert(table), func.least, func.greatest
+    return sqlite.insert(table), func.min, func.max
+
+
+def upsert(connection, rollups: List[dict], dialect: str):
+    """
+    merges rollup rows into the rollups table
+
+    a bucket that already exists has its count and sums added to and its min and max widened
+
+    :param connection: sqlalchemy connection or session
+    :param rollups: list of rollup rows from aggregate
+    :param dialect: str, 'sqlite' or 'postgresql'
+    :return: None
+    """
+    if not rollups:
+        return
+    table = Rollup.__table__
+    statement, least, greatest = insert(table, dialect)
+    update = {"count": table.c.count + statement.excluded.count}
+    for measurement in MEASUREMENTS:
+        update[f"{measurement}_min"] = least(table.c[f"{measurement}_min"], statement.excluded[f"{measurement}_min"])
+        update[f"{measurement}_max"] = greatest(table.c[f"{measurement}_max"], statement.excluded[f"{measurement}_max"])
+        update[f"{measurement}_sum"] = table.c[f"{measurement}_sum"] + statement.excluded[f"{measurement}_sum"]
+        update[f"{measurement}_squares"] = (table.c[f"{measurement}_squares"] +
+                                            statement.excluded[f"{measurement}_squares"])
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.client_id, table.c.resolution, table.c.processor, table.c.bucket], set_=update)
+    connection.execute(statement, rollups)
+
+
+def upsert_processes(connection, counters: List[dict], dialect: str):
+    """
+    merges heaviest process counters into the process_rollups table
+
+    :param connection: sqlalchemy connection or session
+    :param counters: list of rows from aggregate_processes
+    :param dialect: str, 'sqlite' or 'postgresql'
+    :return: None
+    """
+    if not counters:
+        return
+    table = ProcessRollup.__table__
+    statement, least, greatest = insert(table, dialect)
+    update = {"count": table.c.count + statement.excluded.count,
+              "usage_sum": table.c.usage_sum + statement.excluded.usage_sum,
+              "temperature_sum": table.c.temperature_sum + statement.excluded.temperature_sum,
+              "temperature_max": greatest(table.c.temperature_max, statement.excluded.temperature_max)}
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.client_id, table.c.bucket, table.c.processor, table.c.process_id], set_=update)
+    connection.execute(statement, counters)
+
+
+def rebuild(engine):
+    """
+    rebuilds the rollups and the heaviest process counters from the raw processor rows
+
+    the aggregation runs inside the database, one transaction per client and resolution.
+    only the buckets from the oldest raw row on are rebuilt, older rollups are kept as their raw rows
+    may have been deleted by retention. a row that stands for a run of readings counts as every reading
+    of the run in the bucket the run starts in, see changes.ChangeFilter
+
+    :param engine: sqlalchemy engine
+    :return: None
+    """
+    statement = text(
+        "INSERT INTO rollups (client_id, resolution, bucket, core, processor, count, "
+        "temperature_min, temperature_max, temperature_sum, temperature_squares, "
+        "processor_usage_min, processor_usage_max, processor_usage_sum, processor_usage_squares) "
+        "SELECT client_id, :resolution, (time / :size) * :size, min(core), processor, sum(COALESCE(samples, 1)), "
+        "min(temperature), max(temperature), sum(temperature * COALESCE(samples, 1)), "
+        "sum(temperature * 1.0 * temperature * COALESCE(samples, 1)), "
+        "min(processor_usage), max(processor_usage), sum(processor_usage * COALESCE(samples, 1)), "
+        "sum(processor_usage * processor_usage * COALESCE(samples, 1)) "
+        "FROM processors WHERE client_id = :client_id AND time IS NOT NULL "
+        "GROUP BY processor, time / :size")
+    processes = text(
+        "INSERT INTO process_rollups (client_id, bucket, processor, core, process_id, count, usage_sum, "
+        "temperature_sum, temperature_max) "
+        "SELECT client_id, (time / :size) * :size, processor, min(core), heaviest_process_id, "
+        "sum(COALESCE(samples, 1)), sum(heaviest_process_usage * COALESCE(samples, 1)), "
+        "sum(temperature * COALESCE(samples, 1)), max(temperature) "
+        "FROM processors WHERE client_id = :client_id AND time IS NOT NULL AND heaviest_process_id IS NOT NULL "
+        "AND heaviest_process_usage > 0 "
+        "GROUP BY processor, heaviest_process_id, time / :size")
+    first = text("SELECT MIN(time) FROM processors WHERE client_id = :client_id")
+    with engine.connect() as connection:
+        clients = [row[0] for row in connection.execute(text("SELECT id FROM clients"))]
+    for client_id in clients:
+        with engine.connect() as connection:
+            oldest = connection.execute(first, {"client_id": client_id}).scalar()
+        if oldest is None:
+            continue
+        for name, resolution in RESOLUTIONS.items():
+            size = resolution * 1000
+            with engine.begin() as connection:
+                connection.execute(text("DELETE FROM rollups WHERE client_id = :client_id AND resolution = :resolution "
+                                        "AND bucket >= :bucket"),
+                                   {"client_id": client_id, "resolution": resolution, "bucket": oldest // size * size})
+                connection.execute(statement, {"client_id": client_id, "resolution": resolution,
+                                               "size": resolution * 1000})
+            print(f"rebuilt {name} rollups of client {client_id}", flush=True)
+        size = PROCESS_RESOLUTION * 1000
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM process_rollups WHERE client_id = :client_id AND bucket >= :bucket"),
+                               {"client_id": client_id, "bucket": oldest // size * size})
+            connection.execute(processes, {"client_id": client_id, "size": size})
+        print(f"rebuilt process counters of client {client_id}", flush=True)
+
+
+def pick_resolution(start_time: datetime, end_time: datetime) -> Optional[int]:
+    """
+    picks the coarsest resolution that still gives MIN_POINTS points between start_time and end_time
+
+    :param start_time: datetime
+    :param end_time: datetime
+    :return: int, resolution in seconds or None if the raw rows should be used
+    """
+    seconds = (end_time - start_time).total_seconds()
+    usable = [resolution for resolution in RESOLUTIONS.values() if seconds / resolution >= MIN_POINTS]
+    return max(usable) if usable else None
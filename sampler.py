@@ -0,0 +1,233 @@
+from typing import Dict, List, Tuple, Optional
+from pathlib import Path
+import heapq
+import os
+
+
+PROC_ROOT = Path("/proc")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+# processes kept per processor and sample
+TOP_K = 5
+# seconds between the snapshot and the first sample of a sampler that has no previous sample, see snapshot
+FIRST_WINDOW = 0.5
+
+
+def read_bytes(path: Path) -> bytes:
+    """
+    reads the full content of a file as bytes
+
+    :param path: Path, path to the file
+    :return: bytes, the content of the file
+    """
+    with open(str(path), "rb") as file:
+        return file.read()
+
+
+def parse_command(cmdline: bytes, name: str) -> str:
+    """
+    turns the content of /proc/[pid]/cmdline into the same command string the ps parser produced
+
+    the executable is used as the command, if both the executable and its first argument
+    are paths the argument is assumed to be a script and is included as well.
+    kernel threads have no cmdline and are named '[name]' the same way ps names them
+
+    :param cmdline: bytes, null separated content of /proc/[pid]/cmdline
+    :param name: str, the comm field from /proc/[pid]/stat
+    :return: str, the command
+    """
+    args = [arg.decode(errors="replace") for arg in cmdline.split(b"\0") if arg]
+    if not args:
+        return f"[{name}]"
+    if len(args) > 1 and "/" in args[0] and "/" in args[1]:
+        return f"{args[0]} {args[1]}"
+    return args[0]
+
+
+class ProcSampler:
+    """
+    samples processor and process usage straight from /proc
+
+    keeps the previous snapshot of /proc/stat and every /proc/[pid]/stat in memory
+    so usage is calculated from the delta between two samples instead of being a lifetime average.
+    without a previous sample the usage of processors is since boot and that of processes since they started,
+    the same way ps calculates pcpu, so a first sample should be preceded by snapshot.
+    a process that started after the previous sample is calculated since it started.
+
+    the top_k processes of each processor are picked with a heap of top_k entries per processor,
+    so a sample costs one comparison for most processes no matter how many there are.
+    the commands of the picked processes are cached by pid and start time for as long as the process lives.
+    """
+
+    def __init__(self, proc_root: Path = PROC_ROOT, top_k: int = TOP_K):
+        self.proc_root = proc_root
+        self.top_k = top_k
+        self.previous_cpus: Dict[int, Tuple[int, int]] = {}
+        self.previous_processes: Dict[Tuple[int, int], int] = {}
+        self.previous_uptime: Optional[float] = None
+        self.commands: Dict[Tuple[int, int], str] = {}
+        # seconds since epoch the system booted at, from the btime line of /proc/stat
+        self.boot_time = 0
+
+    def read_uptime(self) -> float:
+        """
+        reads the systems uptime in seconds
+
+        :return: float, seconds since boot
+        """
+        return float(read_bytes(self.proc_root.joinpath("uptime")).split()[0])
+
+    def read_cpus(self) -> Dict[int, Tuple[int, int]]:
+        """
+        reads the cumulative jiffies of each processor from /proc/stat
+
+        :return: dict[processor_id: int] -> (total: int, idle: int)
+        """
+        cpus = {}
+        for line in read_bytes(self.proc_root.joinpath("stat")).splitlines():
+            if line.startswith(b"btime"):
+                self.boot_time = int(line.split()[1])
+            if not line.startswith(b"cpu") or line.startswith(b"cpu "):
+                continue
+            name, *fields = line.split()
+            values = [int(field) for field in fields]
+            # idle + iowait
+            idle = values[3] + (values[4] if len(values) > 4 else 0)
+            # guest time is already accounted for in user and nice
+            cpus[int(name[3:])] = (sum(values[:8]), idle)
+        return cpus
+
+    def read_process(self, pid: bytes) -> Optional[Tuple[str, int, int, int]]:
+        """
+        reads the name, start time, used jiffies and last processor of a process
+
+        :param pid: bytes, the name of the /proc/[pid] directory
+        :return: tuple(name: str, start_time: int, ticks: int, processor_id: int) or None if the process is gone
+        """
+        try:
+            stat = read_bytes(self.proc_root.joinpath(pid.decode(), "stat"))
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            return None
+        # the name can contain spaces and parentheses so split on the last one
+        left, _, right = stat.rpartition(b")")
+        name = left.partition(b"(")[2].decode(errors="replace")
+        fields = right.split()
+        # fields[0] is field 3 (state) in proc(5)
+        ticks = int(fields[11]) + int(fields[12])
+        return name, int(fields[19]), ticks, int(fields[36])
+
+    def read_command(self, pid: int, name: str) -> str:
+        """
+        reads the command of a process
+
+        :param pid: int, the process id
+        :param name: str, fallback name if the process has no command line
+        :return: str, the command
+        """
+        try:
+            cmdline = read_bytes(self.proc_root.joinpath(str(pid), "cmdline"))
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            cmdline = b""
+        return parse_command(cmdline, name)
+
+    def sample_cpus(self) -> Dict[int, float]:
+        """
+        calculates the usage of each processor since the previous call
+
+        only reads /proc/stat so it is cheap enough to call many times a second
+
+        :return: dict[processor_id: int] -> processor_usage: float
+        """
+        cpus = self.read_cpus()
+        processor_usage = {}
+        for processor_id, (total, idle) in cpus.items():
+            previous_total, previous_idle = self.previous_cpus.get(processor_id, (0, 0))
+            delta = total - previous_total
+            processor_usage[processor_id] = (100 * (1 - (idle - previous_idle) / delta)) if delta > 0 else 0.0
+        self.previous_cpus = cpus
+        return processor_usage
+
+    def snapshot(self):
+        """
+        remembers the jiffies of every processor and process without calculating any usage or reading commands,
+        so the next sample is calculated since now
+
+        :return: None
+        """
+        uptime = self.read_uptime()
+        self.sample_cpus()
+        processes = {}
+        for entry in os.listdir(bytes(self.proc_root)):
+            if not entry.isdigit():
+                continue
+            process = self.read_process(entry)
+            if process is not None:
+                processes[(int(entry), process[1])] = process[2]
+        self.previous_processes = processes
+        self.previous_uptime = uptime
+
+    def sample(self) -> Dict[int, dict]:
+        """
+        finds the heaviest processes for each processor since the previous sample
+
+        same format as cpu_temp.get_processes
+        keys: 'process_usage', 'command', 'processor_usage' and 'top', the top_k processes that used the processor
+        the most as a list of tuple(pid: int, start_time: int ms since epoch, command: str, usage: float),
+        heaviest first. processes that used nothing are left out, a processor where no process used anything
+        has the empty command as heaviest process with a usage of 0.
+
+        :return: dict(processor_id: int) -> dict
+        """
+        uptime = self.read_uptime()
+        processor_usage = self.sample_cpus()
+
+        # min heaps of (usage, pid, start_time, name), the lightest of the kept processes on top
+        heaps: Dict[int, List[Tuple[float, int, int, str]]] = {}
+        size = max(1, self.top_k)
+        processes = {}
+        for entry in os.listdir(bytes(self.proc_root)):
+            if not entry.isdigit():
+                continue
+            process = self.read_process(entry)
+            if process is None:
+                continue
+            name, start_time, ticks, processor_id = process
+            key = (int(entry), start_time)
+            processes[key] = ticks
+
+            previous_ticks = self.previous_processes.get(key)
+            if previous_ticks is None or self.previous_uptime is None:
+                elapsed = uptime * CLOCK_TICKS - start_time
+                previous_ticks = 0
+            else:
+                elapsed = (uptime - self.previous_uptime) * CLOCK_TICKS
+            usage = 100 * (ticks - previous_ticks) / elapsed if elapsed > 0 else 0.0
+
+            heap = heaps.get(processor_id)
+            if heap is None:
+                heaps[processor_id] = [(usage, key[0], start_time, name)]
+            elif len(heap) < size:
+                heapq.heappush(heap, (usage, key[0], start_time, name))
+            elif usage > heap[0][0]:
+                heapq.heapreplace(heap, (usage, key[0], start_time, name))
+
+        self.previous_processes = processes
+        self.previous_uptime = uptime
+        self.commands = {key: command for key, command in self.commands.items() if key in processes}
+
+        result = {}
+        for processor_id, usage in processor_usage.items():
+            top = []
+            for process_usage, pid, start_time, name in sorted(heaps.get(processor_id, []), reverse=True):
+                if round(process_usage, 1) <= 0:
+                    # the rest used nothing either, an idle processor has no heaviest process
+                    break
+                if (pid, start_time) not in self.commands:
+                    self.commands[(pid, start_time)] = self.read_command(pid, name)
+                top.append((pid, self.boot_time * 1000 + start_time * 1000 // CLOCK_TICKS,
+                            self.commands[(pid, start_time)], round(process_usage, 1)))
+            heaviest_usage, command = (top[0][3], top[0][2]) if top else (0.0, "")
+            result[processor_id] = {"process_usage": heaviest_usage,
+                                    "command": command,
+                                    "processor_usage": round(usage, 1),
+                                    "top": top[:self.top_k]}
+        return result
@@ -0,0 +1,171 @@
+from typing import Dict, List, Optional
+from pathlib import Path
+import os
+import re
+from topology import Topology
+import exceptions
+
+
+HWMON_ROOT = Path("/sys/class/hwmon")
+CORE_LABEL = re.compile(r"(\d+)")
+# amd package sensors, Tdie is the real temperature where Tctl can have an offset for fan control
+K10TEMP_LABELS = ["Tdie", "Tctl"]
+
+
+def read_file(path: Path) -> str:
+    """
+    open a file and read its first line
+
+    :param path: Path, path to the file
+    :return: str, the first line of a file
+    """
+    with open(str(path)) as file:
+        return file.readline().strip()
+
+
+class SensorRegistry:
+    """
+    keeps the coretemp and k10temp temperature inputs open between readings
+
+    the hwmon tree is walked once to find every core and package temperature input, each input is kept open
+    and read with pread on every reading. the tree is only walked again when a hwmon device
+    appears or disappears, when a kept input stops being readable or when the topology changes.
+
+    intel hosts have one coretemp device per package with a 'Package id N' input and one 'Core N' input
+    per core id. amd hosts have one k10temp device per package without core inputs.
+    k10temp devices are matched to packages in the order of their pci address.
+    cores without an input of their own get the temperature of their package, or of the hottest core input
+    of their package when it has no package input.
+    with a cpu topology the core inputs are keyed by the core numbers of topology.Topology,
+    without one by their core id.
+    """
+
+    def __init__(self, hwmon_root: Path = HWMON_ROOT):
+        self.hwmon_root = hwmon_root
+        self.devices: List[str] = []
+        self.topology: Optional[Topology] = None
+        # core -> fd of its input
+        self.inputs: Dict[int, int] = {}
+        # package -> fd of its input
+        self.package_inputs: Dict[int, int] = {}
+        # core -> package, cores of the topology without an input of their own
+        self.package_cores: Dict[int, int] = {}
+        # package -> temperature: int, of the last reading
+        self.packages: Dict[int, int] = {}
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        closes all open temperature inputs
+
+        :return: None
+        """
+        for fd in list(self.inputs.values()) + list(self.package_inputs.values()):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.inputs = {}
+        self.package_inputs = {}
+        self.package_cores = {}
+
+    def open(self, hwmon: Path, label_file: str) -> int:
+        return os.open(str(hwmon.joinpath(label_file.replace("_label", "_input"))), os.O_RDONLY)
+
+    def scan(self, topology: Optional[Topology] = None):
+        """
+        walks the hwmon tree and opens every coretemp and k10temp input
+
+        :param topology: topology.Topology, what the inputs are matched to
+        :return: None
+        """
+        self.close()
+        self.topology = topology
+        self.devices = sorted(os.listdir(str(self.hwmon_root)))
+        coretemps, k10temps = [], []
+        for device in self.devices:
+            hwmon = self.hwmon_root.joinpath(device)
+            try:
+                name = read_file(hwmon.joinpath("name")).lower()
+            except OSError:
+                continue
+            labels = {file.name: read_file(file) for file in hwmon.iterdir() if file.name.endswith("_label")}
+            if name == "coretemp":
+                coretemps.append((hwmon, labels))
+            elif name == "k10temp":
+                # the device link points at the pci function of the package, such as 0000:00:18.3
+                k10temps.append((os.path.realpath(str(hwmon.joinpath("device"))), device, hwmon, labels))
+
+        for position, (hwmon, labels) in enumerate(coretemps):
+            packages = [int(CORE_LABEL.search(label).group(1)) for label in labels.values()
+                        if label.lower().startswith("package") and CORE_LABEL.search(label)]
+            package = packages[0] if packages else position
+            for file, label in sorted(labels.items()):
+                match = CORE_LABEL.search(label)
+                if label.lower().startswith("package"):
+                    self.package_inputs[package] = self.open(hwmon, file)
+                elif "core" in label.lower() and match:
+                    core = int(match.group(1))
+                    if topology:
+                        core = topology.core(package, core)
+                    if core is not None:
+                        self.inputs[core] = self.open(hwmon, file)
+
+        packages = topology.packages() if topology else list(range(len(k10temps)))
+        for package, (_, _, hwmon, labels) in zip(packages, sorted(k10temps)):
+            by_label = {label: file for file, label in labels.items()}
+            for label in K10TEMP_LABELS:
+                if label in by_label:
+                    self.package_inputs[package] = self.open(hwmon, by_label[label])
+                    break
+
+        if topology:
+            for package in topology.packages():
+                for core in topology.cores_of(package):
+                    if core not in self.inputs:
+                        self.package_cores[core] = package
+
+    def changed(self, topology: Optional[Topology] = None) -> bool:
+        """
+        checks if a hwmon device appeared or disappeared or the topology changed since the last scan
+
+        :return: bool
+        """
+        return topology is not self.topology or sorted(os.listdir(str(self.hwmon_root))) != self.devices
+
+    def read_inputs(self) -> Dict[int, int]:
+        self.packages = {package: int(os.pread(fd, 16, 0)) for package, fd in self.package_inputs.items()}
+        temperatures = {core: int(os.pread(fd, 16, 0)) for core, fd in self.inputs.items()}
+        hottest: Dict[int, int] = {}
+        if self.topology:
+            for core, temperature in temperatures.items():
+                package = self.topology.package_of.get(core)
+                if package is not None:
+                    hottest[package] = max(hottest.get(package, temperature), temperature)
+        for core, package in self.package_cores.items():
+            if package in self.packages:
+                temperatures[core] = self.packages[package]
+            elif package in hottest:
+                # a package without a package input, such as coretemp that lost its 'Package id' input
+                temperatures[core] = hottest[package]
+            else:
+                raise exceptions.CPULoggingNotSupported(f"Found no temperature input for package {package}")
+        return temperatures
+
+    def read(self, topology: Optional[Topology] = None) -> Dict[int, int]:
+        """
+        reads the temperature of each core, the temperatures of the packages are kept in 'packages'
+
+        :param topology: topology.Topology, the inputs are matched again when it is not the one of the last scan
+        :return: dict[core: int] -> temperature: int
+        """
+        if not self.inputs and not self.package_inputs or self.changed(topology):
+            self.scan(topology)
+        try:
+            return self.read_inputs()
+        except OSError:
+            # a device went away without changing the listing, start over once
+            self.scan(topology)
+            return self.read_inputs()
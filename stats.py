@@ -0,0 +1,271 @@
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+import math
+import numpy as np
+from db import to_timestamp
+import rollup
+import exceptions
+
+
+GROUPS = ["host", "core", "processor"]
+SOURCES = ["auto", "raw"] + list(rollup.RESOLUTIONS)
+PERCENTILES = [95, 99]
+
+
+class TDigest:
+    """
+    mergeable sketch of a distribution that answers quantiles in constant memory
+
+    a merging t-digest: values are buffered and then merged into at most about 'compression' centroids
+    where centroids near the tails hold few values and centroids near the median many,
+    so p95 and p99 stay accurate. the merge assigns every value to a bin of the k1 scale function
+    so it runs in numpy instead of a python loop. two digests are combined with merge.
+
+    every centroid keeps the smallest and largest value it holds next to its mean. quantiles are interpolated
+    between the middles of the centroids, except that a centroid of equal values holds its value over all
+    of its weight, so a value added with a weight, such as a run of readings, counts as that many equal values
+    instead of being spread towards its neighbours.
+    """
+
+    def __init__(self, compression: int = 200, buffer_size: int = 50000):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.minimums = np.empty(0)
+        self.maximums = np.empty(0)
+        self.buffer: List[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = []
+        self.buffered = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, values: np.ndarray, weights: Optional[np.ndarray] = None, minimums: Optional[np.ndarray] = None,
+            maximums: Optional[np.ndarray] = None):
+        """
+        :param values: float64 array
+        :param weights: float64 array, how many values each value stands for, 1 if None
+        :param minimums: float64 array, the smallest of the values each value stands for, the value if None
+        :param maximums: float64 array, the largest of the values each value stands for, the value if None
+        :return: None
+        """
+        if not len(values):
+            return
+        weights = weights if weights is not None else np.ones(len(values))
+        minimums = minimums if minimums is not None else values
+        maximums = maximums if maximums is not None else values
+        self.buffer.append((values, weights, minimums, maximums))
+        self.buffered += len(values)
+        self.minimum = min(self.minimum, float(minimums.min()))
+        self.maximum = max(self.maximum, float(maximums.max()))
+        if self.buffered >= self.buffer_size:
+            self.compress()
+
+    def merge(self, other: "TDigest"):
+        other.compress()
+        self.add(other.means, other.weights, other.minimums, other.maximums)
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def compress(self):
+        if not self.buffer:
+            return
+        means, weights, minimums, maximums = (
+            np.concatenate([centroids] + [added[column] for added in self.buffer])
+            for column, centroids in enumerate([self.means, self.weights, self.minimums, self.maximums]))
+        self.buffer, self.buffered = [], 0
+        order = np.argsort(means, kind="stable")
+        means, weights, minimums, maximums = means[order], weights[order], minimums[order], maximums[order]
+        total = weights.sum()
+        left = (np.cumsum(weights) - weights) / total
+        # k1 scale, every bin spans one unit of k
+        bins = np.floor(self.compression / (2 * math.pi) * (np.arcsin(2 * left - 1) + math.pi / 2)).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+        self.minimums = np.minimum.reduceat(minimums, starts)
+        self.maximums = np.maximum.reduceat(maximums, starts)
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: float, between 0 and 1
+        :return: float, nan if the digest is empty
+        """
+        self.compress()
+        if not len(self.means):
+            return math.nan
+        ends = np.cumsum(self.weights)
+        starts = ends - self.weights
+        # a centroid of equal values holds its value over all of its weight, any other is placed at its middle
+        flat = self.minimums == self.maximums
+        positions = np.where(flat[:, None], np.column_stack((starts, ends)),
+                             (starts + self.weights / 2)[:, None]).ravel()
+        values = np.repeat(self.means, 2)
+        keep = np.repeat(flat, 2) | np.tile([True, False], len(flat))
+        positions = np.r_[0, positions[keep], ends[-1]]
+        values = np.r_[self.minimum, values[keep], self.maximum]
+        # interpolated from the top down so a quantile that falls exactly where one flat centroid ends
+        # and the next starts is the lower value, like the inverted cdf percentile of the values
+        return float(np.interp(-q * ends[-1], -positions[::-1], values[::-1]))
+
+
+class Summary:
+    """
+    count, sum, sum of squares, min, max and a t-digest of one group
+
+    every part is mergeable so raw rows and rollups can be added in any order
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        # False once a rollup without a sum of squares was added, they are NULL for rollups from before version 4
+        self.exact_squares = True
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.digest = TDigest()
+
+    def add(self, values: np.ndarray, samples: Optional[np.ndarray] = None):
+        """
+        adds raw values
+
+        :param values: float64 array
+        :param samples: float64 array, how many readings each value stands for, 1 if None
+        :return: None
+        """
+        if samples is None:
+            samples = np.ones(len(values))
+        self.count += int(samples.sum())
+        self.total += float(np.dot(values, samples))
+        self.squares += float(np.dot(values * values, samples))
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        self.digest.add(values, samples)
+
+    def add_buckets(self, counts: np.ndarray, sums: np.ndarray, squares: np.ndarray, minimums: np.ndarray,
+                    maximums: np.ndarray):
+        """
+        adds rollup buckets, the digest gets the mean, minimum and maximum of each bucket weighted by its count
+
+        :return: None
+        """
+        self.count += int(counts.sum())
+        self.total += float(sums.sum())
+        if np.isnan(squares).any():
+            self.exact_squares = False
+        self.squares += float(np.nansum(squares))
+        self.minimum = min(self.minimum, float(minimums.min()))
+        self.maximum = max(self.maximum, float(maximums.max()))
+        self.digest.add(sums / counts, counts, minimums, maximums)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count
+
+    @property
+    def stdev(self) -> float:
+        """
+        sample standard deviation like statistics.stdev, nan if it can not be known
+        """
+        if self.count < 2 or not self.exact_squares:
+            return math.nan
+        return math.sqrt(max(0.0, (self.squares - self.total * self.total / self.count) / (self.count - 1)))
+
+
+def group(summaries: Dict[Tuple[int, int], Summary], clients: np.ndarray, keys: np.ndarray, *columns: np.ndarray):
+    """
+    splits a chunk of columns by (client_id, key) and yields the summary and columns of each group
+
+    :return: iterator of tuple(summary, columns of the group)
+    """
+    order = np.lexsort((keys, clients))
+    clients, keys = clients[order], keys[order]
+    columns = [column[order] for column in columns]
+    starts = np.flatnonzero(np.r_[True, (clients[1:] != clients[:-1]) | (keys[1:] != keys[:-1])])
+    ends = np.r_[starts[1:], len(clients)]
+    for start, end in zip(starts, ends):
+        identity = (int(clients[start]), int(keys[start]))
+        if identity not in summaries:
+            summaries[identity] = Summary()
+        yield summaries[identity], [column[start:end] for column in columns]
+
+
+def summarize(storage, client_ids: List[int], measurement: str, by: str, start_time: datetime,
+              end_time: datetime, source: str = "auto") -> Dict[Tuple[int, int], Summary]:
+    """
+    summarizes a measurement per host, core or processor in one streaming pass
+
+    with source 'auto' the raw rows are used where they exist and before the oldest raw row of a host,
+    where retention deleted them, the finest rollups that exist are used and before those the next coarser and so on.
+    with 'raw' only the raw rows are used and with a resolution name only the rollups of that resolution,
+    which is the fastest over long ranges. rollup buckets that are not fully within the range are left out.
+    percentiles of rollups are of the bucket means so they understate the tails.
+    storages without rollups only have the raw rows. a raw row that stands for a run of readings
+    counts as every reading of the run, see changes.ChangeFilter.
+
+    :param storage: storage.Storage
+    :param client_ids: list of int
+    :param measurement: str, 'temperature' or 'processor_usage'
+    :param by: str, one of GROUPS
+    :param start_time: datetime
+    :param end_time: datetime
+    :param source: str, one of SOURCES
+    :return: dict[(client_id: int, key: int)] -> Summary, key is 0 when grouped by host
+    """
+    if source not in ("auto", "raw") and not storage.rollups:
+        raise exceptions.ArgumentError(f"--source {source} needs rollups, this storage only keeps the raw rows")
+    summaries: Dict[Tuple[int, int], Summary] = {}
+
+    boundaries = {client_id: to_timestamp(end_time) for client_id in client_ids}
+    if source in ("auto", "raw"):
+        for clients, keys, values, samples in storage.iter_raw(client_ids, measurement, by, start_time, end_time):
+            for summary, (group_values, group_samples) in group(summaries, clients, keys, values, samples):
+                summary.add(group_values, group_samples)
+        if source == "raw" or not storage.rollups:
+            return summaries
+        boundaries.update(storage.oldest_raw(client_ids, start_time, end_time))
+
+    resolutions = list(rollup.RESOLUTIONS.values()) if source == "auto" else [rollup.RESOLUTIONS[source]]
+    for resolution in resolutions:
+        for client_id, boundary in list(boundaries.items()):
+            first = boundary
+            for clients, keys, buckets, *columns in storage.iter_rollups(
+                    client_id, measurement, by, resolution, start_time, boundary):
+                first = min(first, int(buckets.min()))
+                for summary, group_columns in group(summaries, clients, keys, *columns):
+                    summary.add_buckets(*group_columns)
+            boundaries[client_id] = first
+    return summaries
+
+
+def report(storage, measurement: str, by: str, start_time: datetime, end_time: datetime,
+           source: str = "auto", host: Optional[str] = None):
+    """
+    prints count, mean, median, standard deviation, min, percentiles and max per group
+
+    temperatures are printed in degrees C
+
+    :param storage: storage.Storage
+    :param measurement: str, 'temperature' or 'processor_usage'
+    :param by: str, one of GROUPS
+    :param start_time: datetime
+    :param end_time: datetime
+    :param source: str, one of SOURCES
+    :param host: str, only this host, every host if None
+    :return: None
+    """
+    hosts = storage.hosts(host)
+    summaries = summarize(storage, list(hosts), measurement, by, start_time, end_time, source)
+    if not summaries:
+        print("No data in the given time range.")
+        return
+
+    scale = 1000 if measurement == "temperature" else 1
+    columns = ["mean", "median", "stdev", "min"] + [f"p{percentile}" for percentile in PERCENTILES] + ["max"]
+    label = "" if by == "host" else f"{by:>10}"
+    print(f"{'host':<20}{label}{'count':>14}" + "".join(f"{column:>10}" for column in columns))
+    for (client_id, key), summary in sorted(summaries.items(), key=lambda item: (hosts[item[0][0]], item[0][1])):
+        values = [summary.mean, summary.digest.quantile(0.5), summary.stdev, summary.minimum] + \
+                 [summary.digest.quantile(percentile / 100) for percentile in PERCENTILES] + [summary.maximum]
+        print(f"{hosts[client_id]:<20}" + (f"{key:>10}" if by != "host" else "") + f"{summary.count:>14,}" +
+              "".join(f"{value / scale:>10.2f}" for value in values))
@@ -0,0 +1,338 @@
+from typing import Dict, List, Optional, Tuple, Iterator, TYPE_CHECKING
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from timestamps import to_timestamp, from_timestamp
+
+if TYPE_CHECKING:
+    # the database modules are imported by SqlStorage so the binary log does not load sqlalchemy
+    import numpy as np
+    from db import Client
+    from retention import Retention
+
+
+# adresses starting with this are a directory of the binary log, see binlog.py
+LOG_SCHEME = "log://"
+
+
+def open_storage(adress: str, flush_size: int = 1024, flush_interval: float = 30.0,
+                 retention: Optional["Retention"] = None) -> "Storage":
+    """
+    picks the storage of an adress
+
+    'log:///path/to/directory' is the binary log of binlog.py, anything else is a sqlalchemy url
+
+    :param adress: str
+    :param flush_size: int, rows buffered before they are written
+    :param flush_interval: float, longest time in seconds rows are buffered
+    :param retention: retention.Retention, expires old rows after every flush
+    :return: Storage
+    """
+    if adress.startswith(LOG_SCHEME):
+        # only imported when used so --log against a database does not pay for it
+        from binlog import LogStorage
+        return LogStorage(adress[len(LOG_SCHEME):], flush_size, flush_interval, retention)
+    return SqlStorage(adress, flush_size, flush_interval, retention)
+
+
+class Storage(ABC):
+    """
+    where readings are written to and read back from
+
+    store_temp, plot and stats only go through this interface. readings are buffered by add
+    and written by flush, which is also called when the storage exits.
+    a backend has to implement every abstractmethod, add_top, add_packages, add_tick and oldest_raw are optional.
+    columns are read as numpy float64 arrays like query.iter_columns gives them.
+    """
+
+    # whether minute, hour and day rollups are kept next to the raw rows
+    rollups = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    @abstractmethod
+    def add(self, host: str, time: datetime, stats: List[tuple]):
+        """
+        buffers one reading
+
+        :param host: str
+        :param time: datetime, time of the reading
+        :param stats: list of tuple(core, processor, processor_usage, process, process_usage, temperature),
+                      see cpu_temp.get_stats
+        :return: None
+        """
+        raise NotImplementedError
+
+    def add_top(self, host: str, time: datetime, top: Dict[int, List[tuple]]):
+        """
+        buffers the heaviest processes of every processor in one reading, storages without a process_samples
+        table drop them
+
+        :param host: str
+        :param time: datetime, time of the reading
+        :param top: dict[processor: int] -> list of tuple(pid, start_time, command, usage), see cpu_temp.get_stats
+        :return: None
+        """
+        pass
+
+    def add_packages(self, host: str, time: datetime, packages: Dict[int, int]):
+        """
+        buffers the package temperatures of one reading, storages without a package_temperatures table drop them
+
+        :param host: str
+        :param time: datetime, time of the reading
+        :param packages: dict[package: int] -> temperature: int, see cpu_temp.get_package_temp
+        :return: None
+        """
+        pass
+
+    def add_tick(self, host: str, tick: dict):
+        """
+        buffers what taking a reading cost, see instrument.TickProfiler, storages without a ticks table drop it
+
+        :return: None
+        """
+        pass
+
+    @abstractmethod
+    def flush(self):
+        """
+        writes the buffered readings
+
+        :return: None
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def hosts(self, host: Optional[str] = None) -> Dict[int, str]:
+        """
+        :param host: str, only this host, every host if None
+        :return: dict[client_id: int] -> host: str
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_raw(self, client_id: int, measurement: str, start_time: datetime,
+                 end_time: datetime) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray", "np.ndarray"]:
+        """
+        reads the raw samples of one measurement for a client within a time range
+
+        :return: tuple(times: int64 ms, processors: int64, cores: int64, values: float64)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_raw(self, client_ids: List[int], measurement: str, by: str, start_time: datetime,
+                 end_time: datetime) -> Iterator[List["np.ndarray"]]:
+        """
+        streams one measurement of many clients in chunks, NULL values are left out
+
+        :param client_ids: list of int
+        :param measurement: str, 'temperature' or 'processor_usage'
+        :param by: str, 'host', 'core' or 'processor', the key column, 0 for 'host'
+        :param start_time: datetime
+        :param end_time: datetime
+        :return: iterator of [client_ids, keys, values, samples] float64 arrays,
+                 samples is how many readings each row stands for, see changes.ChangeFilter
+        """
+        raise NotImplementedError
+
+    def oldest_raw(self, client_ids: List[int], start_time: datetime, end_time: datetime) -> Dict[int, int]:
+        """
+        :return: dict[client_id: int] -> milliseconds of the oldest raw sample within the range
+        """
+        return {}
+
+    @abstractmethod
+    def iter_rollups(self, client_id: int, measurement: str, by: str, resolution: int, start_time: datetime,
+                     until: int) -> Iterator[List["np.ndarray"]]:
+        """
+        streams the rollup buckets of one resolution that start at start_time or later and end by until
+
+        :param until: int, milliseconds
+        :return: iterator of [client_ids, keys, buckets, counts, sums, squares, minimums, maximums] float64 arrays
+        """
+        raise NotImplementedError
+
+    def read_series(self, host: str, measurement: str, core: bool, start_time: datetime,
+                    end_time: datetime) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+        """
+        reads what cpu_temp.plot draws, the mean of every minute, hour or day when the range is long enough,
+        see rollup.pick_resolution. without rollups the raw samples are averaged into buckets while reading.
+
+        :param host: str
+        :param measurement: str, 'temperature' or 'processor_usage'
+        :param core: bool, mean per core instead of per processor
+        :param start_time: datetime
+        :param end_time: datetime
+        :return: tuple(times: int64 ms, keys: int64, values: float64)
+        """
+        import numpy as np
+        import query
+        import rollup
+
+        client_ids = list(self.hosts(host))
+        if not client_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        times, processors, cores, values = self.read_raw(client_ids[0], measurement, start_time, end_time)
+        resolution = rollup.pick_resolution(from_timestamp(int(times.min())), end_time) if len(times) else None
+        if resolution:
+            # like the rollups, every bucket that starts after start_time and before end_time is used in full
+            size = resolution * 1000
+            end = to_timestamp(end_time)
+            rest = self.read_raw(client_ids[0], measurement, end - 1, -(-end // size) * size)
+            times, processors, cores, values = [np.concatenate(columns) for columns in
+                                                zip((times, processors, cores, values), rest)]
+            buckets = times // size * size
+            used = buckets > to_timestamp(start_time)
+            keys = cores[used] if core else processors[used]
+            keys, times, values = query.group_mean(keys, buckets[used], values[used])
+            return times, keys, values
+        keys = cores if core else processors
+        if core:
+            keys, times, values = query.group_mean(keys, times, values)
+        return times, keys, values
+
+
+class SqlStorage(Storage):
+    """
+    the processor rows, rollups, process samples and ticks tables of a sqlalchemy database, written through Manager
+    """
+
+    rollups = True
+
+    def __init__(self, engine_adress: str, flush_size: int = 1024, flush_interval: float = 30.0,
+                 retention: Optional["Retention"] = None):
+        from manager import Manager
+
+        self.manager = Manager(engine_adress, flush_size, flush_interval, retention)
+        self.engine = self.manager.engine
+        self.clients: Dict[str, "Client"] = {}
+
+    def __enter__(self):
+        self.manager.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.manager.__exit__(exc_type, exc_val, exc_tb)
+
+    def client(self, host: str) -> "Client":
+        if host not in self.clients:
+            self.clients[host] = self.manager.get_client(host)
+        return self.clients[host]
+
+    def add(self, host: str, time: datetime, stats: List[tuple]):
+        client = self.client(host)
+        for core, cpu, cpu_usage, process, process_usage, temperature in stats:
+            self.manager.buffer_cpu(client, core, cpu, cpu_usage, process, process_usage, temperature, time)
+
+    def add_top(self, host: str, time: datetime, top: Dict[int, List[tuple]]):
+        self.manager.buffer_top(self.client(host), time, top)
+
+    def add_packages(self, host: str, time: datetime, packages: Dict[int, int]):
+        self.manager.buffer_packages(self.client(host), time, packages)
+
+    def add_tick(self, host: str, tick: dict):
+        self.manager.buffer_tick(self.client(host), tick)
+
+    def flush(self):
+        self.manager.flush()
+
+    def hosts(self, host: Optional[str] = None) -> Dict[int, str]:
+        from sqlalchemy import select
+        from db import Client
+
+        table = Client.__table__
+        statement = select(table.c.id, table.c.identifier)
+        if host:
+            statement = statement.where(table.c.identifier == host)
+        with self.engine.connect() as connection:
+            return {client_id: identifier for client_id, identifier in connection.execute(statement)}
+
+    def read_raw(self, client_id: int, measurement: str, start_time: datetime, end_time: datetime):
+        import query
+
+        with self.engine.connect() as connection:
+            return query.query_raw(connection, client_id, measurement, start_time, end_time)
+
+    def iter_raw(self, client_ids: List[int], measurement: str, by: str, start_time: datetime, end_time: datetime):
+        from sqlalchemy import select, func
+        from db import Processor
+        import query
+
+        raw = Processor.__table__
+        key = raw.c[by] if by != "host" else raw.c.client_id * 0
+        statement = select(raw.c.client_id, key, raw.c[measurement], func.coalesce(raw.c.samples, 1)).where(
+            raw.c.client_id.in_(client_ids), raw.c.time > to_timestamp(start_time),
+            raw.c.time < to_timestamp(end_time), raw.c[measurement].isnot(None))
+        with self.engine.connect() as connection:
+            yield from query.iter_columns(connection, statement)
+
+    def oldest_raw(self, client_ids: List[int], start_time: datetime, end_time: datetime) -> Dict[int, int]:
+        from sqlalchemy import select, func, Integer, type_coerce
+        from db import Processor
+
+        raw = Processor.__table__
+        statement = select(raw.c.client_id, func.min(type_coerce(raw.c.time, Integer))).where(
+            raw.c.client_id.in_(client_ids), raw.c.time > to_timestamp(start_time),
+            raw.c.time < to_timestamp(end_time)).group_by(raw.c.client_id)
+        with self.engine.connect() as connection:
+            return {client_id: first for client_id, first in connection.execute(statement)}
+
+    def iter_rollups(self, client_id: int, measurement: str, by: str, resolution: int, start_time: datetime,
+                     until: int):
+        from sqlalchemy import select, Integer, type_coerce
+        from db import Rollup
+        import query
+
+        table = Rollup.__table__
+        key = table.c[by] if by != "host" else table.c.client_id * 0
+        statement = select(
+            table.c.client_id, key, type_coerce(table.c.bucket, Integer), table.c.count,
+            table.c[f"{measurement}_sum"], table.c[f"{measurement}_squares"], table.c[f"{measurement}_min"],
+            table.c[f"{measurement}_max"]
+        ).where(table.c.client_id == client_id, table.c.resolution == resolution,
+                table.c.bucket >= to_timestamp(start_time), table.c.bucket <= until - resolution * 1000)
+        with self.engine.connect() as connection:
+            yield from query.iter_columns(connection, statement)
+
+    def read_series(self, host: str, measurement: str, core: bool, start_time: datetime, end_time: datetime):
+        """
+        reads the rollups when the range is long enough instead of averaging the raw rows,
+        and the finest rollups that exist when retention already deleted the raw rows of the range
+        """
+        from sqlalchemy import func
+        from db import Processor, Rollup
+        import query
+        import rollup
+
+        session = self.manager.session
+        client = self.client(host)
+        first_raw = session.query(func.min(Processor.time)).filter(
+            start_time < Processor.time, client == Processor.client).scalar()
+        # the raw rows may have been deleted by retention before the rollups were
+        first_rollups = dict(session.query(Rollup.resolution, func.min(Rollup.bucket)).filter(
+            start_time < Rollup.bucket, client.id == Rollup.client_id).group_by(Rollup.resolution).all())
+        first = min([first_raw, end_time] + list(first_rollups.values()), key=lambda time: time or end_time)
+        resolution = rollup.pick_resolution(first, end_time)
+        # a bucket only says there was data somewhere within it
+        expired = [size for size, bucket in first_rollups.items()
+                   if first_raw is None or first_raw >= bucket + timedelta(seconds=size)]
+        if resolution is None and expired:
+            resolution = min(expired)
+        with self.engine.connect() as connection:
+            if resolution:
+                times, keys, values = query.query_rollup(
+                    connection, client.id, measurement, start_time, end_time, resolution, core)
+            else:
+                times, processors, cores, values = query.query_raw(
+                    connection, client.id, measurement, start_time, end_time)
+                if core:
+                    # rows that stand for runs of readings do not line up between the processors of a core
+                    keys, times, values = query.step_mean(cores, processors, times, values)
+                else:
+                    keys = processors
+        return times, keys, values
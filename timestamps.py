@@ -0,0 +1,28 @@
+from typing import Dict, Union
+from datetime import datetime
+
+
+# seconds per bucket of the minute, hour and day rollups, see rollup.py
+RESOLUTIONS: Dict[str, int] = {"minute": 60, "hour": 3600, "day": 86400}
+
+
+def to_timestamp(time: Union[datetime, int, float]) -> int:
+    """
+    converts a local datetime to integer milliseconds since epoch
+
+    :param time: datetime, numbers are assumed to already be milliseconds
+    :return: int
+    """
+    if isinstance(time, datetime):
+        return int(round(time.timestamp() * 1000))
+    return int(time)
+
+
+def from_timestamp(timestamp: int) -> datetime:
+    """
+    converts integer milliseconds since epoch to a local datetime
+
+    :param timestamp: int
+    :return: datetime
+    """
+    return datetime.fromtimestamp(timestamp / 1000)
@@ -0,0 +1,114 @@
+from typing import List
+from datetime import datetime
+from sqlalchemy import select, func, literal, union_all, Integer, Float, type_coerce
+from db import Processor, ProcessRollup, Process, to_timestamp
+import rollup
+
+
+GROUPS = ["host", "core", "processor"]
+RANKINGS = ["count", "usage"]
+
+
+def heaviest(connection, client_id: int, start_time: datetime, end_time: datetime, by: str = "core",
+             rank: str = "count", limit: int = 5) -> List[tuple]:
+    """
+    finds the processes that were the heaviest process most often, or used the most, per core or processor
+
+    the whole hours of the window are read from the hourly counters in process_rollups and only the partial
+    hours at its ends from the raw rows, both through their (client_id, bucket) and (client_id, time) indexes.
+    grouping and ranking happen inside the database.
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param start_time: datetime
+    :param end_time: datetime
+    :param by: str, one of GROUPS
+    :param rank: str, 'count' ranks by how often a process was the heaviest, 'usage' by the usage it added up to
+    :param limit: int, processes per group
+    :return: list of tuple(key: int, rank: int, command: str, count: int, samples: int, usage_sum: float,
+                           temperature_mean: float, temperature_max: int, group_temperature_mean: float)
+    """
+    start, end = to_timestamp(start_time), to_timestamp(end_time)
+    size = rollup.PROCESS_RESOLUTION * 1000
+    first_hour, last_hour = -(-start // size) * size, end // size * size
+
+    raw = Processor.__table__
+    counters = ProcessRollup.__table__
+
+    def raw_part(since: int, until: int):
+        key = raw.c[by] if by != "host" else literal(0)
+        # rows that stand for a run of readings count as every reading of the run
+        samples = func.coalesce(raw.c.samples, 1)
+        return select(key.label("key"), raw.c.heaviest_process_id.label("process_id"),
+                      samples.label("count"), (raw.c.heaviest_process_usage * samples).label("usage_sum"),
+                      type_coerce(raw.c.temperature * samples, Float).label("temperature_sum"),
+                      raw.c.temperature.label("temperature_max")).where(
+            raw.c.client_id == client_id, raw.c.time >= since, raw.c.time < until,
+            raw.c.heaviest_process_id.isnot(None), raw.c.heaviest_process_usage > 0)
+
+    if first_hour < last_hour:
+        key = counters.c[by] if by != "host" else literal(0)
+        parts = [raw_part(start, first_hour), raw_part(last_hour, end),
+                 select(key.label("key"), counters.c.process_id, counters.c["count"], counters.c.usage_sum,
+                        counters.c.temperature_sum, counters.c.temperature_max).where(
+                     counters.c.client_id == client_id, counters.c.bucket >= first_hour,
+                     counters.c.bucket < last_hour)]
+    else:
+        parts = [raw_part(start, end)]
+    rows = union_all(*parts).subquery("rows")
+
+    # readings of idle processors, where the heaviest process used nothing, are left out above and in the
+    # counters, see rollup.aggregate_processes. migrated readings without a heaviest process have the empty command
+    busy = Process.__table__
+    grouped = select(
+        rows.c.key, rows.c.process_id, func.sum(rows.c["count"]).label("count"),
+        func.sum(rows.c.usage_sum).label("usage_sum"), func.sum(rows.c.temperature_sum).label("temperature_sum"),
+        func.max(rows.c.temperature_max).label("temperature_max")
+    ).join(busy, busy.c.id == rows.c.process_id).where(busy.c.command != "").group_by(
+        rows.c.key, rows.c.process_id).subquery("grouped")
+
+    order = grouped.c["count"] if rank == "count" else grouped.c.usage_sum
+    ranked = select(
+        grouped,
+        func.row_number().over(partition_by=grouped.c.key, order_by=order.desc()).label("rank"),
+        func.sum(grouped.c["count"]).over(partition_by=grouped.c.key).label("samples"),
+        func.sum(grouped.c.temperature_sum).over(partition_by=grouped.c.key).label("group_temperature_sum")
+    ).subquery("ranked")
+
+    statement = select(
+        type_coerce(ranked.c.key, Integer), ranked.c.rank, busy.c.command, ranked.c["count"], ranked.c.samples,
+        ranked.c.usage_sum, ranked.c.temperature_sum * 1.0 / ranked.c["count"], ranked.c.temperature_max,
+        ranked.c.group_temperature_sum * 1.0 / ranked.c.samples
+    ).join(busy, busy.c.id == ranked.c.process_id).where(ranked.c.rank <= limit).order_by(ranked.c.key, ranked.c.rank)
+    return [tuple(row) for row in connection.execute(statement)]
+
+
+def report(connection, client_id: int, start_time: datetime, end_time: datetime, by: str = "core",
+           rank: str = "count", limit: int = 5):
+    """
+    prints the top processes per core or processor with the temperature while they were the heaviest
+
+    'heaviest' is the share of the samples of the core where the process was the heaviest,
+    'temp' the mean temperature in those samples and 'vs core' how much warmer that is
+    than the mean of every sample of the core that had a heaviest process
+
+    :param connection: sqlalchemy connection
+    :param client_id: int
+    :param start_time: datetime
+    :param end_time: datetime
+    :param by: str, one of GROUPS
+    :param rank: str, one of RANKINGS
+    :param limit: int, processes per group
+    :return: None
+    """
+    rows = heaviest(connection, client_id, start_time, end_time, by, rank, limit)
+    if not rows:
+        print("No heaviest processes in the given time range.")
+        return
+    label = "" if by == "host" else f"{by:>6}"
+    print(f"{label}{'#':>3} {'command':<48}{'heaviest':>10}{'share':>8}{'mean %':>8}"
+          f"{'temp C':>8}{'max C':>8}{'vs ' + by:>10}")
+    for key, position, command, count, samples, usage_sum, temperature, maximum, group_temperature in rows:
+        print((f"{key:>6}" if by != "host" else "") + f"{position:>3} {command[-48:]:<48}{count:>10,}"
+              f"{count / samples * 100:>7.1f}%{usage_sum / count:>8.1f}{temperature / 1000:>8.1f}"
+              f"{maximum / 1000:>8.1f}{(temperature - group_temperature) / 1000:>+10.2f}")
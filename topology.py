@@ -0,0 +1,170 @@
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import os
+import re
+import exceptions
+
+
+CPU_ROOT = Path("/sys/devices/system/cpu")
+PROC_ROOT = Path("/proc")
+CPU_DIRECTORY = re.compile(r"^cpu(\d+)$")
+# fields of one processor block of /proc/cpuinfo
+CPUINFO_PROCESSOR = re.compile(r"^processor\s*:\s*(\d+)\s*$", re.MULTILINE)
+CPUINFO_PACKAGE = re.compile(r"^physical id\s*:\s*(\d+)\s*$", re.MULTILINE)
+CPUINFO_CORE = re.compile(r"^core id\s*:\s*(\d+)\s*$", re.MULTILINE)
+
+
+def read_number(path: Path, default: Optional[int] = None) -> int:
+    """
+    :param path: Path, a sysfs file holding one integer
+    :param default: int, returned if the file does not exist, the error is raised if None
+    :return: int
+    """
+    try:
+        with open(str(path)) as file:
+            return int(file.read().strip())
+    except FileNotFoundError:
+        if default is None:
+            raise
+        return default
+
+
+class Topology:
+    """
+    which package, die and core every online processor is on
+
+    core ids only count within a die, so on hosts with more than one package or die they repeat.
+    every core gets a number that is unique on the host: the index of its die times the span of the core ids
+    plus its core id. hosts with one die keep their core ids as core numbers.
+    """
+
+    def __init__(self, threads: Dict[int, Tuple[int, int, int]], online: str = ""):
+        """
+        :param threads: dict[processor: int] -> tuple(package: int, die: int, core id: int)
+        :param online: str, the online processors this was read for, see TopologyCache
+        """
+        if not threads:
+            raise exceptions.CPULoggingNotSupported("Found no processors in the cpu topology")
+        self.threads = threads
+        self.online = online
+        dies = sorted({(package, die) for package, die, _ in threads.values()})
+        span = max(core for _, _, core in threads.values()) + 1
+        self.dies: Dict[Tuple[int, int], int] = {die: index for index, die in enumerate(dies)}
+        self.cores: Dict[int, int] = {processor: self.dies[(package, die)] * span + core
+                                      for processor, (package, die, core) in threads.items()}
+        # core number -> package
+        self.package_of: Dict[int, int] = {self.cores[processor]: package
+                                           for processor, (package, _, _) in threads.items()}
+        # (package, core id) -> core number, what a sensor that only knows its package can be matched on
+        self.package_cores: Dict[Tuple[int, int], int] = {}
+        for processor, (package, die, core) in sorted(threads.items()):
+            self.package_cores.setdefault((package, core), self.cores[processor])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(processors={len(self.threads)}, cores={len(set(self.cores.values()))}, " \
+            f"packages={len(self.packages())})"
+
+    def core_map(self) -> Dict[int, int]:
+        """
+        :return: dict[processor: int] -> core number: int
+        """
+        return dict(self.cores)
+
+    def packages(self) -> List[int]:
+        return sorted({package for package, _, _ in self.threads.values()})
+
+    def cores_of(self, package: int) -> List[int]:
+        """
+        :param package: int
+        :return: list of the core numbers on a package
+        """
+        return sorted({self.cores[processor] for processor, (thread_package, _, _) in self.threads.items()
+                       if thread_package == package})
+
+    def core(self, package: int, core: int) -> Optional[int]:
+        """
+        :param package: int
+        :param core: int, core id within the package
+        :return: int, the core number or None if the package has no such core
+        """
+        return self.package_cores.get((package, core))
+
+
+def read_sysfs(cpu_root: Path = CPU_ROOT) -> Dict[int, Tuple[int, int, int]]:
+    """
+    reads the topology of every online processor from /sys/devices/system/cpu/cpu*/topology
+
+    offline processors have no topology directory and are left out, kernels before 5.4 have no die_id
+
+    :param cpu_root: Path
+    :return: dict[processor: int] -> tuple(package: int, die: int, core id: int), empty if sysfs has no topology
+    """
+    threads = {}
+    for entry in os.listdir(str(cpu_root)):
+        match = CPU_DIRECTORY.match(entry)
+        if not match:
+            continue
+        topology = cpu_root.joinpath(entry, "topology")
+        try:
+            threads[int(match.group(1))] = (read_number(topology.joinpath("physical_package_id")),
+                                            read_number(topology.joinpath("die_id"), 0),
+                                            read_number(topology.joinpath("core_id")))
+        except FileNotFoundError:
+            continue
+    return threads
+
+
+def read_cpuinfo(proc_root: Path = PROC_ROOT) -> Dict[int, Tuple[int, int, int]]:
+    """
+    reads the topology of every processor from /proc/cpuinfo, for when sysfs is not there
+
+    :param proc_root: Path
+    :return: dict[processor: int] -> tuple(package: int, 0, core id: int)
+    """
+    path = proc_root.joinpath("cpuinfo")
+    if not path.exists():
+        raise exceptions.CPULoggingNotSupported(f"Can not find file {path}")
+    with open(str(path)) as file:
+        blocks = file.read().strip("\n").split("\n\n")
+    threads = {}
+    for block in blocks:
+        processor = CPUINFO_PROCESSOR.search(block)
+        if not processor:
+            raise exceptions.CPULoggingNotSupported("Can not find info about processor id in /proc/cpuinfo")
+        core = CPUINFO_CORE.search(block)
+        if not core:
+            raise exceptions.CPULoggingNotSupported("Can not find info about core id in /proc/cpuinfo")
+        package = CPUINFO_PACKAGE.search(block)
+        threads[int(processor.group(1))] = (int(package.group(1)) if package else 0, 0, int(core.group(1)))
+    return threads
+
+
+class TopologyCache:
+    """
+    keeps the topology between readings
+
+    the topology is read once and only read again when the list of online processors changes,
+    which is one small read of /sys/devices/system/cpu/online per call
+    """
+
+    def __init__(self, cpu_root: Path = CPU_ROOT, proc_root: Path = PROC_ROOT):
+        self.cpu_root = cpu_root
+        self.proc_root = proc_root
+        self.topology: Optional[Topology] = None
+
+    def read_online(self) -> str:
+        try:
+            with open(str(self.cpu_root.joinpath("online"))) as file:
+                return file.read().strip()
+        except OSError:
+            return ""
+
+    def get(self) -> Topology:
+        """
+        :return: Topology, the same object as long as the online processors do not change
+        """
+        online = self.read_online()
+        if self.topology is None or self.topology.online != online:
+            threads = read_sysfs(self.cpu_root) if self.cpu_root.exists() else {}
+            self.topology = Topology(threads if threads else read_cpuinfo(self.proc_root), online)
+        return self.topology